@@ -0,0 +1,287 @@
+import os
+import sys
+import gc
+import json
+import time
+import atexit
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, "..", "src")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# the stages log every file, only the warnings are kept so the logging does not weigh on the timings
+logging.basicConfig(level=logging.WARNING)
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, SRC_DIR)
+
+import numpy as np  # noqa: E402
+from synthetic import SIZES, CONFIG_TEMPLATE, make_fov, make_spot_table  # noqa: E402
+from preprocess import split_image_stack, max_projection, stream_split_projection  # noqa: E402
+from analysis import (segment_stacks, reduce_fov, find_active_slices, find_active_slices_batch, cell_intensity,  # noqa: E402
+                      cell_intensity_batch, process_fov)
+from get_mNG_intensity import (load_integrated_intensity, clean_integrated_intensity_data, fit_integrated_intensity,  # noqa: E402
+                               fit_integrated_intensity_log, bootstrap_single_mNG_intensity)
+from mask_index import MaskIndex  # noqa: E402
+
+# benchmarked stages: {name: (setup, sizes)}, see stage
+STAGES = {}
+
+# resamples of the bootstrap stage (bootstrap_single_mNG_intensity defaults to 2000)
+BOOTSTRAP_RESAMPLES = 200
+
+
+def stage(name, sizes=None):
+    """
+    Registers the setup of a benchmarked stage: setup(data) prepares the inputs of the stage (not timed) and returns
+    the function to time, called without arguments. sizes restricts the stage to some dataset sizes.
+    """
+    def register(setup):
+        STAGES[name] = (setup, sizes)
+        return setup
+    return register
+
+
+def make_data(size, seed):
+    """
+    Seeded synthetic inputs of the stages: one field of view (raw dual-view stack, GFP and RFP stacks as read from
+    their files, mask), a spot table and the analysis settings of the config template.
+    """
+    rng = np.random.default_rng(seed)
+    raw, mask = make_fov(size, rng)
+    RFP_stack, GFP_stack = split_image_stack(raw)
+    with open(CONFIG_TEMPLATE, "r") as f:
+        config = json.load(f)
+    config["active_slice_settings"]["plot_intensity_profile"] = False
+    return {"raw": raw, "mask": mask,
+            "channels": {"GFP": np.ascontiguousarray(GFP_stack), "RFP": np.ascontiguousarray(RFP_stack)},
+            "spots": make_spot_table(SIZES[size]["n_spots"], rng),
+            "n_tables": SIZES[size]["n_fovs"], "config": config}
+
+
+def _close_figure(result):
+    # the fitters return (single_mNG_intensity, fit_params, figure)
+    import matplotlib.pyplot as plt
+    plt.close(result[2])
+
+
+@stage("split_image_stack")
+def _split_image_stack(data):
+    return lambda: split_image_stack(data["raw"])
+
+
+@stage("max_projection")
+def _max_projection(data):
+    return lambda: max_projection(data["channels"]["GFP"])
+
+
+@stage("stream_split_projection")
+def _stream_split_projection(data):
+    return lambda: stream_split_projection(iter(data["raw"]))
+
+
+@stage("segment_stacks")
+def _segment_stacks(data):
+    return lambda: segment_stacks({"fov": data["channels"]}, {"fov": data["mask"]}, compact=True)
+
+
+@stage("segment_stacks_full", sizes=("small",))
+def _segment_stacks_full(data):
+    # full-frame masked copies of the stacks for each cell, too large above the small size
+    return lambda: segment_stacks({"fov": data["channels"]}, {"fov": data["mask"]})
+
+
+@stage("reduce_fov")
+def _reduce_fov(data):
+    return lambda: reduce_fov(data["channels"], data["mask"])
+
+
+@stage("reduce_fov_chunked")
+def _reduce_fov_chunked(data):
+    # out-of-core reduction, 4 slices at a time (z_chunk_size of the Execution_settings)
+    return lambda: reduce_fov(data["channels"], data["mask"], z_chunk_size=4)
+
+
+@stage("mask_index")
+def _mask_index(data):
+    return lambda: MaskIndex.from_mask(data["mask"])
+
+
+@stage("reduce_fov_indexed")
+def _reduce_fov_indexed(data):
+    # the mask as read from its sidecar (see mask_index.cached_mask_index), without the scan of the label image
+    index = MaskIndex.from_mask(data["mask"])
+    return lambda: reduce_fov(data["channels"], index)
+
+
+@stage("find_active_slices")
+def _find_active_slices(data):
+    segmented = segment_stacks({"fov": data["channels"]}, {"fov": data["mask"]}, compact=True)
+    return lambda: find_active_slices(segmented, data["config"]["active_slice_settings"])
+
+
+@stage("find_active_slices_batch")
+def _find_active_slices_batch(data):
+    _, GFP_sums, _ = reduce_fov(data["channels"], data["mask"])
+    return lambda: find_active_slices_batch(GFP_sums, data["config"]["active_slice_settings"])
+
+
+@stage("cell_intensity")
+def _cell_intensity(data):
+    segmented = segment_stacks({"fov": data["channels"]}, {"fov": data["mask"]}, compact=True)
+    active_slices = find_active_slices(segmented, data["config"]["active_slice_settings"])
+    return lambda: cell_intensity(segmented, active_slices, data["config"]["Analysis_settings"])
+
+
+@stage("cell_intensity_batch")
+def _cell_intensity_batch(data):
+    _, GFP_sums, RFP_sums = reduce_fov(data["channels"], data["mask"])
+    active = find_active_slices_batch(GFP_sums, data["config"]["active_slice_settings"])["active"]
+    return lambda: cell_intensity_batch(GFP_sums, RFP_sums, active, data["config"]["Analysis_settings"])
+
+
+@stage("process_fov")
+def _process_fov(data):
+    return lambda: process_fov("synthetic.TIF", data["channels"], data["mask"], data["config"])
+
+
+@stage("load_integrated_intensity")
+def _load_integrated_intensity(data):
+    folder = tempfile.mkdtemp(prefix="spot_tables_")
+    atexit.register(shutil.rmtree, folder, ignore_errors=True)
+    bounds = np.linspace(0, len(data["spots"]), data["n_tables"] + 1).astype(int)
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        data["spots"].iloc[start:stop].to_csv(os.path.join(folder, f"spots_{i:03d}.csv"), index=False)
+    return lambda: load_integrated_intensity(folder)
+
+
+@stage("clean_integrated_intensity_data")
+def _clean_integrated_intensity_data(data):
+    return lambda: clean_integrated_intensity_data(data["spots"])
+
+
+@stage("fit_integrated_intensity")
+def _fit_integrated_intensity(data):
+    cleaned = clean_integrated_intensity_data(data["spots"])
+    return lambda: _close_figure(fit_integrated_intensity(cleaned))
+
+
+@stage("fit_integrated_intensity_log")
+def _fit_integrated_intensity_log(data):
+    cleaned = clean_integrated_intensity_data(data["spots"])
+    return lambda: _close_figure(fit_integrated_intensity_log(cleaned))
+
+
+@stage("bootstrap_single_mNG_intensity")
+def _bootstrap_single_mNG_intensity(data):
+    cleaned = clean_integrated_intensity_data(data["spots"])
+    return lambda: bootstrap_single_mNG_intensity(cleaned, n_resamples=BOOTSTRAP_RESAMPLES)
+
+
+def measure(function, repeats):
+    """
+    Times a stage and measures its memory: a warm-up call (imports and caches), a call traced by tracemalloc for
+    the peak of the memory allocated by the stage (numpy arrays included), then the timed calls.
+
+    Returns:
+        dict: seconds (each timed call), median and min (s), peak_mb (MB).
+    """
+    function()
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return {"seconds": seconds, "median": statistics.median(seconds), "min": min(seconds), "peak_mb": peak / 2**20}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(size="small", seed=0, repeats=3, names=None):
+    """
+    Runs the benchmarked stages on a synthetic dataset of a size.
+
+    Returns:
+        dict: the run (commit, date, environment, size and seed) and the results of each stage (see measure).
+    """
+    from save_metadata import get_installed_packages
+
+    data = make_data(size, seed)
+    results = {}
+    for name, (setup, sizes) in STAGES.items():
+        if (names and name not in names) or (sizes and size not in sizes):
+            continue
+        results[name] = measure(setup(data), repeats)
+        print(f"{name:32} {results[name]['median'] * 1000:10.2f} ms  peak {results[name]['peak_mb']:9.2f} MB", flush=True)
+
+    return {"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "packages": get_installed_packages(), "size": size, "dataset": SIZES[size], "seed": seed,
+            "repeats": repeats, "results": results}
+
+
+def compare(baseline, run):
+    """
+    Prints the median time and peak memory of the stages of a run relative to a baseline run (e.g. another commit).
+    """
+    if baseline.get("size") != run["size"] or baseline.get("seed") != run["seed"]:
+        print(f"Warning: the baseline was run on another dataset (size {baseline.get('size')}, seed {baseline.get('seed')}).")
+    print(f"{'stage':32} {'baseline ms':>12} {'ms':>10} {'speedup':>8} {'baseline MB':>12} {'MB':>9}")
+    for name, result in run["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        print(f"{name:32} {base['median'] * 1000:12.2f} {result['median'] * 1000:10.2f} "
+              f"{base['median'] / result['median']:7.2f}x {base['peak_mb']:12.2f} {result['peak_mb']:9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times each stage of the pipeline on a seeded synthetic dataset.")
+    parser.add_argument("--size", choices=list(SIZES), default="small", help="size of the synthetic dataset.")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic dataset.")
+    parser.add_argument("--repeats", type=int, default=3, help="timed calls of each stage.")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None, help="stages to run (default: all).")
+    parser.add_argument("--output", default=None,
+                        help="JSON file of the results (default: results/<size>_<commit>_<date>.json in the benchmarks directory).")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare with.")
+    args = parser.parse_args(argv)
+
+    run = run_benchmarks(args.size, args.seed, args.repeats, args.stages)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{args.size}_{(run['commit'] or 'nocommit')[:10]}_{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"Saved the results to {output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
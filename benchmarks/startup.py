@@ -0,0 +1,80 @@
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# commands timed, each in a fresh interpreter
+COMMANDS = {
+    "import pipeline": ["-c", "import pipeline"],
+    "pipeline.py --help": [os.path.join(SRC_DIR, "pipeline.py"), "--help"],
+    "plot_only.py --help": [os.path.join(SRC_DIR, "plot_only.py"), "--help"],
+}
+
+# modules that the entry points must not import before a stage needs them
+HEAVY_MODULES = ("scipy", "matplotlib", "seaborn", "sklearn", "pandas", "pyarrow", "tifffile")
+
+
+def time_command(args, repeats):
+    """
+    Median wall time (s) of running python with args in a fresh process.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=SRC_DIR, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def imported_modules(args):
+    """
+    Top-level modules imported by python with args, and their cumulative import times (s), from -X importtime.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=SRC_DIR, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\S+)$", line)
+        if match:
+            top = match.group(2).split(".")[0]
+            modules[top] = max(modules.get(top, 0), int(match.group(1)) / 1e6)
+    return modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup time of the pipeline entry points.")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of each command, the median is reported.")
+    parser.add_argument("--budget", type=float, default=0.5,
+                        help="maximum startup time (s) of each command, the benchmark fails above it.")
+    parser.add_argument("--output", default=None, help="optional JSON file of the results.")
+    args = parser.parse_args(argv)
+
+    results = {}
+    failed = False
+    for name, command in COMMANDS.items():
+        seconds = time_command(command, args.repeats)
+        modules = imported_modules(command)
+        heavy = sorted(module for module in HEAVY_MODULES if module in modules)
+        slowest = sorted(modules.items(), key=lambda item: -item[1])[:5]
+        results[name] = {"seconds": seconds, "heavy_modules": heavy, "slowest_imports": dict(slowest)}
+
+        status = "ok" if seconds <= args.budget and not heavy else "FAIL"
+        failed |= status == "FAIL"
+        print(f"{status:4} {name:24} {seconds * 1000:8.1f} ms  heavy imports: {', '.join(heavy) or 'none'}")
+        print("     slowest imports: " + ", ".join(f"{module} {t * 1000:.1f} ms" for module, t in slowest))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"budget": args.budget, "python": sys.version, "results": results}, f, indent=4)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
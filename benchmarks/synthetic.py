@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# sizes of the synthetic datasets, from a quick check to the size of a production field of view
+SIZES = {
+    "small": {"n_slices": 10, "height": 128, "width": 128, "n_cells": 20, "n_spots": 20_000, "n_fovs": 2},
+    "medium": {"n_slices": 20, "height": 512, "width": 512, "n_cells": 100, "n_spots": 200_000, "n_fovs": 4},
+    "production": {"n_slices": 40, "height": 1024, "width": 1024, "n_cells": 300, "n_spots": 2_000_000, "n_fovs": 8},
+}
+
+# intensity of a single mNG of the synthetic data, and of the calibration spots (16 and 32 units)
+SINGLE_MNG_INTENSITY = 700.0
+
+CONFIG_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.template.json")
+
+
+def make_mask(height, width, n_cells, rng):
+    """
+    Cellpose-style label mask: n_cells non-overlapping elliptical cells labeled 1..N (consecutive), background 0.
+
+    Returns:
+        np.ndarray: (height, width) uint16 mask.
+    """
+    mask = np.zeros((height, width), dtype=np.uint16)
+    # radius of the cells, so that they cover about a third of the frame
+    radius = max(3.0, np.sqrt(height * width / (3 * np.pi * n_cells)))
+    rows, cols = np.ogrid[:height, :width]
+    for label in range(1, n_cells + 1):
+        cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+        ry, rx = radius * rng.uniform(0.6, 1.4, size=2)
+        theta = rng.uniform(0, np.pi)
+        y0, y1 = int(max(cy - 1.5 * radius, 0)), int(min(cy + 1.5 * radius + 1, height))
+        x0, x1 = int(max(cx - 1.5 * radius, 0)), int(min(cx + 1.5 * radius + 1, width))
+        dy, dx = rows[y0:y1] - cy, cols[:, x0:x1] - cx
+        u = dy * np.cos(theta) + dx * np.sin(theta)
+        v = -dy * np.sin(theta) + dx * np.cos(theta)
+        box = mask[y0:y1, x0:x1]
+        # the cells do not overwrite the ones drawn before (touching cells, as in the Cellpose masks)
+        box[((u / ry) ** 2 + (v / rx) ** 2 <= 1) & (box == 0)] = label
+
+    # consecutive labels, without the cells hidden by the ones drawn before
+    _, consecutive = np.unique(mask, return_inverse=True)
+    if not (mask == 0).any():
+        consecutive += 1
+    return consecutive.reshape(height, width).astype(np.uint16)
+
+
+def make_dual_view_stack(mask, n_slices, rng, background=100.0, noise=5.0):
+    """
+    Dual-view Z-stack of the cells of a mask: the left half is the RFP channel (autofluorescence) and the right half
+    the GFP channel. Each cell has a random brightness and a Gaussian intensity profile along Z around its focal slice.
+
+    Returns:
+        np.ndarray: (n_slices, height, 2 * width) uint16 stack.
+    """
+    height, width = mask.shape
+    n_cells = int(mask.max())
+    copy_numbers = rng.lognormal(np.log(200), 0.5, size=n_cells + 1)
+    areas = np.maximum(np.bincount(mask.ravel(), minlength=n_cells + 1), 1)
+    # per-pixel brightness of the focal slice, background 0
+    brightness = copy_numbers * SINGLE_MNG_INTENSITY / areas
+    brightness[0] = 0
+    focal = rng.normal(n_slices / 2, n_slices / 10, size=n_cells + 1)
+    pixel_brightness, pixel_focal = brightness[mask], focal[mask]
+    depth = max(n_slices / 8, 1.0)
+
+    stack = np.empty((n_slices, height, 2 * width), dtype=np.uint16)
+    for z in range(n_slices):
+        profile = np.exp(-0.5 * ((z - pixel_focal) / depth) ** 2)
+        GFP = background + pixel_brightness * profile + rng.normal(0, noise, size=mask.shape)
+        RFP = background + 0.05 * pixel_brightness * profile + rng.normal(0, noise, size=mask.shape)
+        stack[z, :, :width] = np.clip(RFP, 0, 65535)
+        stack[z, :, width:] = np.clip(GFP, 0, 65535)
+    return stack
+
+
+def make_spot_table(n_spots, rng, column_name="Intens", outlier_fraction=0.01):
+    """
+    Spot table of the single mNG calibration: integrated intensities of 16 and 32 units of mNG (log-normal
+    spread), with a fraction of dim and bright outliers removed by the cleaning.
+
+    Returns:
+        pd.DataFrame: one row per spot with the intensity column.
+    """
+    n_outliers = int(n_spots * outlier_fraction)
+    n_32 = int((n_spots - n_outliers) * 0.3)
+    n_16 = n_spots - n_outliers - n_32
+    intensities = np.concatenate([
+        rng.lognormal(np.log(16 * SINGLE_MNG_INTENSITY), 0.15, size=n_16),
+        rng.lognormal(np.log(32 * SINGLE_MNG_INTENSITY), 0.15, size=n_32),
+        rng.lognormal(np.log(16 * SINGLE_MNG_INTENSITY), 3.0, size=n_outliers),
+    ])
+    rng.shuffle(intensities)
+    return pd.DataFrame({column_name: intensities})
+
+
+def make_fov(size, rng):
+    """
+    Synthetic field of view of a size: (raw dual-view stack, mask).
+    """
+    params = SIZES[size]
+    mask = make_mask(params["height"], params["width"], params["n_cells"], rng)
+    return make_dual_view_stack(mask, params["n_slices"], rng), mask
+
+
+def write_dataset(root, size="small", seed=0):
+    """
+    Writes a synthetic dataset: raw stacks, masks, spot tables and a config.json pointing to them, so the pipeline
+    can be run end to end on it (the GFP and RFP stacks are written by the preprocessing, or use --from-raw).
+
+    Returns:
+        str: path of the config file.
+    """
+    import tifffile
+    import imageio.v2 as imageio
+
+    params = SIZES[size]
+    rng = np.random.default_rng(seed)
+    with open(CONFIG_TEMPLATE, "r") as f:
+        config = json.load(f)
+
+    Path_settings = config["Path_settings"]
+    for key, name in (("input_dir", "raw"), ("GFP_dir", "GFP"), ("RFP_dir", "RFP"), ("projected_dir", "projected"),
+                      ("mask_dir", "mask"), ("output_dir", "output")):
+        Path_settings[key] = os.path.join(os.path.abspath(root), name)
+        os.makedirs(Path_settings[key], exist_ok=True)
+
+    for i in range(params["n_fovs"]):
+        raw, mask = make_fov(size, rng)
+        file_name = f"synthetic_{i:03d}.TIF"
+        tifffile.imwrite(os.path.join(Path_settings["input_dir"], file_name), raw)
+        imageio.imwrite(os.path.join(Path_settings["mask_dir"], file_name.replace(".TIF", Path_settings["mask_suffix"])), mask)
+
+    calibration = config["get_single_mNG_intensity"]
+    calibration["data_path"] = os.path.join(os.path.abspath(root), "spots")
+    calibration["output_dir"] = os.path.join(os.path.abspath(root), "spots_result")
+    calibration["integrated_intensity_analysis"] = False
+    os.makedirs(calibration["data_path"], exist_ok=True)
+    spots = make_spot_table(params["n_spots"], rng, calibration["column_name"])
+    bounds = np.linspace(0, len(spots), params["n_fovs"] + 1).astype(int)
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        spots.iloc[start:stop].to_csv(os.path.join(calibration["data_path"], f"spots_{i:03d}.csv"), index=False)
+
+    config["Analysis_settings"]["single_mNG_intensity"] = SINGLE_MNG_INTENSITY
+    config_path = os.path.join(root, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+    return config_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes a seeded synthetic dataset for the pipeline.")
+    parser.add_argument("root", help="directory of the dataset.")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    print(write_dataset(args.root, args.size, args.seed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,169 +1,366 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import logging
-import pandas as pd
 import os
+from cells import COLUMNS, OPTIONAL_COLUMNS, CellStack, CellTable, cell_stacks
+from mask_index import as_mask_index
+from load_data import close_stacks, iter_z_chunks
+from report import save_fov_profiles
+from stats import update_fov_stats
+import profiling
+from log_setup import cell_logger
 
-#logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
 
-
-def segment_stacks(image_stacks, masks):
+def segment_stacks(image_stacks, masks, compact=False):
     """"
     Segments the GFP and RFP stacks using the corresponding masks.
 
     Parameters:
     - image_stacks (dict): dictionary with the file names as keys and dicts of 'GFP' and 'RFP' stacks as values.
-    - masks(dict):dictionary with the file names as keys and segmentation masks as values.
+    - masks(dict):dictionary with the file names as keys and segmentation masks (label images or MaskIndex) as values.
+    - compact (bool): if True, each cell is stored as a CellStack holding views of the stacks cropped to the 
+    cell bounding box and the cropped mask, instead of full-frame masked copies of the stacks.
     
     Returns:
-    - sgmented_data (dict): dictionary storing the segmented GFP and RFP stacks for each file and cell ID.
+    - sgmented_data (dict): dictionary storing the segmented GFP and RFP stacks (or CellStack) for each file and cell ID.
     
     """
 
     segmented_data = {}
+    # per-cell records only when asked for in the Logging_settings (see log_setup.py)
+    log_cells = cell_logger.isEnabledFor(logging.DEBUG)
 
     for file_name, channels in image_stacks.items():
         if file_name in masks:
-            mask = masks[file_name]
-            unique_cell_ids = np.unique(mask)
-            unique_cell_ids = unique_cell_ids[unique_cell_ids != 0] # Exclude background
-            unique_cell_ids = [int(cell_id) for cell_id in unique_cell_ids]  # Convert to native int
+            # labels and pixels of the cells, from the mask index (built here for a label image)
+            mask = as_mask_index(masks[file_name])
+            unique_cell_ids = mask.cell_ids.tolist()  # background excluded, native ints
             if len(unique_cell_ids)==0:
-                logging.warning(f'{file_name} does not contain any cell')
+                logging.warning('%s does not contain any cell', file_name)
+                continue
+
+            if compact:
+                segmented_data[file_name] = cell_stacks(channels, mask)
+                logging.info('sucsussfuly segmented %s cells in the %s', len(unique_cell_ids), file_name)
                 continue
 
             segmented_data[file_name] = {}
 
-            for cell_id in unique_cell_ids:
+            for i, cell_id in enumerate(unique_cell_ids):
 
-                binary_mask = (mask == cell_id).astype(np.uint8)
+                binary_mask = mask.binary_mask(i)
 
                 segmented_GFP_stack = np.array([image * binary_mask for image in channels['GFP']])
                 segmented_RFP_stack = np.array([image * binary_mask for image in channels['RFP']])
 
                 segmented_data[file_name][cell_id] = {'GFP': segmented_GFP_stack, 'RFP': segmented_RFP_stack}
                 
-                logging.info(f'sucsussfuly segmented the cell {cell_id} in the {file_name}')
+                if log_cells:
+                    cell_logger.debug('sucsussfuly segmented the cell %s in the %s', cell_id, file_name)
+            logging.info('sucsussfuly segmented %s cells in the %s', len(unique_cell_ids), file_name)
         else: 
-            logging.warning(f'mask was not found for {file_name} file')
+            logging.warning('mask was not found for %s file', file_name)
     
     return segmented_data
 
+def label_index(mask):
+    """
+    Indexes the labelled cells of a segmentation mask.
+
+    Parameters:
+    - mask (np.ndarray or MaskIndex): segmentation mask, background is 0 and each cell has a unique label, 
+    or its index (see mask_index.py), which is used without scanning the label image.
+
+    Returns:
+    - cell_ids (list): sorted cell IDs (background excluded) as native ints.
+    - coords (tuple): (rows, cols) pixel coordinates of the foreground pixels, grouped by cell.
+    - labels (np.ndarray): position in cell_ids of the cell each foreground pixel belongs to.
+    """
+    index = as_mask_index(mask)
+    return index.cell_ids.tolist(), index.coords(), index.labels()
+
+
+def slice_intensity_sums(stack, coords, labels, n_cells):
+    """
+    Computes the sum of pixel intensities of every cell in every slice of a stack.
+
+    Each slice is reduced in a single labelled sum (bincount) over the foreground pixels, 
+    instead of masking the full frame once per cell.
+
+    Parameters:
+    - stack (np.ndarray): Z x H x W image stack.
+    - coords, labels: foreground pixel index of the mask, as returned by label_index.
+    - n_cells (int): number of cells in the mask.
+
+    Returns:
+    - sums (np.ndarray): (n_cells, Z) matrix of per-slice intensity sums. Integer stacks are summed exactly into int64.
+    """
+    sums = np.empty((n_cells, len(stack)), dtype=np.float64)
+    for z, image in enumerate(stack):
+        sums[:, z] = np.bincount(labels, weights=image[coords], minlength=n_cells)
+
+    if np.issubdtype(stack.dtype, np.integer):
+        sums = sums.astype(np.int64)
+
+    return sums
+
+
+def reduce_fov(channels, mask, z_chunk_size=None):
+    """
+    Reduces the GFP and RFP stacks of one field of view to the per-slice intensity sums of each cell.
+
+    Parameters:
+    - channels (dict): {'GFP': GFP_stack, 'RFP': RFP_stack}
+    - mask (np.ndarray or MaskIndex): segmentation mask of the field of view.
+    - z_chunk_size (int): if set, the stacks are read z_chunk_size slices at a time (see reduce_fov_chunked).
+
+    Returns:
+    - cell_ids (list): cell IDs, in the order of the rows of the sums.
+    - GFP_sums, RFP_sums (np.ndarray): (n_cells, Z) matrices of per-slice intensity sums.
+    """
+    if z_chunk_size:
+        return reduce_fov_chunked(channels, mask, z_chunk_size)
+    cell_ids, coords, labels = label_index(mask)
+    GFP_sums = slice_intensity_sums(channels['GFP'], coords, labels, len(cell_ids))
+    RFP_sums = slice_intensity_sums(channels['RFP'], coords, labels, len(cell_ids))
+
+    return cell_ids, GFP_sums, RFP_sums
+
+
+def reduce_fov_chunked(channels, mask, z_chunk_size):
+    """
+    Out-of-core version of reduce_fov, for the stacks larger than the memory: reads the GFP and RFP stacks 
+    z_chunk_size slices at a time (see load_data.iter_z_chunks) and fills the per-slice sums of the cells chunk 
+    by chunk, so only one chunk of each stack is held in memory (with stacks opened lazily). The sums are the same 
+    as reduce_fov.
+
+    Parameters:
+    - channels (dict): {'GFP': GFP_stack, 'RFP': RFP_stack}, e.g. memory-mapped stacks or LazyStack.
+    - mask (np.ndarray or MaskIndex): segmentation mask of the field of view.
+    - z_chunk_size (int): number of slices read at a time.
+
+    Returns:
+    - same as reduce_fov.
+    """
+    cell_ids, coords, labels = label_index(mask)
+    sums = {channel: np.empty((len(cell_ids), len(channels[channel])),
+                              dtype=np.int64 if np.issubdtype(channels[channel].dtype, np.integer) else np.float64)
+            for channel in ('GFP', 'RFP')}
+    if len(cell_ids)==0:
+        return cell_ids, sums['GFP'], sums['RFP']
+
+    for start, GFP_chunk, RFP_chunk in iter_z_chunks(channels, z_chunk_size):
+        stop = start + len(GFP_chunk)
+        sums['GFP'][:, start:stop] = slice_intensity_sums(GFP_chunk, coords, labels, len(cell_ids))
+        sums['RFP'][:, start:stop] = slice_intensity_sums(RFP_chunk, coords, labels, len(cell_ids))
+
+    return cell_ids, sums['GFP'], sums['RFP']
+
+
+def cell_slice_sums(cells, channel):
+    """
+    Per-slice intensity sums of one channel of the segmented cells of a field of view.
+
+    Args:
+        cells (dict): {cell_id: {'GFP': array, 'RFP': array}} or {cell_id: CellStack}, from segment_stacks.
+        channel (str): 'GFP' or 'RFP'.
+
+    Returns:
+        np.ndarray: (n_cells, Z) matrix, in the order of the cells.
+    """
+    return np.array([channels.slice_sums(channel) if isinstance(channels, CellStack)
+                     else np.sum(channels[channel], axis=(1, 2)) for channels in cells.values()])
+
+
+def plot_cell_intensity_profile(intensity_sums, threshold_intensity, focal_plane, cell_id, file_name):
+    """
+    Plots the intensity profile (sum of intensities per slice) of a cell with its threshold and focal slice.
+    """
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 6))
+    plt.plot(intensity_sums, label='Intensity Profile')
+    plt.axhline(y=threshold_intensity, color='r', linestyle='--', label='Threshold Intensity')
+    plt.axvline(x=focal_plane, color='g', linestyle='--', label='Focal Slice')
+    plt.xticks(ticks=np.arange(len(intensity_sums)), labels=np.arange(len(intensity_sums)))
+    plt.title(f"Intensity Profile for Cell {cell_id} in {file_name}")
+    plt.xlabel('Slice Number')
+    plt.ylabel('Sum of Intensities')
+    plt.legend()
+    plt.show()
+
+
+def find_active_slices_batch(GFP_sums, active_slice_settings):
+    """
+    Batched version of find_active_slices: finds the focal slice, threshold and active slices of all the cells 
+    of a field of view at once, from the matrix of per-slice GFP intensity sums.
+
+    Args:
+        GFP_sums (np.ndarray): (n_cells, Z) per-slice GFP intensity sums, e.g. from reduce_fov.
+        active_slice_settings: configuration for the drop intensity threishold
+
+    Returns:
+        dict: {'focal slice': (n_cells,) int array, 'focal intensity': (n_cells,) float array, 
+        'threshold intensity': (n_cells,) float array, 'active': (n_cells, Z) boolean matrix of the active slices}
+    """
+    drop_threshold = active_slice_settings["drop_threshold"]
+
+    # Identify focal slice (slice with max intensity) of each cell
+    focal_planes = np.argmax(GFP_sums, axis=1)
+    focal_intensities = GFP_sums[np.arange(len(GFP_sums)), focal_planes].astype(np.float64)
+
+    # Define threshold intensity and identify the active slices
+    threshold_intensities = focal_intensities * (1 - drop_threshold / 100)
+    active = GFP_sums >= threshold_intensities[:, None]
+
+    return {'focal slice': focal_planes, 'focal intensity': focal_intensities,
+            'threshold intensity': threshold_intensities, 'active': active}
+
+
+def cell_intensity_batch(GFP_sums, RFP_sums, active, analysis_settings):
+    """
+    Batched version of cell_intensity: total intensities over the active slices, autofluorescence correction 
+    and copy numbers of all the cells of a field of view, as masked reductions of the per-slice sums.
+
+    Args:
+        GFP_sums, RFP_sums (np.ndarray): (n_cells, Z) per-slice intensity sums.
+        active (np.ndarray): (n_cells, Z) boolean matrix of the active slices, from find_active_slices_batch.
+        analysis_settings (config dict): rg, ra and single_mNG_intensity, see cell_intensity.
+
+    Returns:
+        dict: {'total_intensity', 'total_background', 'total_intensity_normal', 'copy_number'}, (n_cells,) arrays,
+        and the copy number interval ('copy_number_ci_low', 'copy_number_ci_high') if single_mNG_intensity_ci is set.
+    """
+    ra = analysis_settings["ra"]
+    rg = analysis_settings["rg"]
+    single_mNG_intensity = analysis_settings["single_mNG_intensity"]
+
+    gfp_total_intensity = np.where(active, GFP_sums, 0).sum(axis=1)
+    rfp_total_intensity = np.where(active, RFP_sums, 0).sum(axis=1)
+
+    total_intensity_normal = (rg * gfp_total_intensity - ra * rg * rfp_total_intensity) / (rg - ra)
+    copy_number = total_intensity_normal / single_mNG_intensity
+
+    intensities = {'total_intensity': gfp_total_intensity, 'total_background': rfp_total_intensity,
+                   'total_intensity_normal': total_intensity_normal, 'copy_number': copy_number}
+    intensities.update(copy_number_interval(total_intensity_normal, analysis_settings))
+    return intensities
+
+
+def copy_number_interval(total_intensity_normal, analysis_settings):
+    """
+    Copy number interval of the cells, from the confidence interval of the single mNG intensity 
+    (single_mNG_intensity_ci in the Analysis_settings, from the bootstrap of the calibration).
+
+    Returns:
+        dict: {'copy_number_ci_low', 'copy_number_ci_high'}, empty if no interval is configured.
+    """
+    single_mNG_intensity_ci = analysis_settings.get("single_mNG_intensity_ci")
+    if not single_mNG_intensity_ci:
+        return {}
+    ci_low, ci_high = single_mNG_intensity_ci
+    bounds = (np.asarray(total_intensity_normal, dtype=np.float64) / ci_high,
+              np.asarray(total_intensity_normal, dtype=np.float64) / ci_low)
+    return {'copy_number_ci_low': np.minimum(*bounds), 'copy_number_ci_high': np.maximum(*bounds)}
+
+
 def find_active_slices(segmented_data, active_slice_settings):
     """
     Finds active slices for each cell based on intensity drop in the GFP channel.
+    Wrapper of find_active_slices_batch for the nested output of segment_stacks.
 
     Args:
-        segmented_data (dict): Dictionary containing {file_name: {cell_id: {'GFP': array, 'RFP': array}}}
+        segmented_data (dict): Dictionary containing {file_name: {cell_id: {'GFP': array, 'RFP': array}}} or CellStack cells.
         active_slice_settings: configuration for the drop intensity threishold
 
     Returns:
         dict: Dictionary with {file_name: {cell_id: {'Focal Slice': int, 'Focal Intensity': float, 
         'Threshold Intensity': float, 'Active Slices': list}}}
     """
-    drop_threshold = active_slice_settings["drop_threshold"]
     plot_intensity_profile = active_slice_settings["plot_intensity_profile"] # wether plot the intensity profile of each cell or not
 
-
     active_slices_dict = {}
+    log_cells = cell_logger.isEnabledFor(logging.DEBUG)
 
     for file_name, cells in segmented_data.items():
         active_slices_dict[file_name] = {}
 
         for cell_id, channels in cells.items():
-
             if not 'GFP' in channels:
-                logging.warning(f'Skipping cell {cell_id} in the file {file_name}: No GFP file found.')
-
-            # extracting GFP stack for the current cell
-            GFP_stack = channels['GFP'] 
-
-            # Compute sum of pixel intensities for each slice
-            intensity_sums = [np.sum(image) for image in GFP_stack] 
-
-            # Identify focal slice (slice with max intensity)
-            focal_plane = int(np.argmax(intensity_sums))
-            focal_intensity = float(intensity_sums[focal_plane])
-
-            # Define threshold intensity
-            threshold_intensity = focal_intensity * (1 - drop_threshold / 100)
-
-            # Identify active slices
-            active_slices = [i for i, intensity in enumerate(intensity_sums) if intensity >= threshold_intensity]
-
-            #store the results
-            active_slices_dict[file_name][cell_id] = { 'focal slice': focal_plane, 'focal intensity': focal_intensity,'threshold intensity': threshold_intensity,'active slices': active_slices}
-
-            logging.info(f'Extracted the active slices for the cell {cell_id} in the file {file_name} Focal Slice={focal_plane}, Active Slices={active_slices}')
-                          
-            # Optional: Plot intensity profile
-            if plot_intensity_profile:
-                plt.figure(figsize=(10, 6))
-                plt.plot(intensity_sums, label='Intensity Profile')
-                plt.axhline(y=threshold_intensity, color='r', linestyle='--', label='Threshold Intensity')
-                plt.axvline(x=focal_plane, color='g', linestyle='--', label='Focal Slice')
-                plt.xticks(ticks=np.arange(len(intensity_sums)), labels=np.arange(len(intensity_sums)))
-                plt.title(f"Intensity Profile for Cell {cell_id} in {file_name}")
-                plt.xlabel('Slice Number')
-                plt.ylabel('Sum of Intensities')
-                plt.legend()
-                plt.show()
-            
-
-    logging.info(f' Sucsussfully extracted the active slices for all the cells. Proceeding with copy number calculation.')
+                logging.warning('Skipping cell %s in the file %s: No GFP file found.', cell_id, file_name)
+        cells = {cell_id: channels for cell_id, channels in cells.items() if 'GFP' in channels}
+
+        if cells:
+            # Sum of pixel intensities of the GFP stack for each slice of each cell
+            GFP_sums = cell_slice_sums(cells, 'GFP')
+            batch = find_active_slices_batch(GFP_sums, active_slice_settings)
+
+            for i, cell_id in enumerate(cells):
+                focal_plane = int(batch['focal slice'][i])
+                threshold_intensity = float(batch['threshold intensity'][i])
+                active_slices = np.flatnonzero(batch['active'][i]).tolist()
+
+                #store the results
+                active_slices_dict[file_name][cell_id] = {'focal slice': focal_plane, 'focal intensity': float(batch['focal intensity'][i]),
+                                                          'threshold intensity': threshold_intensity, 'active slices': active_slices}
+
+                if log_cells:
+                    cell_logger.debug('Extracted the active slices for the cell %s in the file %s Focal Slice=%s, Active Slices=%s', cell_id, file_name, focal_plane, active_slices)
+
+                # Optional: Plot intensity profile
+                if plot_intensity_profile:
+                    plot_cell_intensity_profile(GFP_sums[i], threshold_intensity, focal_plane, cell_id, file_name)
+
+        logging.info('Extracted the active slices for %s cells in the file %s', len(active_slices_dict[file_name]), file_name)
+
+    logging.info(' Sucsussfully extracted the active slices for all the cells. Proceeding with copy number calculation.')
     return active_slices_dict
 
 def cell_intensity(segmented_data, active_slices_dict, analysis_settings):
     """
     Computes total cell intensity, which is normalized for cell autofourescent. 
+    Wrapper of cell_intensity_batch for the nested outputs of segment_stacks and find_active_slices.
 
     Args:
-        - segmented_data (dict): Dictionary containing {file_name: {cell_id: {'GFP': array, 'RFP': array}}}
+        - segmented_data (dict): Dictionary containing {file_name: {cell_id: {'GFP': array, 'RFP': array}}} or CellStack cells.
         - active_slices_dict (dict):Dictionary with {file_name: {cell_id: {'Focal Slice': int, 'Focal Intensity': float, 
         'Threshold Intensity': float, 'Active Slices': list}}}
         - analysis_settings (config dict):
         rg (float): GFP scaling factor for autofluorescence correction.
         ra (float): RFP scaling factor for autofluorescence correction.
         single_mNG_intensity (float): Intensity of a single mNeonGreen molecule for copy number estimation.
+        single_mNG_intensity_ci (list, optional): [low, high] confidence interval of single_mNG_intensity, adds the copy number interval.
 
     Returns:
         processed_data (dict): Processed data containing calculated intensities and copy numbers for each cell in each file.
     """
-    ra = analysis_settings["ra"]
-    rg = analysis_settings["rg"]
-    single_mNG_intensity = analysis_settings["single_mNG_intensity"]
-
     processed_intensity_data = {}
-
+    log_cells = cell_logger.isEnabledFor(logging.DEBUG)
 
     for file_name, cells in segmented_data.items():
-        
-       processed_intensity_data[file_name] = {}
+        processed_intensity_data[file_name] = {}
+        if not cells:
+            continue
 
-       for cell_id, channels in cells.items():
-           
-           # Extract the GFP and RFP stacks
-           gfp_stack = channels['GFP']
-           rfp_stack = channels['RFP']
-
-           # Get the active slices from active_slices_data
-           active_slices = active_slices_dict.get(file_name, {}).get(cell_id, {}).get('active slices', [])
-           # Calculate total intensity of the cell in each channel
-           gfp_total_intensity = sum(np.sum(gfp_stack[i]) for i in active_slices)
-           rfp_total_intensity = sum(np.sum(rfp_stack[i]) for i in active_slices)
-
-           # calculate the normalized intensity
-           total_intensity_normal = (rg * gfp_total_intensity - ra * rg * rfp_total_intensity) / (rg - ra)
-           copy_number = total_intensity_normal / single_mNG_intensity
-
-           processed_intensity_data[file_name][cell_id] = {'total_intensity': gfp_total_intensity,
-                'total_background': rfp_total_intensity,
-                'total_intensity_normal': total_intensity_normal,
-                'copy_number': copy_number}
-           logging.info(f'Calculated the copy number for the cell {cell_id} in the file {file_name}')
+        # Extract the per-slice intensity sums of the GFP and RFP stacks
+        GFP_sums = cell_slice_sums(cells, 'GFP')
+        RFP_sums = cell_slice_sums(cells, 'RFP')
+
+        # Get the active slices from active_slices_data, none for the cells without active slices
+        active = np.zeros(GFP_sums.shape, dtype=bool)
+        file_active_slices = active_slices_dict.get(file_name, {})
+        for i, cell_id in enumerate(cells):
+            active[i, file_active_slices.get(cell_id, {}).get('active slices', [])] = True
+
+        intensities = cell_intensity_batch(GFP_sums, RFP_sums, active, analysis_settings)
+
+        for i, cell_id in enumerate(cells):
+            processed_intensity_data[file_name][cell_id] = {column: values[i] for column, values in intensities.items()}
+            if log_cells:
+                cell_logger.debug('Calculated the copy number for the cell %s in the file %s', cell_id, file_name)
+
+        logging.info('Calculated the copy number for %s cells in the file %s', len(processed_intensity_data[file_name]), file_name)
            
-    logging.info(f'Copy number calculation was done.')
+    logging.info('Copy number calculation was done.')
     return processed_intensity_data
 
 def save_processed_data(active_slices_dict, processed_intensity_data, output_path):
@@ -191,107 +388,221 @@ def save_processed_data(active_slices_dict, processed_intensity_data, output_pat
 
     
     """
-    # Initialize a list to store flattened rows
-    flattened_data = []
-
     logging.info("Saving data.")
 
+    # one CellTable per file, as built by process_fov, the missing intensity values are NaN
+    tables = []
     for file_name, cells in active_slices_dict.items():
-        for cell_id, active_slice_info in cells.items():
-            # Retrieve intensity data
-            intensity_values = processed_intensity_data.get(file_name, {}).get(cell_id, {})
-
-            logging.debug(f"Processing cell {cell_id} in file {file_name} - Active Slice Info: {active_slice_info}")
-            logging.debug(f"Processing cell {cell_id} in file {file_name} - Intensity Values: {intensity_values}")
-
-            # Merge active slice info and intensity data
-            row = {
-                'File Name': file_name,
-                'Cell ID': cell_id,
-                'Focal Slice': active_slice_info.get('focal slice', None),
-                'Focal Intensity': active_slice_info.get('focal intensity', None),
-                'Threshold Intensity': active_slice_info.get('threshold intensity', None),
-                'Active Slices': ', '.join(map(str, active_slice_info.get('active slices', []))),
-                'Total Intensity': intensity_values.get('total_intensity', None),
-                'Total Background': intensity_values.get('total_background', None),
-                'Total Intensity Normal': intensity_values.get('total_intensity_normal', None),
-                'Copy Number': intensity_values.get('copy_number', None)
-            }
-            logging.debug(f"Row data for cell {cell_id} in file {file_name}: {row}")
-            flattened_data.append(row)
-    # convert to dataframe
-    df = pd.DataFrame(flattened_data)
-    logging.info("Data successfully flattened into DataFrame.")
+        intensity_values = [processed_intensity_data.get(file_name, {}).get(cell_id, {}) for cell_id in cells]
+        active_lists = [active_slice_info.get('active slices', []) for active_slice_info in cells.values()]
+        active = np.zeros((len(cells), max((max(slices) + 1 for slices in active_lists if len(slices)), default=0)), dtype=bool)
+        for i, slices in enumerate(active_lists):
+            active[i, slices] = True
+
+        active_slices = {key: np.array([active_slice_info.get(key, np.nan) for active_slice_info in cells.values()])
+                         for key in ('focal slice', 'focal intensity', 'threshold intensity')}
+        active_slices['active'] = active
+        intensities = {}
+        for column, _ in COLUMNS[4:]:
+            values = np.array([values.get(column, np.nan) for values in intensity_values])
+            if column not in OPTIONAL_COLUMNS or not np.isnan(values.astype(np.float64)).all():
+                intensities[column] = values
+        tables.append(CellTable.from_fov(file_name, list(cells), active_slices, intensities))
+
+    table = CellTable.concat(tables)
+    log_cell_rows(table)
+
+    return write_processed_data(table, output_path)
+
+def write_processed_data(table, output_path):
+    """
+    Saves the processed data (CellTable of the cells) into a csv file, in one bulk write.
+
+    Return:
+        df (pandas dataframe): the saved data.
+    """
+    # convert to dataframe, the numeric columns are not copied
+    df = table.to_pandas()
+    logging.info("Data successfully converted into DataFrame.")
 
     # save as a CSV file
     try: 
-        df.to_csv(output_path,index=False)
-        logging.info(f"Successfully saved the processed data to {output_path}.")
+        with profiling.stage("write_csv") as span:
+            df.to_csv(output_path,index=False)
+            span["cells"] = len(df)
+        logging.info("Successfully saved the processed data to %s.", output_path)
     except Exception as e:
-        logging.error(f"Error while saving CSV file: {e}")
+        logging.error("Error while saving CSV file: %s", e)
         raise
 
     return df
 
-def processing(image_stacks, masks, config):
+def append_processed_data(table, output_path, header):
+    """
+    Appends the cells of one field of view to the processed data csv file.
+
+    Args:
+        table (CellTable): cells returned by process_fov.
+        output_path (str): path of the csv file.
+        header (bool): write the column names (for the first rows of the file).
+    """
+    try:
+        with profiling.stage("write_csv", table.file_names[0] if len(table) else None) as span:
+            table.to_pandas().to_csv(output_path, mode='a', header=header, index=False)
+            span["cells"] = len(table)
+        logging.info("Appended %s cells to %s.", len(table), output_path)
+    except Exception as e:
+        logging.error("Error while saving CSV file: %s", e)
+        raise
+
+def processing(image_stacks, masks, config, fov_stats=None, report=None):
     """
-    1. Segments the GFP and RFP stacks using the corresponding masks.
+    For each field of view:
+    1. Reduces the GFP and RFP stacks to per-slice intensity sums of each cell using the corresponding masks.
     2. Finds focal plane and the active slices for each cell.
     3. Calculates the total intensity for each cell and corrects the autoflourescent background.
     4. Calculates the copy numebr for each cell.
+    Then saves the results of all the cells into the output csv file.
 
     Parameters:
     - image_stacks (dict): dictionary with the file names as keys and dicts of 'GFP' and 'RFP' stacks as values.
     - masks(dict):dictionary with the file names as keys and segmentation masks as values.
+    - fov_stats (GroupedStats): optional mergeable statistics, updated with the copy numbers of each field of view.
+    - report (ProfileReport): optional intensity profile report, each field of view is added once analysed.
 
     retunrs: 
-    final_processed_data (dict): for each file and each cell inside the file: Focal Slice, Focal Intensity, Threshold Intensity, Active Slices
-    total_intensity, total_background, total_intensity_normal, copy_number
+    table (CellTable): the saved cells, for each file and each cell inside the file: Focal Slice, Focal Intensity, 
+    Threshold Intensity, Active Slices, total_intensity, total_background, total_intensity_normal, copy_number
+    (converted with to_pandas or to_arrow by the next stages).
 
     """
     Path_settings = config["Path_settings"]
     output_path = os.path.join(Path_settings["output_dir"],Path_settings["output_name"])
-    active_slice_settings = config["active_slice_settings"]
-    analysis_settings = config["Analysis_settings"]
-    
     
-    # 1. segmenting the GFP and RFP stacks for each file and cell ID
-    segmented_data = segment_stacks(image_stacks, masks)
-    if not segmented_data:
+    # 1-4. reducing the stacks, finding the active slices and calculating the copy number of the cells of each file
+    tables = []
+    for file_name, channels in image_stacks.items():
+        if file_name not in masks:
+            logging.warning('mask was not found for %s file', file_name)
+            continue
+        table = process_fov(file_name, channels, masks[file_name], config)
+        if not len(table):
+            continue
+        update_fov_stats(fov_stats, file_name, table['copy_number'], Path_settings)
+        if report is not None:
+            report.add(file_name)
+        tables.append(table)
+
+    table = CellTable.concat(tables)
+    if not len(table):
         logging.error("No cells were segmented. Aborting processing.")
         raise ValueError("Segmentation resulted in an empty dataset.")
 
-    # 2. finding the active slices for each cell
-    active_slices_dict = find_active_slices(segmented_data, active_slice_settings)
-    if not any(active_slices_dict[file] for file in active_slices_dict):
-        logging.error("No active slices found for any cells. Aborting processing.")
-        raise ValueError("Active slice extraction failed.")
-
-    # 3. Calculating the copy number for each cell
-    processed_intensity_data = cell_intensity(segmented_data, active_slices_dict, analysis_settings)
-    if not any(processed_intensity_data[file] for file in processed_intensity_data):
-        logging.error("No intensity data calculated. Aborting processing.")
-        raise ValueError("Intensity calculation resulted in no data.")
-
-    # 4. Merging the all the extracted information and saving it to csv file
-    final_processed_data = save_processed_data(active_slices_dict, processed_intensity_data, output_path)
-    if final_processed_data.empty:
-        logging.error("Merging completed, but final dataset is empty.")
-        raise ValueError("Empty saved csv file.")
-    
-    return final_processed_data
-           
+    # Saving the all the extracted information to csv file
+    write_processed_data(table, output_path)
 
+    return table
 
 
+def process_fov(file_name, channels, mask, config):
+    """
+    Runs the analysis (steps 1 to 4 of processing) on a single field of view, with the batched functions
+    operating on the (n_cells, Z) matrices of per-slice intensity sums.
 
+    Parameters:
+    - file_name (str): name of the raw file of the field of view.
+    - channels (dict): {'GFP': GFP_stack, 'RFP': RFP_stack}
+    - mask (np.ndarray or MaskIndex): segmentation mask of the field of view.
+    - config (dict): full configuration.
 
+    Returns:
+    table (CellTable): the cells of the field of view. Empty if the field of view has no cell.
+    """
+    # the spans of the stages are recorded when the profiling is enabled (see profiling.py)
+    with profiling.stage("reduce_fov", file_name) as span:
+        cell_ids, GFP_sums, RFP_sums = reduce_fov(channels, mask, config.get("Execution_settings", {}).get("z_chunk_size"))
+        span["cells"] = len(cell_ids)
+    if len(cell_ids)==0:
+        logging.warning('%s does not contain any cell', file_name)
+        return CellTable.empty()
 
+    active_slice_settings = config["active_slice_settings"]
+    with profiling.stage("find_active_slices", file_name) as span:
+        active_slices = find_active_slices_batch(GFP_sums, active_slice_settings)
+        span["cells"] = len(cell_ids)
 
+    # Optional: save the intensity profiles, plotted by the report stage (report.py) after the analysis
+    if active_slice_settings["plot_intensity_profile"]:
+        with profiling.stage("save_profiles", file_name):
+            save_fov_profiles(config["Path_settings"]["output_dir"], file_name, cell_ids, GFP_sums, active_slices)
 
+    with profiling.stage("cell_intensity", file_name) as span:
+        intensities = cell_intensity_batch(GFP_sums, RFP_sums, active_slices['active'], config["Analysis_settings"])
+        span["cells"] = len(cell_ids)
 
+    table = CellTable.from_fov(file_name, cell_ids, active_slices, intensities)
+    log_fov_summary(file_name, table, active_slices['active'])
+    log_cell_rows(table)
+    return table
 
+def log_fov_summary(file_name, table, active):
+    """
+    Logs one summary event per field of view: number of cells, median number of active slices and median copy number,
+    as JSON fields of the "fov_summary" event.
+    """
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        copy_number = float(np.median(table['copy_number']))
+        logging.info('Calculated the copy number for %s cells in the file %s (median copy number %.1f)',
+                     len(table), file_name, copy_number,
+                     extra={"event": "fov_summary", "fov": file_name, "cells": len(table),
+                            "median_active_slices": float(np.median(active.sum(axis=1))), "median_copy_number": copy_number})
+
+def log_cell_rows(table):
+    """
+    Logs the row of each cell of a CellTable, only when the per-cell records are enabled.
+    """
+    if cell_logger.isEnabledFor(logging.DEBUG):
+        for row in table.rows():
+            cell_logger.debug("Row data for cell %s in file %s: %s", row['Cell ID'], row['File Name'], row,
+                              extra={"event": "cell", "fov": row['File Name'], "cell_id": row['Cell ID']})
+
+def processing_stream(fovs, config, fov_stats=None, report=None):
+    """
+    Streaming version of processing: analyses one field of view at a time and appends its rows to the output
+    csv file as soon as they are produced, so only one field of view is held in memory.
 
+    Parameters:
+    - fovs (iterable): yields (file_name, {'GFP': GFP_stack, 'RFP': RFP_stack}, mask) for each field of view.
+    - config (dict): full configuration.
+    - fov_stats (GroupedStats): optional mergeable statistics, updated with the copy numbers of each field of view.
+    - report (ProfileReport): optional intensity profile report, each field of view is added once analysed.
 
+    retunrs: 
+    table (CellTable): same as processing.
+    """
+    Path_settings = config["Path_settings"]
+    output_path = os.path.join(Path_settings["output_dir"],Path_settings["output_name"])
 
-    
\ No newline at end of file
+    # start from an empty output file, rows are appended per field of view
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    tables = []
+    for file_name, channels, mask in fovs:
+        try:
+            table = process_fov(file_name, channels, mask, config)
+        finally:
+            close_stacks(channels)
+        if not len(table):
+            continue
+        append_processed_data(table, output_path, header=not tables)
+        update_fov_stats(fov_stats, file_name, table['copy_number'], Path_settings)
+        if report is not None:
+            report.add(file_name)
+        tables.append(table)
+
+    if not tables:
+        logging.error("No cells were processed. Aborting processing.")
+        raise ValueError("Streaming resulted in an empty dataset.")
+
+    return CellTable.concat(tables)
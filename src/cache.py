@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from cells import CellTable
+from digest import file_digest
+
+# bump when the analysis changes the cached cells, to invalidate the old entries
+CACHE_VERSION = 2
+
+# suffix of the entries (CellTable archives), and of the entries of the previous versions (evicted with the others)
+ENTRY_SUFFIX = ".npz"
+ENTRY_SUFFIXES = (".npz", ".json")
+# suffix of the intensity profiles of an entry (see report.save_fov_profiles), when the profiles are plotted
+PROFILES_SUFFIX = ".profiles.npz"
+# suffix of the files being written (renamed once complete), left behind by the crashed workers
+TMP_SUFFIX = ".tmp"
+
+# config sections the results of a field of view depend on
+CACHED_SECTIONS = ("active_slice_settings", "Analysis_settings")
+
+
+class ResultCache:
+    """
+    Per field of view cache of the processed cells (CellTable of the field of view).
+
+    An entry is keyed by the content hash of the input files of the field of view (GFP and RFP stacks, or raw stack,
+    and mask) and of the config sections the analysis depends on, so only the fields of view whose inputs or settings
+    changed are processed again. The content hash of a file is only recomputed when its size or modification time changes.
+    The total size of the cache (entries and content hash memos) is capped, the least recently used files are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.digest_dir = os.path.join(cache_dir, "digests")
+        os.makedirs(self.digest_dir, exist_ok=True)
+        # the temporary files older than the run are left by crashed workers, see evict
+        self.started = time.time()
+
+    def file_digest(self, path):
+        """
+        Content hash of a file, reused from the previous runs while the size and modification time of the file are unchanged.
+        """
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        memo_path = os.path.join(self.digest_dir, hashlib.blake2b(path.encode(), digest_size=16).hexdigest() + ".json")
+        try:
+            with open(memo_path, "r") as f:
+                memo = json.load(f)
+            if memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+                # mark as recently used
+                os.utime(memo_path)
+                return memo["digest"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = file_digest(path)
+        self._write_json(memo_path, {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest})
+        return digest
+
+    def key(self, file_name, paths, config):
+        """
+        Cache key of a field of view.
+
+        Args:
+            file_name (str): name of the raw .TIF file (stored in the table).
+            paths (list): input files of the field of view.
+            config (dict): full configuration.
+        """
+        key = hashlib.blake2b(digest_size=20)
+        key.update(json.dumps({
+            "version": CACHE_VERSION,
+            "file_name": file_name,
+            "inputs": [self.file_digest(path) for path in paths],
+            "config": {section: config.get(section) for section in CACHED_SECTIONS},
+        }, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """
+        Returns the cached CellTable of a key, or None on a cache miss.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            table = CellTable.load(entry_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        # mark as recently used
+        os.utime(entry_path)
+        return table
+
+    def put(self, key, table, profiles_path=None):
+        """
+        Saves the CellTable of a key, and a copy of the intensity profiles saved for the report (profiles_path).
+        """
+        # write then rename, so that concurrent workers never read a partial file
+        entry_path = self._entry_path(key)
+        if profiles_path is not None:
+            self._copy(profiles_path, os.path.join(self.cache_dir, key + PROFILES_SUFFIX))
+        tmp_path = f"{entry_path}.{os.getpid()}{TMP_SUFFIX}"
+        table.save(tmp_path)
+        os.replace(tmp_path, entry_path)
+
+    def get_profiles(self, key, profiles_path):
+        """
+        Copies the cached intensity profiles of a key to profiles_path. Returns False if they are not cached.
+        """
+        cached_path = os.path.join(self.cache_dir, key + PROFILES_SUFFIX)
+        try:
+            os.makedirs(os.path.dirname(profiles_path), exist_ok=True)
+            self._copy(cached_path, profiles_path)
+        except FileNotFoundError:
+            return False
+        os.utime(cached_path)
+        return True
+
+    def evict(self):
+        """
+        Removes the least recently used entries and content hash memos until the cache fits in its size cap,
+        and the temporary files older than the run (left by crashed workers).
+        """
+        files = []
+        for directory in (self.cache_dir, self.digest_dir):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(TMP_SUFFIX):
+                    if stat.st_mtime < self.started:
+                        _remove(path)
+                        logging.info("Removed the temporary cache file %s", name)
+                elif name.endswith(ENTRY_SUFFIXES):
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+            logging.info("Evicted cache file %s", os.path.relpath(path, self.cache_dir))
+
+    def _copy(self, path, destination):
+        tmp_path = f"{destination}.{os.getpid()}{TMP_SUFFIX}"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, destination)
+
+    def _write_json(self, path, data):
+        # write then rename, so that concurrent workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}{TMP_SUFFIX}"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,282 @@
+import os
+import json
+import struct
+import logging
+import numpy as np
+import tiffile
+from load_data import preprocessed_stack_paths
+from segmentation import segmentation_mask_path
+
+CATALOG_FILE = "dataset_catalog.json"
+
+# bump when the entries change, to rebuild the old catalogs
+CATALOG_VERSION = 1
+
+# input files of a field of view, and the ones the analysis reads
+ROLES = ("raw", "GFP", "RFP", "mask")
+REQUIRED_ROLES = {False: ("GFP", "RFP", "mask"), True: ("raw", "mask")}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# number of channels of the PNG color types
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def catalog_path(Path_settings):
+    """
+    Path of the dataset catalog: "catalog_path" of the Path_settings, or dataset_catalog.json in the output directory.
+    """
+    return Path_settings.get("catalog_path") or os.path.join(Path_settings["output_dir"], CATALOG_FILE)
+
+
+def scan_dir(directory, suffix):
+    """
+    Lists a directory once and returns {file name: os.stat_result} of its files ending with suffix,
+    skipping hidden files like .DS_Store.
+    """
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.') and entry.name.endswith(suffix) and entry.is_file():
+                    files[entry.name] = entry.stat()
+    except OSError as e:
+        logging.warning("Could not list %s: %s", directory, e)
+    return files
+
+
+def png_header(path):
+    """
+    Shape and dtype of a PNG image, from its IHDR chunk.
+    """
+    with open(path, "rb") as f:
+        head = f.read(26)
+    if head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        raise ValueError(f"Not a PNG file: {path}")
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", head[16:26])
+    channels = PNG_CHANNELS[color_type]
+    return {"shape": [height, width] + ([channels] if channels > 1 else []),
+            "dtype": "uint16" if bit_depth == 16 else "uint8"}
+
+
+def tiff_header(path):
+    """
+    Shape and dtype of the first series of a TIFF file, and whether its data is contiguous (can be memory-mapped).
+    Only the header and the IFDs are read.
+    """
+    with tiffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        return {"shape": list(series.shape), "dtype": str(series.dtype), "contiguous": series.dataoffset is not None}
+
+
+def read_header(path):
+    """
+    Header of a PNG or TIFF image (detected from its first bytes), see png_header and tiff_header.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic == PNG_SIGNATURE:
+        return png_header(path)
+    return tiff_header(path)
+
+
+def header_nbytes(header):
+    """
+    Size in memory (bytes) of the image of a header.
+    """
+    return int(np.prod(header["shape"], dtype=np.int64)) * np.dtype(header["dtype"]).itemsize
+
+
+class DatasetCatalog:
+    """
+    Index of the input files of the fields of view: raw stack, GFP and RFP stacks and mask of each raw file, with
+    their size, modification time and header (shape, dtype).
+
+    The input directories are listed once, and only the headers of the files are read, so the stages know the files
+    and the size of the stacks without reading any pixels. The catalog is saved as JSON, and the headers of the files
+    whose size and modification time are unchanged are reused from the previous catalog.
+    """
+
+    def __init__(self, fovs, orphans=None):
+        # {file name: {role: {"path", "size", "mtime_ns", "shape", "dtype", ...} or None}}
+        self.fovs = fovs
+        # {role: [files without raw file]}
+        self.orphans = orphans or {}
+
+    @classmethod
+    def build(cls, Path_settings, previous=None):
+        """
+        Scans the raw, GFP, RFP and mask directories and reads the headers of the new or changed files.
+
+        Args:
+            Path_settings (config dict): input_dir, GFP_dir, RFP_dir, mask_dir and their suffixes.
+            previous (DatasetCatalog): catalog of a previous run, whose unchanged entries are reused.
+        """
+        reused = {}
+        if previous is not None:
+            for fov in previous.fovs.values():
+                for entry in fov.values():
+                    if entry is not None:
+                        reused[entry["path"]] = entry
+
+        dirs = {"raw": (Path_settings["input_dir"], ".TIF"),
+                "GFP": (Path_settings.get("GFP_dir"), Path_settings.get("GFP_suffix")),
+                "RFP": (Path_settings.get("RFP_dir"), Path_settings.get("RFP_suffix")),
+                "mask": (Path_settings["mask_dir"], Path_settings["mask_suffix"])}
+        listings = {role: scan_dir(directory, suffix) if directory and suffix else {}
+                    for role, (directory, suffix) in dirs.items()}
+
+        paths = {"raw": lambda file_name: os.path.join(Path_settings["input_dir"], file_name),
+                 "GFP": lambda file_name: preprocessed_stack_paths(file_name, Path_settings)[0],
+                 "RFP": lambda file_name: preprocessed_stack_paths(file_name, Path_settings)[1],
+                 "mask": lambda file_name: segmentation_mask_path(file_name, Path_settings)}
+
+        fovs = {}
+        n_read = 0
+        for file_name in sorted(listings["raw"]):
+            fov = {}
+            for role in ROLES:
+                if role != "raw" and not listings[role]:
+                    fov[role] = None
+                    continue
+                path = paths[role](file_name)
+                stat = listings[role].pop(os.path.basename(path), None)
+                if stat is None:
+                    fov[role] = None
+                    continue
+                entry = reused.get(path)
+                if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                    entry = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                    try:
+                        entry.update(read_header(path))
+                    except Exception as e:
+                        logging.warning("Could not read the header of %s: %s", path, e)
+                        entry["error"] = str(e)
+                    n_read += 1
+                fov[role] = entry
+            fovs[file_name] = fov
+
+        orphans = {role: sorted(files) for role, files in listings.items() if role != "raw" and files}
+        logging.info("Cataloged %s fields of view, read %s headers.", len(fovs), n_read)
+        return cls(fovs, orphans)
+
+    def file_names(self, from_raw=False):
+        """
+        Sorted names of the raw files whose inputs (GFP and RFP stacks, or raw stack, and mask) are all available.
+        """
+        required = REQUIRED_ROLES[from_raw]
+        return [file_name for file_name, fov in self.fovs.items()
+                if all(fov[role] is not None and "error" not in fov[role] for role in required)]
+
+    def missing(self, from_raw=False):
+        """
+        Returns {file name: [missing or unreadable inputs]} of the incomplete fields of view.
+        """
+        missing = {}
+        for file_name, fov in self.fovs.items():
+            roles = [role for role in REQUIRED_ROLES[from_raw] if fov[role] is None or "error" in fov[role]]
+            if roles:
+                missing[file_name] = roles
+        return missing
+
+    def memory_estimate(self, file_name, from_raw=False, lazy=False, z_chunk_size=None):
+        """
+        Estimated memory (bytes) of the arrays of a field of view held during its analysis: the stacks (not counted
+        when they are memory-mapped or read on demand, only their chunks read on demand with z_chunk_size) and the
+        mask, converted to uint16.
+        """
+        fov = self.fovs[file_name]
+        stack_roles = ("raw",) if from_raw else ("GFP", "RFP")
+        if z_chunk_size:
+            # the chunks of the memory-mapped stacks are views, the others are decoded chunk_size pages at a time
+            stack_bytes = sum(header_nbytes(fov[role]) * min(z_chunk_size, fov[role]["shape"][0]) // fov[role]["shape"][0]
+                              for role in stack_roles if not fov[role].get("contiguous"))
+        else:
+            stack_bytes = 0 if lazy else sum(header_nbytes(fov[role]) for role in stack_roles)
+        mask_bytes = int(np.prod(fov["mask"]["shape"][:2], dtype=np.int64)) * 2
+        return stack_bytes + mask_bytes
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # write then rename, so that an interrupted run never leaves a partial catalog
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "fovs": self.fovs, "orphans": self.orphans}, f, indent=1)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a saved catalog, or returns None if it is missing, unreadable or from another version.
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != CATALOG_VERSION:
+            return None
+        return cls(data["fovs"], data.get("orphans"))
+
+
+def update_catalog(Path_settings, from_raw=False):
+    """
+    Dataset catalog stage: rebuilds the catalog from the input directories, reusing the headers of the unchanged
+    files of the saved catalog, saves it and reports the incomplete fields of view.
+
+    Returns:
+        DatasetCatalog
+    """
+    path = catalog_path(Path_settings)
+    catalog = DatasetCatalog.build(Path_settings, DatasetCatalog.load(path))
+    catalog.save(path)
+    for file_name, roles in catalog.missing(from_raw).items():
+        logging.warning("Skipping %s: missing or unreadable %s", file_name, ', '.join(roles))
+    return catalog
+
+
+def plan_memory(catalog, Execution_settings):
+    """
+    Estimates the memory of the run from the catalog: per field of view, and at the peak of the execution mode
+    (all the fields of view in the batch mode, the largest one in the stream mode, the largest ones processed
+    at the same time by the workers).
+
+    Returns:
+        dict: {"fovs": {file name: bytes}, "peak": bytes, "mode": str}
+    """
+    from_raw = Execution_settings.get("direct_from_raw", False)
+    lazy = Execution_settings.get("lazy_loading", False)
+    workers = Execution_settings.get("workers", 1)
+    z_chunk_size = Execution_settings.get("z_chunk_size")
+    fovs = {file_name: catalog.memory_estimate(file_name, from_raw, lazy, z_chunk_size) for file_name in catalog.file_names(from_raw)}
+    sizes = sorted(fovs.values(), reverse=True)
+
+    if workers > 1 or Execution_settings.get("cache_dir"):
+        mode, peak = f"{workers} worker(s)", sum(sizes[:workers])
+    elif Execution_settings.get("stream", False):
+        mode, peak = "stream", sum(sizes[:1])
+    else:
+        mode, peak = "batch", sum(sizes)
+    return {"fovs": fovs, "peak": peak, "mode": mode}
+
+
+def dry_run_report(catalog, Execution_settings):
+    """
+    Reports the orphan files and the estimated memory per field of view and at the peak of the run, without loading
+    any pixels (the incomplete fields of view are reported by update_catalog).
+
+    Returns:
+        dict: output of plan_memory, with the "missing" inputs and the "orphans".
+    """
+    from_raw = Execution_settings.get("direct_from_raw", False)
+    plan = plan_memory(catalog, Execution_settings)
+    plan["missing"] = catalog.missing(from_raw)
+    plan["orphans"] = catalog.orphans
+
+    for file_name, size in plan["fovs"].items():
+        shape = catalog.fovs[file_name]["raw" if from_raw else "GFP"]["shape"]
+        logging.info("%s: stack %s, estimated memory %.1f MB", file_name, 'x'.join(map(str, shape)), size / 2**20)
+    for role, files in plan["orphans"].items():
+        logging.warning("%s %s file(s) without raw file: %s", len(files), role, ', '.join(files))
+    logging.info("Dry run: %s fields of view ready, %s incomplete, estimated peak memory %.1f MB (%s).",
+                 len(plan['fovs']), len(plan['missing']), plan['peak'] / 2**20, plan['mode'])
+    return plan
@@ -0,0 +1,251 @@
+import numpy as np
+from mask_index import as_mask_index
+
+
+class CellStack:
+    """
+    Compact representation of one segmented cell.
+
+    Holds views of the GFP and RFP stacks cropped to the bounding box of the cell, and the mask cropped to the same box,
+    instead of two full-frame masked copies of the stacks. The views share memory with the original stacks.
+
+    Indexing a CellStack with 'GFP' or 'RFP' returns the masked cropped stack, so it can be used where the
+    {'GFP': array, 'RFP': array} dict of a segmented cell is expected.
+    """
+    __slots__ = ('GFP_view', 'RFP_view', 'mask', 'bbox')
+
+    def __init__(self, GFP_view, RFP_view, mask, bbox):
+        self.GFP_view = GFP_view
+        self.RFP_view = RFP_view
+        self.mask = mask
+        self.bbox = bbox
+
+    def __contains__(self, channel):
+        return channel in ('GFP', 'RFP')
+
+    def __getitem__(self, channel):
+        return self._view(channel) * self.mask
+
+    def _view(self, channel):
+        if channel == 'GFP':
+            return self.GFP_view
+        if channel == 'RFP':
+            return self.RFP_view
+        raise KeyError(channel)
+
+    def slice_sums(self, channel):
+        """
+        Sum of the cell pixel intensities for each slice of the channel stack.
+        """
+        return [np.sum(image[self.mask]) for image in self._view(channel)]
+
+    @property
+    def nbytes(self):
+        """
+        Memory owned by the cell (the cropped mask), the stack views share the memory of the original stacks.
+        """
+        return self.mask.nbytes
+
+
+def cell_stacks(channels, mask):
+    """
+    Builds the compact CellStack of every cell in a segmentation mask.
+
+    Args:
+        channels (dict): {'GFP': stack, 'RFP': stack} of one field of view.
+        mask (np.ndarray or MaskIndex): segmentation mask, background is 0 and each cell has a unique label,
+        or its index (bounding boxes and pixels of the cells, see mask_index.py).
+
+    Returns:
+        dict: {cell_id: CellStack} for the cells present in the mask.
+    """
+    index = as_mask_index(mask)
+
+    cells = {}
+    for i, label in enumerate(index.cell_ids.tolist()):
+        crop, bbox = index.cell_mask(i)
+        cells[label] = CellStack(channels['GFP'][(slice(None),) + bbox],
+                                 channels['RFP'][(slice(None),) + bbox],
+                                 crop,
+                                 bbox)
+    return cells
+
+
+# columns of the processed data csv file: (CellTable column, csv column), the active slices are stored as a bitmask
+COLUMNS = (('cell_id', 'Cell ID'),
+           ('focal_slice', 'Focal Slice'),
+           ('focal_intensity', 'Focal Intensity'),
+           ('threshold_intensity', 'Threshold Intensity'),
+           ('total_intensity', 'Total Intensity'),
+           ('total_background', 'Total Background'),
+           ('total_intensity_normal', 'Total Intensity Normal'),
+           ('copy_number', 'Copy Number'),
+           ('copy_number_ci_low', 'Copy Number CI Low'),
+           ('copy_number_ci_high', 'Copy Number CI High'))
+# columns that are only present when the copy number interval is configured
+OPTIONAL_COLUMNS = ('copy_number_ci_low', 'copy_number_ci_high')
+
+
+class CellTable:
+    """
+    Columnar table of the processed cells: one NumPy array per column instead of a dict per cell.
+
+    The file of each cell is an index into file_names, and the active slices are a bitmask, packed along Z
+    (bit z of row i is set when slice z is active for cell i). The stages of process_fov fill the columns of a
+    field of view at once, the tables of the fields of view are concatenated, and the table is converted to pandas
+    (to_pandas) or Arrow (to_arrow) once, for a single bulk write. The numeric columns are not copied by the
+    conversions.
+    """
+    __slots__ = ('file_names', 'file_index', 'columns', 'active', 'n_slices')
+
+    def __init__(self, file_names, file_index, columns, active, n_slices):
+        # names of the files, and index of the file of each cell
+        self.file_names = list(file_names)
+        self.file_index = np.asarray(file_index, dtype=np.int32)
+        # {column: (n_cells,) array}, see COLUMNS
+        self.columns = columns
+        # (n_cells, ceil(n_slices / 8)) uint8, bits in little-endian order
+        self.active = active
+        self.n_slices = n_slices
+
+    def __len__(self):
+        return len(self.file_index)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], {}, np.zeros((0, 0), dtype=np.uint8), 0)
+
+    @classmethod
+    def from_fov(cls, file_name, cell_ids, active_slices, intensities):
+        """
+        Table of the cells of one field of view, from the batched results.
+
+        Args:
+            file_name (str): name of the raw file of the field of view.
+            cell_ids (list): cell IDs, in the order of the rows of the batched results.
+            active_slices (dict): output of find_active_slices_batch.
+            intensities (dict): output of cell_intensity_batch.
+        """
+        columns = {'cell_id': np.asarray(cell_ids, dtype=np.int64),
+                   'focal_slice': active_slices['focal slice'],
+                   'focal_intensity': active_slices['focal intensity'],
+                   'threshold_intensity': active_slices['threshold intensity']}
+        for column, _ in COLUMNS[4:]:
+            if column in intensities:
+                columns[column] = np.asarray(intensities[column])
+        active = active_slices['active']
+        return cls([file_name], np.zeros(len(columns['cell_id']), dtype=np.int32), columns,
+                   np.packbits(active, axis=1, bitorder='little'), active.shape[1])
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Concatenates tables, in order. The optional columns missing in some tables are NaN.
+        """
+        tables = [table for table in tables if len(table)]
+        if not tables:
+            return cls.empty()
+        if len(tables) == 1:
+            return tables[0]
+
+        positions, file_index = {}, []
+        for table in tables:
+            remap = np.array([positions.setdefault(name, len(positions)) for name in table.file_names], dtype=np.int32)
+            file_index.append(remap[table.file_index])
+
+        names = [column for column, _ in COLUMNS if any(column in table.columns for table in tables)]
+        columns = {column: np.concatenate([table.columns[column] if column in table.columns else np.full(len(table), np.nan)
+                                           for table in tables])
+                   for column in names}
+
+        n_slices = max(table.n_slices for table in tables)
+        width = max(table.active.shape[1] for table in tables)
+        active = np.concatenate([np.pad(table.active, ((0, 0), (0, width - table.active.shape[1]))) for table in tables])
+        return cls(list(positions), np.concatenate(file_index), columns, active, n_slices)
+
+    def sorted(self):
+        """
+        Returns the table sorted by (file name, cell ID).
+        """
+        file_rank = np.argsort(np.argsort(self.file_names, kind='stable')).astype(np.int32)
+        order = np.lexsort((self.columns['cell_id'], file_rank[self.file_index]))
+        return self.take(order)
+
+    def take(self, indices):
+        return CellTable(self.file_names, self.file_index[indices],
+                         {column: values[indices] for column, values in self.columns.items()},
+                         self.active[indices], self.n_slices)
+
+    def active_mask(self):
+        """
+        (n_cells, n_slices) boolean matrix of the active slices.
+        """
+        return np.unpackbits(self.active, axis=1, count=self.n_slices, bitorder='little').astype(bool)
+
+    def active_slices_strings(self):
+        """
+        Active slices of each cell as in the csv file ("0, 1, 2"), formatted once per distinct bitmask.
+        """
+        if len(self) == 0:
+            return np.array([], dtype=object)
+        unique, inverse = np.unique(self.active, axis=0, return_inverse=True)
+        strings = np.array([', '.join(map(str, np.flatnonzero(np.unpackbits(row, count=self.n_slices, bitorder='little')).tolist()))
+                            for row in unique], dtype=object)
+        return strings[inverse.ravel()]
+
+    def to_pandas(self):
+        """
+        DataFrame with the columns of the processed data csv file. The file names are a categorical column (codes
+        are the file indices), the numeric columns share memory with the table.
+        """
+        import pandas as pd
+
+        data = {'File Name': pd.Categorical.from_codes(self.file_index, categories=self.file_names)}
+        for column, name in COLUMNS:
+            if column in self.columns:
+                data[name] = self.columns[column]
+            if column == 'threshold_intensity':
+                data['Active Slices'] = self.active_slices_strings()
+        return pd.DataFrame(data, copy=False)
+
+    def to_arrow(self):
+        """
+        Arrow table with snake_case columns: file_name (dictionary encoded), the numeric columns (not copied) and
+        active_slices as a list column.
+        """
+        import pyarrow as pa
+
+        data = {'file_name': pa.DictionaryArray.from_arrays(self.file_index, pa.array(self.file_names, type=pa.string()))}
+        mask = self.active_mask()
+        offsets = np.zeros(len(self) + 1, dtype=np.int32)
+        np.cumsum(mask.sum(axis=1), out=offsets[1:])
+        active_slices = pa.ListArray.from_arrays(offsets, np.nonzero(mask)[1].astype(np.int32))
+        for column, _ in COLUMNS:
+            if column in self.columns:
+                data[column] = pa.array(self.columns[column])
+            if column == 'threshold_intensity':
+                data['active_slices'] = active_slices
+        return pa.table(data)
+
+    def rows(self):
+        """
+        One dict per cell, with the columns of the processed data csv file.
+        """
+        return self.to_pandas().astype({'File Name': object}).to_dict('records')
+
+    def save(self, path):
+        """
+        Saves the table as an uncompressed .npz archive (written to an open file, so the path is kept as is).
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, file_names=np.array(self.file_names, dtype=str), file_index=self.file_index,
+                     active=self.active, n_slices=self.n_slices, **self.columns)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            columns = {column: data[column] for column, _ in COLUMNS if column in data.files}
+            return cls(data['file_names'].tolist(), data['file_index'], columns, data['active'], int(data['n_slices']))
@@ -0,0 +1,13 @@
+import hashlib
+
+
+def file_digest(path):
+    """
+    Content hash (BLAKE2b, hex) of a file, read by chunks of 1 MB.
+    Shared by the result cache (cache keys) and the mask index sidecars (validation of the touched masks).
+    """
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
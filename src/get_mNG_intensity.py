@@ -3,45 +3,97 @@ import numpy as np
 import os
 import logging
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
-from sklearn.mixture import GaussianMixture
-# configure logging
-logging.basicConfig(level=logging.INFO)
+from mixture import BinnedGaussianMixture, select_mixture, bootstrap_mixture
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:  # optional dependency, faster csv parsing
+    CSV_ENGINE = "c"
 
 
-def load_integrated_intensity(folder_path):
+# spot table formats, detected from the first bytes of the file (the exports are not always named after their format)
+XLSX_MAGIC = b"PK\x03\x04"
+PARQUET_MAGIC = b"PAR1"
+SPOT_TABLE_EXTENSIONS = (".csv", ".xlsx", ".parquet")
+
+
+def detect_table_format(file_path):
+    """
+    Returns the real format of a spot table ("xlsx", "parquet" or "csv") from its magic bytes.
+    """
+    with open(file_path, "rb") as f:
+        magic = f.read(4)
+    if magic == XLSX_MAGIC:
+        return "xlsx"
+    if magic == PARQUET_MAGIC:
+        return "parquet"
+    return "csv"
+
+
+def read_spot_table(file_path, column_name="Intens"):
+    """
+    Reads the integrated intensity column of one spot table (CSV, XLSX or Parquet), as float64.
+
+    Args:
+        file_path (str): Path to the spot table.
+        column_name (str): Name of the column with integrated intensity values, the only column read.
+
+    Returns:
+        pd.Series: integrated intensities of the spots.
+    """
+    table_format = detect_table_format(file_path)
+    if table_format == "parquet":
+        df = pd.read_parquet(file_path, columns=[column_name])
+    elif table_format == "xlsx":
+        df = pd.read_excel(file_path, usecols=[column_name], dtype={column_name: "float64"})
+    else:
+        df = pd.read_csv(file_path, usecols=[column_name], dtype={column_name: "float64"}, engine=CSV_ENGINE)
+    return df[column_name].astype("float64")
+
+
+def load_integrated_intensity(folder_path, column_name="Intens", workers=8):
     """
-    Loads integrated mNG intensity data from CSV files in the specified folder.
+    Loads the integrated mNG intensities of the spot tables (CSV, XLSX or Parquet) in the specified folder.
+    The files are read concurrently and only the intensity column is read. A file that fails to load is reported 
+    and skipped, the other files are still loaded.
 
     Args:
-        folder_path (str): Path to the folder containing CSV files.
+        folder_path (str): Path to the folder containing the spot tables.
+        column_name (str): Name of the column with integrated intensity values.
+        workers (int): Number of files read concurrently.
     
     Returns:
-        pd.DataFrame: DataFrame containing integrated intensity data for all the images of the stacks of the different field of views. 
-    """
-
-    all_date = []
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith(".xlsx"):
-            file_path = os.path.join(folder_path, file_name)
-            try:
-                # read the xlsx file
-                #current_df = pd.read_excel(file_path)
-                # read the csv file
-                current_df = pd.read_csv(file_path)
-                # add the file name as a column after the indext ( second column) to identify the source 
-                current_df.insert(1, "file_name", file_name)
-                all_date.append(current_df)
-            except Exception as e:
-                logging.error(f"Failed to load {file_name}: {e}")
-                continue
-    if all_date:
-        integrated_intensity_df = pd.concat(all_date, ignore_index=True)
-        logging.info(f"Loaded integrated intensity data with {len(integrated_intensity_df)} entries.")
+        pd.DataFrame: file_name and integrated intensity of the spots of all the images of the stacks of the different field of views. 
+    """
+    file_names = sorted(file_name for file_name in os.listdir(folder_path)
+                        if file_name.lower().endswith(SPOT_TABLE_EXTENSIONS) and not file_name.startswith('.'))
+
+    def read(file_name):
+        try:
+            return read_spot_table(os.path.join(folder_path, file_name), column_name)
+        except Exception as e:
+            logging.error("Failed to load %s: %s", file_name, e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        intensities = list(executor.map(read, file_names))
+
+    loaded = {file_name: values for file_name, values in zip(file_names, intensities) if values is not None}
+    failed = [file_name for file_name, values in zip(file_names, intensities) if values is None]
+    if failed:
+        logging.warning("%s of %s spot tables failed to load: %s", len(failed), len(file_names), ', '.join(failed))
+
+    if loaded:
+        integrated_intensity_df = pd.DataFrame({
+            "file_name": pd.Categorical(np.repeat(list(loaded), [len(values) for values in loaded.values()]), categories=list(loaded)),
+            column_name: np.concatenate([values.to_numpy() for values in loaded.values()]),
+        })
+        logging.info("Loaded integrated intensity data with %s entries from %s files.", len(integrated_intensity_df), len(loaded))
         return integrated_intensity_df
     else:
-        logging.error("No CSV files found or failed to load any data.")
-        raise ValueError("No data loaded from CSV files.")
+        logging.error("No spot tables found or failed to load any data.")
+        raise ValueError("No data loaded from the spot tables.")
     
 def clean_integrated_intensity_data_1(df, column_name="Intens"):
     """
@@ -59,7 +111,7 @@ def clean_integrated_intensity_data_1(df, column_name="Intens"):
     # Remove rows with negative values in "Integrated Intensity" column
     df_cleaned = df_cleaned[df_cleaned[column_name] >= 0]
     final_count = len(df_cleaned)
-    logging.info(f"Cleaned integrated intensity data: removed {initial_count - final_count} invalid entries.")
+    logging.info("Cleaned integrated intensity data: removed %s invalid entries.", initial_count - final_count)
     return df_cleaned
 
 
@@ -87,19 +139,19 @@ def clean_integrated_intensity_data(df, column_name="Intens",max_pct=99.5, iqr_k
     df_cleaned = df.loc[kept.index].copy()
     df_cleaned[column_name] = kept
     logging.info(
-        f"Cleaned: {len(df)}→{len(df_cleaned)} rows | "
-        f"log10 range kept ~ [{lo:.2f}, {hi:.2f}] | "
-        f"median={np.median(kept):.3g}, 99%={np.percentile(kept,99):.3g}"
+        "Cleaned: %s→%s rows | log10 range kept ~ [%.2f, %.2f] | median=%.3g, 99%%=%.3g",
+        len(df), len(df_cleaned), lo, hi, np.median(kept), np.percentile(kept,99)
     )
     return df_cleaned
 
-def fit_integrated_intensity(df, column_name="Intens"):
+def fit_integrated_intensity(df, column_name="Intens", gmm=None):
     """
     Fits the integrated intensity data to find the single mNG intensity using a histogram and Gaussian fitting.
 
     Args:
         - df (pd.DataFrame): Cleaned DataFrame containing integrated intensity data.
         - column_name (str): Name of the column with integrated intensity values.
+        - gmm (BinnedGaussianMixture): 2-component mixture already fitted on the intensities, fitted here if None.
     Returns:
         - single_mNG_intensity (float): Estimated single mNG intensity.
         - fit_params (dict): Parameters of the Gaussian mixture model fit.
@@ -107,9 +159,9 @@ def fit_integrated_intensity(df, column_name="Intens"):
     """
 
     integrated_intensities = df[column_name].values.reshape(-1, 1)
-    # Fit a Gaussian Mixture Model
-    gmm = GaussianMixture(n_components=2, random_state=0)
-    gmm.fit(integrated_intensities)
+    # Fit a Gaussian Mixture Model (EM on a fine histogram of the intensities)
+    if gmm is None:
+        gmm = BinnedGaussianMixture(n_components=2).fit(integrated_intensities)
     means = gmm.means_.flatten()
     weights = gmm.weights_.flatten()
     # Assume the smaller mean corresponds to 16 units mean intensity
@@ -137,28 +189,59 @@ def fit_integrated_intensity(df, column_name="Intens"):
     ax.set_xlabel('Integrated Intensity')
     ax.set_ylabel('Density')
     ax.legend()
-    logging.info(f"Fitted single mNG intensity: {single_mNG_intensity:.2f}")
+    logging.info("Fitted single mNG intensity: %.2f", single_mNG_intensity)
     return single_mNG_intensity, fit_params, fig
 
+def bootstrap_single_mNG_intensity(df, column_name="Intens", n_resamples=2000, confidence_level=0.95, seed=0, gmm=None):
+    """
+    Bootstrap confidence interval of the single mNG intensity estimated by fit_integrated_intensity: the 2-component 
+    mixture is refitted on resamples of the cleaned intensities (seeded, see mixture.bootstrap_mixture), starting
+    from the fit on all the intensities.
+
+    Args:
+        - df (pd.DataFrame): Cleaned DataFrame containing integrated intensity data.
+        - column_name (str): Name of the column with integrated intensity values.
+        - n_resamples (int): Number of bootstrap resamples.
+        - confidence_level (float): Coverage of the percentile interval, e.g. 0.95.
+        - seed (int): Seed of the resampling, the same seed gives the same interval.
+        - gmm (BinnedGaussianMixture): 2-component mixture fitted on the intensities (as in fit_integrated_intensity),
+        fitted here if None.
+    Returns:
+        - dict: single_mNG_intensity_ci_low, single_mNG_intensity_ci_high and single_mNG_intensity_se (bootstrap standard
+        error), with the bootstrap settings, to be added to the fit parameters.
+    """
+    integrated_intensities = df[column_name].values
+    if gmm is None:
+        gmm = BinnedGaussianMixture(n_components=2).fit(integrated_intensities)
+    means, _ = bootstrap_mixture(gmm, integrated_intensities, n_resamples=n_resamples, seed=seed)
+    # same estimator as fit_integrated_intensity: the smaller mean corresponds to 16 units
+    single_mNG_intensities = means[:, 0] / 16.0
+
+    tail = (1 - confidence_level) / 2
+    ci_low, ci_high = np.percentile(single_mNG_intensities, [100 * tail, 100 * (1 - tail)])
+    logging.info("Bootstrap (%s resamples): single mNG intensity %.0f%% CI [%.2f, %.2f]", n_resamples, 100 * confidence_level, ci_low, ci_high)
+    return {
+        "single_mNG_intensity_ci_low": float(ci_low),
+        "single_mNG_intensity_ci_high": float(ci_high),
+        "single_mNG_intensity_se": float(np.std(single_mNG_intensities, ddof=1)),
+        "confidence_level": confidence_level,
+        "bootstrap_resamples": n_resamples,
+        "bootstrap_seed": seed,
+    }
+
 def fit_integrated_intensity_log(df, column_name="Intens", n_components=None, random_state=0):
     """
     Fit a GMM to log10(intensity). Overlay PDF on a histogram of log10 values.
+    The binned EM fit is deterministic, random_state is kept for compatibility and unused.
     """
     vals = df[column_name].values
     logI = np.log10(vals).reshape(-1, 1)
 
-    # Auto-select components via BIC if not specified (2–3 are typical here)
+    # Auto-select components via BIC if not specified (2–3 are typical here), the candidates are fitted in parallel
     if n_components is None:
-        bics = []
-        gmms = []
-        for k in (1, 2, 3):
-            g = GaussianMixture(n_components=k, random_state=random_state)
-            g.fit(logI)
-            bics.append(g.bic(logI))
-            gmms.append(g)
-        gmm = gmms[int(np.argmin(bics))]
+        gmm = select_mixture(logI, k_values=(1, 2, 3))
     else:
-        gmm = GaussianMixture(n_components=n_components, random_state=random_state).fit(logI)
+        gmm = BinnedGaussianMixture(n_components=n_components).fit(logI)
 
     means_log = gmm.means_.flatten()               # in log10 space
     weights = gmm.weights_.flatten()
@@ -195,8 +278,8 @@ def fit_integrated_intensity_log(df, column_name="Intens", n_components=None, ra
     ax.set_ylabel("Density")
     ax.legend()
 
-    logging.info(f"GMM on log10 intensities | K={gmm.n_components} | means_log10={means_log} | weights={weights}")
-    logging.info(f"Estimated single mNG intensity (linear units): {single_mNG_intensity:.3g}")
+    logging.info("GMM on log10 intensities | K=%s | means_log10=%s | weights=%s", gmm.n_components, means_log, weights)
+    logging.info("Estimated single mNG intensity (linear units): %.3g", single_mNG_intensity)
     return single_mNG_intensity, fit_params, fig
 
 def get_single_mNG_intensity(get_single_mNG_intensity):
@@ -205,9 +288,13 @@ def get_single_mNG_intensity(get_single_mNG_intensity):
 
     Args:
         get_single_mNG_intensity (dict): Configuration dictionary with keys:
-            - data_path (str): Path to the folder containing integrated intensity CSV files.
+            - data_path (str): Path to the folder containing the spot tables (CSV, XLSX or Parquet).
             - column_name (str): Name of the column with integrated intensity values.
             - output_dir (str): Directory to save output plots.
+            - read_workers (int, optional): Number of spot tables read concurrently (default 8).
+            - bootstrap_resamples (int, optional): Number of bootstrap resamples of the confidence interval, 0 to skip it (default).
+            - confidence_level (float, optional): Coverage of the confidence interval (default 0.95).
+            - bootstrap_seed (int, optional): Seed of the bootstrap (default 0).
     
     Returns:
         float: Estimated single mNG intensity.
@@ -217,30 +304,38 @@ def get_single_mNG_intensity(get_single_mNG_intensity):
     output_dir = get_single_mNG_intensity["output_dir"]
 
     # Load integrated intensity data
-    integrated_intensity_df = load_integrated_intensity(data_path)
+    integrated_intensity_df = load_integrated_intensity(data_path, column_name, get_single_mNG_intensity.get("read_workers", 8))
 
     # Clean the data
     cleaned_df = clean_integrated_intensity_data(integrated_intensity_df, column_name=column_name)
 
-    # Fit the data to find single mNG intensity
-    single_mNG_intensity, fit_params, fig = fit_integrated_intensity(cleaned_df, column_name=column_name)
+    # Fit the data to find single mNG intensity, the mixture is fitted once for the fit and the bootstrap
+    gmm = BinnedGaussianMixture(n_components=2).fit(cleaned_df[column_name].values)
+    single_mNG_intensity, fit_params, fig = fit_integrated_intensity(cleaned_df, column_name=column_name, gmm=gmm)
+
+    # Optional: bootstrap confidence interval of the single mNG intensity, saved with the fit parameters
+    n_resamples = get_single_mNG_intensity.get("bootstrap_resamples", 0)
+    if n_resamples:
+        fit_params.update(bootstrap_single_mNG_intensity(cleaned_df, column_name, n_resamples,
+                                                         get_single_mNG_intensity.get("confidence_level", 0.95),
+                                                         get_single_mNG_intensity.get("bootstrap_seed", 0), gmm=gmm))
 
 
     # Save the plot
     plot_path = os.path.join(output_dir, "integrated_mNG_intensity_fit.png")
     fig.savefig(plot_path)
-    logging.info(f"Saved integrated intensity fit plot to: {plot_path}")
+    logging.info("Saved integrated intensity fit plot to: %s", plot_path)
 
     # save fit parameters to a csv file
     fit_params_path =  os.path.join(output_dir, "integrated_mNG_intensity_fit_params.csv")
     fit_params_df = pd.DataFrame([fit_params])
     fit_params_df.to_csv(fit_params_path, index=False)
-    logging.info(f"Saved fit parameters to: {fit_params_path}")
+    logging.info("Saved fit parameters to: %s", fit_params_path)
 
     # save the cleaned data to a csv file
     cleaned_data_path = os.path.join(output_dir, "cleaned_integrated_mNG_intensity_data.csv")
     cleaned_df.to_csv(cleaned_data_path, index=False)
-    logging.info(f"Saved cleaned integrated intensity data to: {cleaned_data_path}")
+    logging.info("Saved cleaned integrated intensity data to: %s", cleaned_data_path)
 
     
     return single_mNG_intensity
@@ -2,20 +2,260 @@ import os
 import logging 
 from tqdm import tqdm
 import tiffile
+import numpy as np
+import profiling
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.FileHandler("pipeline.log"),  # Save logs to a file
-        logging.StreamHandler()  # Print logs to the console
-    ]
-)
+class LazyStack:
+    """
+    Array-like handle on a TIFF stack that reads the pages (slices) on demand, for the stacks that cannot be memory-mapped (e.g. compressed).
+    Supports len(), iteration over the slices, and indexing with a slice number first (stack[z], stack[z, rows, cols], stack[:, rows, cols]).
+    """
+    def __init__(self, path, cols=slice(None)):
+        self._tif = tiffile.TiffFile(path)
+        series = self._tif.series[0]
+        self._pages = series.pages
+        self._cols = cols
+        self.shape = series.shape[:2] + (len(range(series.shape[2])[cols]),)
+        self.dtype = series.dtype
+        self.ndim = len(self.shape)
+
+    def columns(self, cols):
+        """
+        Returns a LazyStack of the same file restricted to a range of columns (e.g. one half of a dual-view stack).
+        """
+        stack = LazyStack.__new__(LazyStack)
+        stack._tif = self._tif
+        stack._pages = self._pages
+        stack._cols = cols
+        stack.shape = self.shape[:2] + (len(range(self.shape[2])[cols]),)
+        stack.dtype = self.dtype
+        stack.ndim = self.ndim
+        return stack
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for z in range(len(self)):
+            yield self[z]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        z, rest = key[0], key[1:]
+        if isinstance(z, slice):
+            return np.stack([self._page(i)[rest] for i in range(len(self))[z]])
+        return self._page(int(z))[rest]
+
+    def _page(self, z):
+        return self._pages[z].asarray()[:, self._cols]
+
+    def read_pages(self, start, stop):
+        """
+        Reads the pages start to stop - 1 into one (stop - start, rows, columns) array, with all the columns of
+        the pages (see columns), decoded in place.
+        """
+        pages = np.empty((stop - start,) + tuple(self._pages[start].shape), dtype=self.dtype)
+        for i, z in enumerate(range(start, stop)):
+            self._pages[z].asarray(out=pages[i])
+        return pages
+
+    def close(self):
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_stack(path, lazy=False):
+    """
+    Reads a TIFF stack.
+
+    Args:
+        path (str): path of the TIFF file.
+        lazy (bool): if False, the whole stack is read in memory. If True, uncompressed stacks are memory-mapped 
+        (read-only) and the other stacks are returned as a LazyStack reading the slices on demand, so only the 
+        slices and rows used by the analysis are read from the disk.
+
+    Returns:
+        np.ndarray, np.memmap or LazyStack.
+    """
+    if not lazy:
+        return tiffile.imread(path)
+    try:
+        return tiffile.memmap(path, mode='r')
+    except ValueError:
+        # compressed or non contiguous data cannot be memory-mapped
+        return LazyStack(path)
+
+
+def close_stacks(channels):
+    """
+    Closes the files of the stacks of a field of view read on demand (LazyStack, the GFP and RFP views of a raw
+    stack share one file). The arrays and memory-mapped stacks hold no open file.
+
+    Args:
+        channels (dict): {'GFP': stack, 'RFP': stack}, from read_preprocessed_stacks.
+    """
+    files = {id(stack._tif): stack for stack in channels.values() if isinstance(stack, LazyStack)}
+    for stack in files.values():
+        stack.close()
+
+
+def iter_z_chunks(channels, z_chunk_size):
+    """
+    Reads the GFP and RFP stacks of a field of view z_chunk_size slices at a time.
+
+    The chunks of the arrays and memory-mapped stacks are views. The chunks of the stacks read on demand (LazyStack)
+    are decoded into one buffer per chunk, and the pages of a raw dual-view stack (both channels of the same file,
+    from_raw) are decoded once for the two channels.
+
+    Yields:
+        (start, GFP_chunk, RFP_chunk): first slice of the chunk and (chunk size, rows, columns) arrays of both channels.
+    """
+    GFP_stack, RFP_stack = channels['GFP'], channels['RFP']
+    if len(GFP_stack) != len(RFP_stack):
+        raise ValueError(f"The GFP and RFP stacks have {len(GFP_stack)} and {len(RFP_stack)} slices.")
+    shared = isinstance(GFP_stack, LazyStack) and isinstance(RFP_stack, LazyStack) and GFP_stack._tif is RFP_stack._tif
+
+    for start in range(0, len(GFP_stack), z_chunk_size):
+        stop = min(start + z_chunk_size, len(GFP_stack))
+        if shared:
+            pages = GFP_stack.read_pages(start, stop)
+            yield start, pages[:, :, GFP_stack._cols], pages[:, :, RFP_stack._cols]
+        else:
+            yield start, _read_chunk(GFP_stack, start, stop), _read_chunk(RFP_stack, start, stop)
+
+
+def _read_chunk(stack, start, stop):
+    if isinstance(stack, LazyStack):
+        return stack.read_pages(start, stop)[:, :, stack._cols]
+    return stack[start:stop]
+
+
+def split_channels(image_stack):
+    """
+    Splits a dual-view stack into its RFP (left half) and GFP (right half) stacks, as zero-copy column views.
+
+    Returns:
+        - {'GFP': GFP_stack, 'RFP': RFP_stack}
+    """
+    middle_col = image_stack.shape[2]//2
+    if isinstance(image_stack, LazyStack):
+        return {'GFP': image_stack.columns(slice(middle_col, None)), 'RFP': image_stack.columns(slice(None, middle_col))}
+    return {'GFP': image_stack[:, :, middle_col:], 'RFP': image_stack[:, :, :middle_col]}
+
+
+def read_raw_stacks(file_name, Path_settings, lazy=False):
+    """
+    Reads the raw dual-view stack of a single file once and splits it into GFP and RFP views, 
+    without the GFP and RFP stacks written by the preprocessing.
+
+    Args:
+    file_name (str): name of the raw .TIF file.
+    path_settings (config dict): input_dir (str): path to the raw data.
+    lazy (bool): see open_stack.
+
+    Returns:
+        - {'GFP': GFP_stack, 'RFP': RFP_stack}, or None if loading fails.
+    """
+    raw_path = os.path.join(Path_settings["input_dir"], file_name)
+    try:
+        image_stack = open_stack(raw_path, lazy)
+        logging.info("Loaded raw stack: %s", file_name)
+    except Exception as e:
+        logging.error("failed to load the raw stack %s: %s", file_name, e)
+        return None
+
+    return split_channels(image_stack)
+
+
+def list_raw_files(input_dir):
+    """
+    Lists the raw .TIF files of the input directory in sorted order, skipping hidden files like .DS_Store.
+    The sorted order makes the order of the processed cells independent of the file system.
+    """
+    return sorted(file_name for file_name in os.listdir(input_dir)
+                  if not file_name.startswith('.') and file_name.endswith(".TIF"))
+
+
+def preprocessed_stack_paths(file_name, Path_settings):
+    """
+    Returns the paths (GFP_path, RFP_path) of the preprocessed stacks of a raw file.
+    """
+    GFP_path = os.path.join(Path_settings["GFP_dir"], file_name.replace('.TIF', Path_settings["GFP_suffix"]))
+    RFP_path = os.path.join(Path_settings["RFP_dir"], file_name.replace('.TIF', Path_settings["RFP_suffix"]))
+    return GFP_path, RFP_path
 
 
-def load_preprocessed_data(Path_settings):
+def read_preprocessed_stacks(file_name, Path_settings, lazy=False, from_raw=False):
+    """
+    Reads the GFP and RFP stacks of a single raw file.
+
+    Args:
+    file_name (str): name of the raw .TIF file.
+    path_settings (config dict): see load_preprocessed_data.
+    lazy (bool): memory-map or read the slices on demand instead of reading the stacks in memory (see open_stack).
+    from_raw (bool): split the raw dual-view stack instead of reading the preprocessed stacks (see read_raw_stacks).
+
+    Returns:
+        - {'GFP': GFP_stack, 'RFP': RFP_stack}, or None if a stack is missing or loading fails.
+    """
+    with profiling.stage("load_stacks", file_name):
+        if from_raw:
+            return read_raw_stacks(file_name, Path_settings, lazy)
+
+        GFP_path, RFP_path = preprocessed_stack_paths(file_name, Path_settings)
+        GFP_filename = os.path.basename(GFP_path)
+        RFP_filename = os.path.basename(RFP_path)
+
+        # a missing stack is reported when it is opened, without a separate existence check per file
+        try:
+            #read the GFP stacks
+            GFP_stack = open_stack(GFP_path, lazy)
+            logging.info("Loaded GFP: %s", GFP_filename)
+        
+            #read the RFP stacks
+            RFP_stack = open_stack(RFP_path, lazy)
+            logging.info("Loaded RFP: %s", RFP_filename)
+
+        except FileNotFoundError as e:
+            logging.warning("GFP or RFP stack not found: %s", e.filename)
+            return None
+        except Exception as e:
+            logging.error("failed to load the GFP or RFP stack for%s: %s", file_name, e)
+            return None
+
+        return {'GFP': GFP_stack, 'RFP': RFP_stack}
+
+
+def iter_preprocessed_data(Path_settings, lazy=False, from_raw=False, file_names=None):
+    """"
+    Yields the GFP and RFP stacks of each field of view, one at a time. 
+    Only the stacks of the current field of view are held in memory.
+
+    Args: 
+    path_settings (config dict): see load_preprocessed_data.
+    lazy (bool): see load_preprocessed_data.
+    from_raw (bool): see load_preprocessed_data.
+    file_names (list): see load_preprocessed_data.
+
+    Yields:
+        - (file_name, {'GFP': GFP_stack, 'RFP': RFP_stack}) for each raw file with both stacks available.
+    """
+    if file_names is None:
+        file_names = list_raw_files(Path_settings["input_dir"])
+    for file_name in tqdm(file_names):
+        channels = read_preprocessed_stacks(file_name, Path_settings, lazy, from_raw)
+        if channels is not None:
+            yield file_name, channels
+
+
+def load_preprocessed_data(Path_settings, lazy=False, from_raw=False, file_names=None):
     """"
     Loads the GFP and RFP stacks corresponding tp each field of view.
 
@@ -26,52 +266,14 @@ def load_preprocessed_data(Path_settings):
         RFP_dir: path to RFP stacks. 
         GFP_suffix in the file name in GFP directory
         RFP_suffix in the file name in RFP directory
+    lazy (bool): if True, the stacks are memory-mapped, or read slice by slice on demand for compressed files, 
+    instead of being fully read in memory.
+    from_raw (bool): if True, the raw dual-view stacks are read once and split into zero-copy GFP (right half) 
+    and RFP (left half) views, instead of reading the GFP and RFP stacks written by the preprocessing.
+    file_names (list): names of the raw files to load (e.g. from the dataset catalog), instead of listing the raw directory.
 
     
     Returns:
         - image_stacks_dict(dict):  dictionary with the file names as keys and a dict:{'GFP': GFP_stack, 'RFP': RFP_stack} as values. 
     """
-    input_dir = Path_settings["input_dir"]
-    GFP_dir = Path_settings["GFP_dir"]
-    RFP_dir = Path_settings["RFP_dir"]
-    GFP_suffix = Path_settings["GFP_suffix"]
-    RFP_suffix = Path_settings["RFP_suffix"]
-    
-    image_stacks_dict = {}
-    for file_name in tqdm(os.listdir(input_dir)):
-        # Skip hidden files like .DS_Store:
-        if file_name.startswith('.'):
-            continue
-        if file_name.endswith(".TIF"):
-            GFP_filename = file_name.replace('.TIF', GFP_suffix)
-            GFP_path = os.path.join(GFP_dir,GFP_filename)
-
-            RFP_filename = file_name.replace('.TIF', RFP_suffix)
-            RFP_path = os.path.join(RFP_dir,RFP_filename)
-
-        if not os.path.exists(GFP_path):
-            logging.warning(f"GFP stack not found: {GFP_path}")
-            continue
-
-        if not os.path.exists(RFP_path):
-            logging.warning(f"RFP stack not found: {RFP_path}")
-            continue
-    
-        try:
-            #read the GFP stacks
-            GFP_stack = tiffile.imread(GFP_path)
-            logging.info(f"Loaded GFP: {GFP_filename}")
-            
-            #read the RFP stacks
-            RFP_stack = tiffile.imread(RFP_path)
-            logging.info(f"Loaded RFP: {RFP_filename}")
-
-            image_stacks_dict[file_name] = {'GFP': GFP_stack, 'RFP': RFP_stack}
-            
-        except Exception as e:
-            logging.error(f"failed to load the GFP or RFP stack for{file_name}: {e}")
-            continue
-
-    
-    return image_stacks_dict
-    
+    return dict(iter_preprocessed_data(Path_settings, lazy, from_raw, file_names))
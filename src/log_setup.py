@@ -0,0 +1,148 @@
+import os
+import json
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+LOG_FILE = "pipeline_log.jsonl"
+CONSOLE_FORMAT = '[%(asctime)s] %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# logger of the per-cell detail records (debug level), off unless the Logging_settings ask for it:
+# the hot loops check cell_logger.isEnabledFor(logging.DEBUG) once per field of view
+CELL_LOGGER = "pipeline.cells"
+cell_logger = logging.getLogger(CELL_LOGGER)
+
+# attributes of every LogRecord, the other attributes come from the extra= of the call and are saved as JSON fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+# queue and listener of the process, set by setup_logging
+_queue = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line: time (ISO 8601, UTC), level, logger, message, process,
+    and the fields passed with extra= (e.g. the per field of view summaries, {"event": "fov_summary", "fov": ..., "cells": ...}).
+    """
+
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage(),
+                 "process": record.process}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def log_file_path(Logging_settings, output_dir=None):
+    """
+    Path of the JSON-lines log: "log_file" of the Logging_settings, or pipeline_log.jsonl in the output directory,
+    None if the file output is turned off ("json_file": false) or there is no output directory.
+    """
+    if not Logging_settings.get("json_file", True):
+        return None
+    if Logging_settings.get("log_file"):
+        return Logging_settings["log_file"]
+    return os.path.join(output_dir, LOG_FILE) if output_dir else None
+
+
+def setup_logging(Logging_settings=None, output_dir=None):
+    """
+    Configures the logging of the whole pipeline, once per run: the records are put on a queue by the calling
+    thread (or worker process) and written by a listener thread to the console (text) and to the JSON-lines log file,
+    so the stages never wait on the terminal or the disk. The records of the disabled levels are dropped before
+    their message is built.
+
+    Args:
+        Logging_settings (config dict):
+            level (str): level of the pipeline records (default "INFO").
+            cell_details (bool): log the per-cell detail records (default false, one summary per field of view).
+            json_file (bool): write the JSON-lines log file (default true).
+            log_file (str): path of the JSON-lines log, default pipeline_log.jsonl in output_dir.
+        output_dir (str): output directory of the run.
+
+    Returns:
+        str: path of the JSON-lines log, or None.
+    """
+    import multiprocessing
+
+    global _queue, _listener
+    Logging_settings = Logging_settings or {}
+    stop_logging()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT, DATE_FORMAT))
+    handlers = [console]
+
+    path = log_file_path(Logging_settings, output_dir)
+    if path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        json_handler = logging.FileHandler(path, mode="a", encoding="utf-8")
+        json_handler.setFormatter(JsonFormatter())
+        handlers.append(json_handler)
+
+    # a multiprocessing queue, so the worker processes log through the listener of the main process (see init_worker_logging)
+    _queue = multiprocessing.Queue(-1)
+    _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    _install(_queue, Logging_settings.get("level", "INFO"), Logging_settings.get("cell_details", False))
+    # registered after the exit handler of multiprocessing (atexit runs the last registered first),
+    # so the queue is still open when the listener writes out the last records
+    atexit.unregister(stop_logging)
+    atexit.register(stop_logging)
+    return path
+
+
+def _install(queue, level, cell_details):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+    cell_logger.setLevel(logging.DEBUG if cell_details else logging.INFO)
+
+
+def worker_logging_args():
+    """
+    initargs of init_worker_logging for the process pools: (queue, level, cell_details) of the main process.
+    """
+    root = logging.getLogger()
+    return _queue, root.level, cell_logger.level == logging.DEBUG
+
+
+def init_worker_logging(queue, level, cell_details):
+    """
+    Initializer of the worker processes: sends their records to the listener of the main process.
+    Does nothing if the logging of the main process was not set up.
+    """
+    if queue is not None:
+        _install(queue, level, cell_details)
+
+
+def stop_logging():
+    """
+    Writes out the queued records and stops the listener (also called at exit). The records logged afterwards
+    are written directly by the handlers of the listener.
+    """
+    global _queue, _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _queue.close()
+    _queue.join_thread()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener = _queue = None
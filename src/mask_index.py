@@ -0,0 +1,186 @@
+import os
+import logging
+import numpy as np
+from digest import file_digest
+
+# bump when the layout of the sidecars changes, to rebuild the old ones
+INDEX_VERSION = 2
+INDEX_SUFFIX = ".index.npz"
+
+
+class MaskIndex:
+    """
+    Index of the labelled cells of a segmentation mask: sorted labels, bounding boxes, pixel counts and the flat
+    pixel indices of each label (grouped by label, in raster order within a label, with the offsets of the groups).
+
+    Built once per mask with a single scan of the label image (from_mask) and saved as an .npz sidecar, so the
+    analysis gets the cells of a mask without decoding and scanning the label image again. np.asarray(index)
+    rebuilds the label image, for the code that expects the mask array.
+    """
+    __slots__ = ('shape', 'cell_ids', 'bboxes', 'areas', 'offsets', 'pixels')
+
+    def __init__(self, shape, cell_ids, bboxes, areas, offsets, pixels):
+        self.shape = tuple(int(n) for n in shape)
+        # (n_cells,) sorted labels, background (0) excluded
+        self.cell_ids = cell_ids
+        # (n_cells, 4) row start, row stop, column start, column stop of each cell (stops excluded)
+        self.bboxes = bboxes
+        # (n_cells,) number of pixels of each cell
+        self.areas = areas
+        # (n_cells + 1,) the pixels of cell i are pixels[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        # flat indices (row * width + column) of the foreground pixels
+        self.pixels = pixels
+
+    def __len__(self):
+        return len(self.cell_ids)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Indexes a label image (background 0, one label per cell).
+        """
+        mask = np.asarray(mask)
+        flat = mask.ravel()
+        foreground = np.flatnonzero(flat)
+        values = flat[foreground]
+        # stable sort: the pixels of a cell stay in raster order, as with np.nonzero
+        order = np.argsort(values, kind='stable')
+        pixel_dtype = np.int32 if flat.size < 2**31 else np.int64
+        pixels = foreground[order].astype(pixel_dtype)
+        values = values[order]
+
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]]) if len(values) else np.zeros(0, dtype=np.int64)
+        offsets = np.append(starts, len(values)).astype(np.int64)
+        cell_ids = values[starts].astype(np.int64)
+        areas = np.diff(offsets)
+
+        rows, cols = np.divmod(pixels, mask.shape[1])
+        bboxes = np.zeros((len(cell_ids), 4), dtype=np.int32)
+        if len(cell_ids):
+            bboxes[:, 0] = np.minimum.reduceat(rows, starts)
+            bboxes[:, 1] = np.maximum.reduceat(rows, starts) + 1
+            bboxes[:, 2] = np.minimum.reduceat(cols, starts)
+            bboxes[:, 3] = np.maximum.reduceat(cols, starts) + 1
+        return cls(mask.shape, cell_ids, bboxes, areas, offsets, pixels)
+
+    def coords(self):
+        """
+        (rows, cols) pixel coordinates of the foreground pixels, grouped by cell.
+        """
+        return np.divmod(self.pixels, self.shape[1])
+
+    def labels(self):
+        """
+        Position in cell_ids of the cell of each foreground pixel, in the order of coords().
+        """
+        return np.repeat(np.arange(len(self.cell_ids)), self.areas)
+
+    def cell_pixels(self, i):
+        return self.pixels[self.offsets[i]:self.offsets[i + 1]]
+
+    def bbox(self, i):
+        row_start, row_stop, col_start, col_stop = self.bboxes[i].tolist()
+        return slice(row_start, row_stop), slice(col_start, col_stop)
+
+    def cell_mask(self, i):
+        """
+        Boolean mask of cell i cropped to its bounding box, and the bounding box (row slice, column slice).
+        """
+        bbox = self.bbox(i)
+        crop = np.zeros((bbox[0].stop - bbox[0].start, bbox[1].stop - bbox[1].start), dtype=bool)
+        rows, cols = np.divmod(self.cell_pixels(i), self.shape[1])
+        crop[rows - bbox[0].start, cols - bbox[1].start] = True
+        return crop, bbox
+
+    def binary_mask(self, i, dtype=np.uint8):
+        """
+        Full-frame mask of cell i (1 in the cell, 0 elsewhere).
+        """
+        mask = np.zeros(self.shape, dtype=dtype)
+        mask.ravel()[self.cell_pixels(i)] = 1
+        return mask
+
+    def to_mask(self, dtype=np.uint16):
+        """
+        Rebuilds the label image.
+        """
+        mask = np.zeros(self.shape, dtype=dtype)
+        mask.ravel()[self.pixels] = np.repeat(self.cell_ids, self.areas)
+        return mask
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_mask() if dtype is None else self.to_mask().astype(dtype)
+
+    def save(self, path, key):
+        """
+        Saves the index with the key of its mask file (see mask_file_key), written then renamed so that a partial
+        sidecar is never read.
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, size=key["size"], mtime_ns=key["mtime_ns"], digest=key["digest"],
+                     shape=np.array(self.shape), cell_ids=self.cell_ids, bboxes=self.bboxes, areas=self.areas,
+                     offsets=self.offsets, pixels=self.pixels)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a sidecar. Returns (index, key of the indexed mask file), or (None, None) if it is missing, unreadable
+        or from another version.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data["version"]) != INDEX_VERSION:
+                    return None, None
+                key = {"size": int(data["size"]), "mtime_ns": int(data["mtime_ns"]), "digest": str(data["digest"])}
+                return cls(data["shape"], data["cell_ids"], data["bboxes"], data["areas"], data["offsets"], data["pixels"]), key
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+
+def as_mask_index(mask):
+    """
+    Returns the MaskIndex of a mask given as a label image or as a MaskIndex.
+    """
+    return mask if isinstance(mask, MaskIndex) else MaskIndex.from_mask(mask)
+
+
+def mask_index_path(mask_path, index_dir=None):
+    """
+    Path of the sidecar of a mask: <mask name>.index.npz next to the mask, or in index_dir.
+    """
+    name = os.path.splitext(os.path.basename(mask_path))[0] + INDEX_SUFFIX
+    return os.path.join(index_dir or os.path.dirname(mask_path), name)
+
+
+def cached_mask_index(mask_path, read_mask, index_dir=None):
+    """
+    Returns the MaskIndex of a mask file from its sidecar, or builds it and saves the sidecar.
+
+    The sidecar is used as is while the size and modification time of the mask are unchanged. When only the
+    modification time changed, the mask file is hashed and the sidecar is still used if the content is the same (e.g. a
+    copied or touched mask). Otherwise the mask is decoded with read_mask(mask_path) and indexed again. Without a
+    sidecar to validate, the mask is only hashed to write the new sidecar.
+
+    Raises:
+        the errors of os.stat and read_mask (e.g. FileNotFoundError for a missing mask).
+    """
+    stat = os.stat(mask_path)
+    index_path = mask_index_path(mask_path, index_dir)
+    index, key = MaskIndex.load(index_path)
+    if index is not None and key["size"] == stat.st_size and key["mtime_ns"] == stat.st_mtime_ns:
+        return index
+
+    digest = None
+    if index is not None and key["size"] == stat.st_size:
+        digest = file_digest(mask_path)
+    if digest is None or key["digest"] != digest:
+        index = MaskIndex.from_mask(read_mask(mask_path))
+    try:
+        index.save(index_path, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest or file_digest(mask_path)})
+    except OSError as e:
+        # read-only mask directory: the index is rebuilt on the next run
+        logging.debug("Could not save the mask index %s: %s", index_path, e)
+    return index
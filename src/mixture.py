@@ -0,0 +1,297 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# bins of the histogram the mixture is fitted on; fine enough for the fit to match a fit on the samples
+N_BINS = 2048
+
+# bootstrap replicates fitted together in one batched EM
+BOOTSTRAP_CHUNK = 128
+
+
+def bin_samples(x, n_bins=N_BINS):
+    """
+    Reduces 1-D samples to a fine histogram: count, mean and within-bin sum of squared deviations of each non-empty bin.
+    The bin means and sums of squares keep the first two moments of the samples exact.
+
+    Args:
+        x (np.ndarray): samples.
+        n_bins (int): number of bins between the min and max of the samples.
+
+    Returns:
+        counts, means, sq_dev (np.ndarray): one value per non-empty bin.
+    """
+    x = np.asarray(x, dtype=np.float64).ravel()
+    lo, hi = x.min(), x.max()
+    if hi == lo:
+        return np.array([x.size], dtype=np.float64), np.array([lo]), np.zeros(1)
+    index = np.minimum(((x - lo) / (hi - lo) * n_bins).astype(np.intp), n_bins - 1)
+    counts = np.bincount(index, minlength=n_bins).astype(np.float64)
+    sums = np.bincount(index, weights=x, minlength=n_bins)
+    sq_sums = np.bincount(index, weights=x * x, minlength=n_bins)
+
+    filled = counts > 0
+    counts, sums, sq_sums = counts[filled], sums[filled], sq_sums[filled]
+    means = sums / counts
+    sq_dev = np.maximum(sq_sums - sums * means, 0)
+    return counts, means, sq_dev
+
+
+def _log_components(x, weights, means, variances):
+    # (n, K) log of the weighted component densities
+    return (np.log(weights) - 0.5 * np.log(2 * np.pi * variances)
+            - (x[:, None] - means) ** 2 / (2 * variances))
+
+
+def _logsumexp(log_p):
+    peak = log_p.max(axis=-1, keepdims=True)
+    return (peak + np.log(np.exp(log_p - peak).sum(axis=-1, keepdims=True)))[..., 0]
+
+
+def _em_step(counts, x, within, params, reg_covar):
+    """
+    One EM iteration of a batch of mixtures, each fitted on its own bin counts.
+
+    Args:
+        counts (np.ndarray): (b, bins) bin counts of each mixture.
+        x, within (np.ndarray): (bins,) bin means and within-bin variances.
+        params (np.ndarray): (b, 3, K) weights, means and variances.
+
+    Returns:
+        log_likelihood (np.ndarray): (b,) mean log-likelihood at params.
+        params (np.ndarray): (b, 3, K) updated parameters.
+    """
+    weights, mu, var = params[:, 0], params[:, 1], params[:, 2]
+    log_p = ((np.log(weights) - 0.5 * np.log(2 * np.pi * var))[:, None, :]
+             - (x[None, :, None] - mu[:, None, :]) ** 2 / (2 * var[:, None, :]))
+    log_density = _logsumexp(log_p)
+    n = counts.sum(axis=1)
+    log_likelihood = np.einsum('bi,bi->b', counts, log_density) / n
+
+    resp = np.exp(log_p - log_density[:, :, None]) * counts[:, :, None]
+    nk = resp.sum(axis=1) + 10 * np.finfo(np.float64).eps
+    mu = np.einsum('bik,i->bk', resp, x) / nk
+    var = (np.einsum('bik,i->bk', resp, within)
+           + np.einsum('bik,bik->bk', resp, (x[None, :, None] - mu[:, None, :]) ** 2)) / nk
+    return log_likelihood, np.stack([nk / n[:, None], mu, var + reg_covar], axis=1)
+
+
+def _fit_em(counts, x, within, params, reg_covar, tol, max_iter):
+    """
+    Batched EM with SQUAREM acceleration (two EM steps extrapolated along their direction), which converges in a few
+    tens of iterations where plain EM crawls when the components overlap. A mixture stops iterating once its
+    log-likelihood changes by less than tol.
+
+    Returns:
+        log_likelihood (np.ndarray): (b,) mean log-likelihood at the fitted params.
+        params (np.ndarray): (b, 3, K) fitted parameters.
+        n_iter (int): iterations of the slowest mixture.
+    """
+    params = params.copy()
+    log_likelihood = np.full(len(params), -np.inf)
+    running = np.arange(len(params))
+
+    for n_iter in range(1, max_iter + 1):
+        c, p0 = counts[running], params[running]
+        ll0, p1 = _em_step(c, x, within, p0, reg_covar)
+        _, p2 = _em_step(c, x, within, p1, reg_covar)
+
+        r = (p1 - p0).reshape(len(running), -1)
+        v = (p2 - p1).reshape(len(running), -1) - r
+        r_norm, v_norm = np.sqrt((r ** 2).sum(axis=1)), np.sqrt((v ** 2).sum(axis=1))
+        alpha = np.minimum(-r_norm / np.where(v_norm > 0, v_norm, np.inf), -1.0)[:, None, None]
+        p_acc = p0 - 2 * alpha * (p1 - p0) + alpha ** 2 * (p2 - 2 * p1 + p0)
+
+        # fall back to the plain EM steps when the extrapolation leaves the valid parameters
+        invalid = ~((p_acc[:, 0] > 0).all(axis=1) & (p_acc[:, 2] > 0).all(axis=1))
+        p_acc[invalid] = p2[invalid]
+        ll_acc, p_new = _em_step(c, x, within, p_acc, reg_covar)
+        # or when it decreases the likelihood
+        worse = ll_acc < ll0
+        if worse.any():
+            ll_acc[worse], p_new[worse] = _em_step(c[worse], x, within, p2[worse], reg_covar)
+
+        params[running] = p_new
+        done = np.abs(ll_acc - log_likelihood[running]) < tol
+        log_likelihood[running] = ll_acc
+        running = running[~done]
+        if running.size == 0:
+            break
+
+    return log_likelihood, params, n_iter
+
+
+def _standardize(counts, means, sq_dev):
+    # the mixtures are fitted in standardized units, so the means and variances have the same scale in the extrapolation
+    n = counts.sum()
+    loc = counts @ means / n
+    scale = np.sqrt((sq_dev.sum() + counts @ (means - loc) ** 2) / n) or 1.0
+    return loc, scale, (means - loc) / scale, sq_dev / counts / scale ** 2
+
+
+class BinnedGaussianMixture:
+    """
+    1-D Gaussian mixture fitted by EM on the weighted bins of a fine histogram instead of the samples, so an
+    iteration costs O(bins * K) whatever the number of samples. The M-step adds the within-bin variance of the
+    samples, so the fit matches a fit on the samples up to the resolution of the bins.
+
+    Exposes the attributes of sklearn's GaussianMixture used by the calibration (n_components, means_, weights_,
+    bic, score_samples), with 1-D means_, variances_ and weights_. reg_covar is relative to the variance of the samples.
+    """
+
+    def __init__(self, n_components, tol=1e-8, max_iter=500, reg_covar=1e-6):
+        self.n_components = n_components
+        self.tol = tol
+        self.max_iter = max_iter
+        self.reg_covar = reg_covar
+
+    def fit_binned(self, counts, means, sq_dev, init=None):
+        """
+        Runs EM on the bins of bin_samples.
+
+        Args:
+            counts, means, sq_dev (np.ndarray): binned samples.
+            init (tuple): optional initial (weights, means, variances), by default the quantile groups of the samples.
+        """
+        weights, mu, var = init if init is not None else self._quantile_init(counts, means, sq_dev)
+        loc, scale, x, within = _standardize(counts, means, sq_dev)
+        params = np.array([[weights, (np.asarray(mu) - loc) / scale, np.asarray(var) / scale ** 2]], dtype=np.float64)
+
+        log_likelihood, params, n_iter = _fit_em(counts[None, :], x, within, params, self.reg_covar, self.tol, self.max_iter)
+
+        weights, mu, var = params[0]
+        self.weights_, self.means_, self.variances_ = weights, mu * scale + loc, var * scale ** 2
+        self.n_samples_ = counts.sum()
+        # log-likelihood of the samples in their own units
+        self.log_likelihood_ = (log_likelihood[0] - np.log(scale)) * self.n_samples_
+        self.n_iter_ = n_iter
+        self.converged_ = n_iter < self.max_iter
+        return self
+
+    def fit(self, x, n_bins=N_BINS):
+        """
+        Fits the mixture to the samples x (any shape, flattened).
+        """
+        return self.fit_binned(*bin_samples(x, n_bins))
+
+    def _quantile_init(self, counts, means, sq_dev):
+        # one component per quantile group of the samples
+        group = np.minimum((np.cumsum(counts) - counts / 2) / counts.sum() * self.n_components,
+                           self.n_components - 1).astype(np.intp)
+        nk = np.bincount(group, weights=counts, minlength=self.n_components) + np.finfo(np.float64).eps
+        mu = np.bincount(group, weights=counts * means, minlength=self.n_components) / nk
+        var = np.bincount(group, weights=sq_dev + counts * (means - mu[group]) ** 2, minlength=self.n_components) / nk
+        return nk / nk.sum(), mu, np.maximum(var, np.finfo(np.float64).tiny)
+
+    def split_init(self):
+        """
+        Warm start of a K+1 mixture: the fitted components, with the widest one split in two around its mean.
+        """
+        k = np.argmax(self.weights_ * np.sqrt(self.variances_))
+        std = np.sqrt(self.variances_[k])
+        weights = np.append(self.weights_, self.weights_[k] / 2)
+        weights[k] /= 2
+        mu = np.append(self.means_, self.means_[k] + std / 2)
+        mu[k] -= std / 2
+        var = np.append(self.variances_, self.variances_[k] * 0.75)
+        var[k] *= 0.75
+        return weights, mu, var
+
+    def n_parameters(self):
+        return 3 * self.n_components - 1
+
+    def bic(self, x=None):
+        """
+        Bayesian information criterion of the fit (x is accepted for compatibility with sklearn and ignored,
+        the criterion is computed on the fitted samples).
+        """
+        return -2 * self.log_likelihood_ + self.n_parameters() * np.log(self.n_samples_)
+
+    def score_samples(self, x):
+        """
+        Log density of the mixture at x, flattened.
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        return _logsumexp(_log_components(x, self.weights_, self.means_, self.variances_))
+
+
+def fit_mixtures(x, k_values=(1, 2, 3), n_bins=N_BINS, workers=None):
+    """
+    Fits a BinnedGaussianMixture for each candidate number of components, in parallel.
+    Each K is fitted from the quantile groups of the samples and, warm-started, from the K-1 fit with its widest
+    component split; the fit with the highest likelihood is kept.
+
+    Args:
+        x (np.ndarray): samples.
+        k_values (iterable): candidate numbers of components.
+        n_bins (int): histogram resolution.
+        workers (int): threads fitting the candidates (one per fit by default).
+
+    Returns:
+        dict: {K: BinnedGaussianMixture}
+    """
+    binned = bin_samples(x, n_bins)
+    k_values = sorted(k_values)
+
+    def fit(k, init=None):
+        return BinnedGaussianMixture(k).fit_binned(*binned, init=init)
+
+    with ThreadPoolExecutor(max_workers=workers or len(k_values)) as executor:
+        fits = dict(zip(k_values, executor.map(fit, k_values)))
+        warm = {k: executor.submit(fit, k, fits[k - 1].split_init()) for k in k_values if k - 1 in fits}
+        for k, future in warm.items():
+            if future.result().log_likelihood_ > fits[k].log_likelihood_:
+                fits[k] = future.result()
+
+    return fits
+
+
+def select_mixture(x, k_values=(1, 2, 3), n_bins=N_BINS, workers=None):
+    """
+    Fits the candidate numbers of components (fit_mixtures) and returns the mixture with the lowest BIC.
+    """
+    fits = fit_mixtures(x, k_values, n_bins, workers)
+    bics = {k: gmm.bic() for k, gmm in fits.items()}
+    best = min(bics, key=bics.get)
+    logging.info("Mixture BIC by number of components: %s -> K=%s", {k: round(float(b), 1) for k, b in bics.items()}, best)
+    return fits[best]
+
+
+def bootstrap_mixture(gmm, x, n_resamples=2000, seed=0, n_bins=N_BINS, workers=None):
+    """
+    Bootstrap of a fitted mixture: refits the mixture on resamples (with replacement) of the samples.
+
+    A resample of the samples is drawn as a multinomial resample of the bin counts, and the replicates are fitted
+    together by the batched EM, warm-started from the fit, in chunks run by a thread pool. Each chunk has its own
+    seed derived from seed, so the replicates do not depend on the number of workers.
+
+    Args:
+        gmm (BinnedGaussianMixture): mixture fitted on x.
+        x (np.ndarray): samples.
+        n_resamples (int): number of bootstrap replicates.
+        seed (int): seed of the resampling.
+        n_bins (int): histogram resolution, the same as the fit.
+        workers (int): threads fitting the chunks of replicates.
+
+    Returns:
+        means, weights (np.ndarray): (n_resamples, K) means and weights of the replicates, components sorted by mean.
+    """
+    counts, means, sq_dev = bin_samples(x, n_bins)
+    loc, scale, x, within = _standardize(counts, means, sq_dev)
+    init = np.array([gmm.weights_, (gmm.means_ - loc) / scale, gmm.variances_ / scale ** 2])
+    n = int(counts.sum())
+
+    def fit_chunk(size, chunk_seed):
+        resampled = np.random.default_rng(chunk_seed).multinomial(n, counts / n, size=size).astype(np.float64)
+        _, params, _ = _fit_em(resampled, x, within, np.repeat(init[None], size, axis=0),
+                               gmm.reg_covar, gmm.tol, gmm.max_iter)
+        return params
+
+    sizes = [min(BOOTSTRAP_CHUNK, n_resamples - start) for start in range(0, n_resamples, BOOTSTRAP_CHUNK)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        params = np.concatenate(list(executor.map(fit_chunk, sizes, np.random.SeedSequence(seed).spawn(len(sizes)))))
+
+    # order the components by mean, so the replicates are comparable
+    order = np.argsort(params[:, 1], axis=1)
+    return (np.take_along_axis(params[:, 1], order, axis=1) * scale + loc,
+            np.take_along_axis(params[:, 0], order, axis=1))
@@ -0,0 +1,162 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from load_data import close_stacks, read_preprocessed_stacks, preprocessed_stack_paths
+from segmentation import read_segmentation_mask, segmentation_mask_path
+from analysis import process_fov, write_processed_data, append_processed_data
+from stats import update_fov_stats
+from cells import CellTable
+from report import profile_path
+import profiling
+from log_setup import init_worker_logging, worker_logging_args
+
+
+def fov_input_paths(file_name, Path_settings, from_raw=False):
+    """
+    Returns the paths of the input files of a field of view: GFP and RFP stacks (or raw stack) and mask.
+    """
+    if from_raw:
+        stack_paths = [os.path.join(Path_settings["input_dir"], file_name)]
+    else:
+        stack_paths = list(preprocessed_stack_paths(file_name, Path_settings))
+    return stack_paths + [segmentation_mask_path(file_name, Path_settings)]
+
+
+def process_file(file_name, config, cache=None):
+    """
+    Loads and analyses a single field of view. Runs in a worker process, so only the table of the cells is sent back.
+
+    Args:
+        file_name (str): name of the raw .TIF file.
+        config (dict): full configuration.
+        cache (ResultCache): if given, the cells are loaded from the cache when the inputs and settings 
+        of the field of view are unchanged, and saved to the cache otherwise.
+
+    Returns:
+        table (CellTable): the cells of the field of view, empty if the stacks or the mask could not be loaded.
+    """
+    Path_settings = config["Path_settings"]
+    Execution_settings = config.get("Execution_settings", {})
+    lazy = Execution_settings.get("lazy_loading", False)
+    from_raw = Execution_settings.get("direct_from_raw", False)
+    # the intensity profiles of the report are cached with the cells
+    profiles_path = (profile_path(Path_settings["output_dir"], file_name)
+                     if config["active_slice_settings"]["plot_intensity_profile"] else None)
+
+    key = None
+    if cache is not None:
+        with profiling.stage("cache_lookup", file_name) as span:
+            try:
+                key = cache.key(file_name, fov_input_paths(file_name, Path_settings, from_raw), config)
+            except OSError as e:
+                # missing input, reported by the loaders below
+                logging.debug("No cache key for %s: %s", file_name, e)
+                table = None
+            else:
+                table = cache.get(key)
+                if table is not None and len(table) and profiles_path is not None and not cache.get_profiles(key, profiles_path):
+                    # entry without its profiles (evicted), analysed again to plot them
+                    table = None
+            if table is not None:
+                span["cells"] = len(table)
+        if table is not None:
+            logging.info("Loaded %s cells of %s from the cache.", len(table), file_name,
+                         extra={"event": "fov_cached", "fov": file_name, "cells": len(table)})
+            return table
+
+    channels = read_preprocessed_stacks(file_name, Path_settings, lazy, from_raw)
+    if channels is None:
+        return CellTable.empty()
+
+    try:
+        mask = read_segmentation_mask(file_name, Path_settings)
+        if mask is None:
+            return CellTable.empty()
+        table = process_fov(file_name, channels, mask, config)
+    finally:
+        # the workers process many fields of view, the files of the lazy stacks are not left open
+        close_stacks(channels)
+    if key is not None:
+        cache.put(key, table, profiles_path if len(table) else None)
+
+    return table
+
+
+def process_file_task(file_name, config, cache=None):
+    """
+    Runs process_file in a worker process and returns (table, profiling spans of the field of view), the spans are 
+    merged into the profile of the run by processing_parallel.
+    """
+    with profiling.collect(config.get("Profiling_settings", {}).get("enabled", False)) as profiler:
+        table = process_file(file_name, config, cache)
+    return table, profiler.spans
+
+
+def processing_parallel(file_names, config, workers, cache=None, fov_stats=None, report=None, stream=False):
+    """
+    Parallel version of processing: fans the fields of view out to a pool of worker processes, each one loading
+    and analysing a single field of view, and merges the cells in a stable order (file name, cell ID).
+    The output csv file is the same as a serial run. With a single worker, the fields of view are processed 
+    one at a time in the main process.
+
+    The fields of view are submitted in file name order and their results are taken in the same order (the results
+    completed ahead wait in their futures), so the rows can be written as they come back.
+
+    Args:
+        file_names (list): names of the raw .TIF files to process.
+        config (dict): full configuration.
+        workers (int): number of worker processes.
+        cache (ResultCache): optional per field of view result cache (see process_file).
+        fov_stats (GroupedStats): optional mergeable statistics, updated with the copy numbers of each field of view.
+        report (ProfileReport): optional intensity profile report, each field of view is added as its cells come back.
+        stream (bool): append the rows of each field of view to the output csv file as they come back (as
+        processing_stream), instead of writing all the rows at the end.
+
+    Returns:
+        table (CellTable): same as processing.
+    """
+    Path_settings = config["Path_settings"]
+    output_path = os.path.join(Path_settings["output_dir"],Path_settings["output_name"])
+    # the cells of a field of view are in cell ID order, the fields of view are taken in file name order
+    file_names = sorted(file_names)
+
+    # start from an empty output file, rows are appended per field of view
+    if stream and os.path.exists(output_path):
+        os.remove(output_path)
+
+    tables = []
+
+    def add_table(file_name, table):
+        if stream and len(table):
+            append_processed_data(table, output_path, header=not any(len(previous) for previous in tables))
+        tables.append(table)
+        if len(table):
+            update_fov_stats(fov_stats, file_name, table['copy_number'], Path_settings)
+            if report is not None:
+                report.add(file_name)
+
+    if workers > 1:
+        logging.info("Processing %s fields of view with %s workers.", len(file_names), workers)
+        # the workers send their log records to the listener of the main process (see log_setup.py)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging,
+                                 initargs=worker_logging_args()) as executor:
+            tasks = executor.map(process_file_task, file_names, repeat(config), repeat(cache))
+            for file_name, (table, spans) in zip(file_names, tasks):
+                profiling.get_profiler().spans.extend(spans)
+                add_table(file_name, table)
+    else:
+        for file_name in file_names:
+            add_table(file_name, process_file(file_name, config, cache))
+
+    if cache is not None:
+        cache.evict()
+
+    table = CellTable.concat(tables)
+    if not len(table):
+        logging.error("No cells were processed. Aborting processing.")
+        raise ValueError("Parallel processing resulted in an empty dataset.")
+
+    if not stream:
+        write_processed_data(table, output_path)
+    return table
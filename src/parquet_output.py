@@ -0,0 +1,125 @@
+import os
+import logging
+from datetime import datetime
+from urllib.parse import quote
+from uuid import uuid4
+from cells import OPTIONAL_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:  # optional dependency, only needed for the parquet output
+    pa = None
+    ds = None
+
+PARTITIONS = ["protein_name", "condition"]
+
+
+def processed_data_schema():
+    """
+    Arrow schema of the processed data, with typed columns and a list column for the active slices.
+    The copy number interval columns are nullable.
+    """
+    return pa.schema([
+        ("run_id", pa.string()),
+        ("file_name", pa.string()),
+        ("cell_id", pa.int32()),
+        ("focal_slice", pa.int32()),
+        ("focal_intensity", pa.float64()),
+        ("threshold_intensity", pa.float64()),
+        ("active_slices", pa.list_(pa.int32())),
+        # exact sums of the pixel intensities, as in the csv file
+        ("total_intensity", pa.int64()),
+        ("total_background", pa.int64()),
+        ("total_intensity_normal", pa.float64()),
+        ("copy_number", pa.float64()),
+        # copy number interval, null when single_mNG_intensity_ci is not set
+        ("copy_number_ci_low", pa.float64(), True),
+        ("copy_number_ci_high", pa.float64(), True),
+        ("protein_name", pa.string()),
+        ("condition", pa.string()),
+    ])
+
+
+def to_arrow(table, protein_name, condition, run_id):
+    """
+    Converts the processed cells to an arrow table, from the columns of the CellTable (CellTable.to_arrow: the
+    numeric columns are not copied and the active slices list column is built from the bitmask).
+
+    Args:
+        table (CellTable): processed cells, output of processing.
+        protein_name, condition (str): partition values of the run.
+        run_id (str): identifier of the run.
+
+    Returns:
+        pyarrow.Table with the processed_data_schema.
+    """
+    cells = table.to_arrow()
+    constants = {"run_id": run_id, "protein_name": protein_name, "condition": condition}
+    schema = processed_data_schema()
+    columns = []
+    for field in schema:
+        if field.name in constants:
+            columns.append(pa.array([constants[field.name]] * len(table), type=field.type))
+        elif field.name in OPTIONAL_COLUMNS:
+            # NaN for the cells without interval (concatenated tables), null when no interval is configured
+            columns.append(pa.array(table[field.name], type=field.type, from_pandas=True) if field.name in table.columns
+                           else pa.nulls(len(table), type=field.type))
+        else:
+            columns.append(cells.column(field.name).cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def save_parquet_dataset(table, dataset_dir, Path_settings, run_id=None):
+    """
+    Appends the processed data of a run to a parquet dataset partitioned by protein_name/condition
+    (hive layout: dataset_dir/protein_name=.../condition=.../<run_id>-0.parquet).
+
+    Args:
+        table (CellTable): processed cells, output of processing.
+        dataset_dir (str): root directory of the dataset, shared by the runs.
+        Path_settings (config dict): protein_name and condition of the run.
+        run_id (str): identifier of the run. Saving a run again with the same id replaces it. By default a timestamp
+        with a random suffix, so the runs started in the same second do not replace each other.
+
+    Returns:
+        run_id (str)
+
+    Raises:
+        FileExistsError: if the file of a default run_id already exists.
+    """
+    if pa is None:
+        raise ImportError("The parquet output requires the pyarrow package.")
+
+    if run_id is None:
+        run_id = f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{uuid4().hex[:8]}"
+        # the partition directories are URI-encoded by pyarrow (hive flavor)
+        path = os.path.join(dataset_dir, *(f"{name}={quote(str(Path_settings[name]), safe='')}" for name in PARTITIONS),
+                            f"{run_id}-0.parquet")
+        if os.path.exists(path):
+            raise FileExistsError(f"The parquet dataset already has a run {run_id}: {path}")
+    arrow_table = to_arrow(table, Path_settings["protein_name"], Path_settings["condition"], run_id)
+
+    ds.write_dataset(arrow_table, dataset_dir, format="parquet",
+                     partitioning=PARTITIONS, partitioning_flavor="hive",
+                     basename_template=f"{run_id}-{{i}}.parquet",
+                     existing_data_behavior="overwrite_or_ignore")
+    logging.info("Appended %s cells of run %s to the parquet dataset %s.", len(table), run_id, dataset_dir)
+
+    return run_id
+
+
+def load_parquet_dataset(dataset_dir, filter=None, columns=None):
+    """
+    Loads the parquet dataset (all the runs) as a pandas dataframe.
+
+    Args:
+        dataset_dir (str): root directory of the dataset.
+        filter (pyarrow.dataset.Expression): optional row filter, e.g. ds.field("protein_name") == "Rfa1".
+        columns (list): optional subset of the columns to read.
+    """
+    if ds is None:
+        raise ImportError("The parquet output requires the pyarrow package.")
+
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning="hive")
+    return dataset.to_table(filter=filter, columns=columns).to_pandas()
@@ -1,23 +1,13 @@
 import os
-import tiffile
-from preprocess import preprocessing
-from load_data import load_preprocessed_data
-from segmentation import load_segmentation_mask
-from analysis import processing
-from plots import plot_copy_number_distribution
-from stats import compute_stats
-from save_metadata import save_full_metadata
 import logging
 import json
-import numpy as np
-from get_mNG_intensity import get_single_mNG_intensity
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+import argparse
+import profiling
+from log_setup import setup_logging
+
+# The stage modules (and their heavy dependencies: scipy, matplotlib, pandas, pyarrow) are imported in the stages 
+# that use them, so the stages turned off in the config do not slow down the startup.
+
 # Define CONFIG_PATH relative to this file's location
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "config.template.json")
 
@@ -25,7 +15,49 @@ def load_config(config_path="config.json"):
     with open(config_path, "r") as config_file:
         return json.load(config_file)
     
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Protein expression analysis pipeline.")
+    parser.add_argument("--stream", action="store_true",
+                        help="process one field of view at a time and append the rows to the output csv file as they are produced.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes analysing the fields of view in parallel (default: 1, serial).")
+    parser.add_argument("--lazy", action="store_true",
+                        help="memory-map the GFP and RFP stacks (or read their slices on demand) instead of reading them in memory.")
+    parser.add_argument("--from-raw", action="store_true",
+                        help="read the raw dual-view stacks and split them in memory, instead of the GFP and RFP stacks written by the preprocessing.")
+    parser.add_argument("--z-chunk", type=int, default=None,
+                        help="read the stacks this number of slices at a time during the reduction, for the stacks larger than the memory (implies --lazy).")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory of the per field of view result cache, only the fields of view with changed inputs or settings are processed again.")
+    parser.add_argument("--profile", action="store_true",
+                        help="record the wall time, CPU time, peak memory, bytes read and written and cells/s of each stage and field of view in the metadata.")
+    parser.add_argument("--trace", action="store_true",
+                        help="same as --profile, and also save the stages as a Chrome trace (profile_trace.json in the output directory).")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="catalog the input files and report the missing files and the estimated memory per field of view, without loading any pixels.")
+    parser.add_argument("--log-level", default=None, choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="level of the log records (default: level of the Logging_settings, or INFO).")
+    parser.add_argument("--log-cells", action="store_true",
+                        help="also log the per-cell detail records (by default one summary per field of view is logged).")
+    return parser.parse_args(argv)
+
+def iter_fovs(Path_settings, lazy=False, from_raw=False, file_names=None):
+    """
+    Yields (file_name, {'GFP': GFP_stack, 'RFP': RFP_stack}, mask) for each field of view, loading one field of view at a time.
+    """
+    from load_data import close_stacks, iter_preprocessed_data
+    from segmentation import read_segmentation_mask
+
+    for file_name, channels in iter_preprocessed_data(Path_settings, lazy, from_raw, file_names):
+        mask = read_segmentation_mask(file_name, Path_settings)
+        if mask is None:
+            close_stacks(channels)
+            continue
+        yield file_name, channels, mask
+
+def main(argv=None):
+
+    args = parse_args(argv)
 
     # Extract paths from config
     config = load_config(CONFIG_PATH)
@@ -33,57 +65,175 @@ def main():
     Path_settings = config["Path_settings"]
     Plot_settings = config["Plot_settings"]
     output_dir = Path_settings["output_dir"]
+    # command line options override the Logging_settings of the config, records are also saved as JSON lines in the output directory
+    Logging_settings = config.setdefault("Logging_settings", {})
+    if args.log_level is not None:
+        Logging_settings["level"] = args.log_level
+    if args.log_cells:
+        Logging_settings["cell_details"] = True
+    setup_logging(Logging_settings, output_dir)
+    # command line options override the Execution_settings of the config (and are saved in the metadata)
+    Execution_settings = config.setdefault("Execution_settings", {})
+    if args.stream:
+        Execution_settings["stream"] = True
+    if args.workers is not None:
+        Execution_settings["workers"] = args.workers
+    if args.lazy:
+        Execution_settings["lazy_loading"] = True
+    if args.from_raw:
+        Execution_settings["direct_from_raw"] = True
+    if args.cache_dir is not None:
+        Execution_settings["cache_dir"] = args.cache_dir
+    if args.z_chunk is not None:
+        Execution_settings["z_chunk_size"] = args.z_chunk
+    if Execution_settings.get("z_chunk_size"):
+        # the chunked reduction reads the slices of lazily opened stacks, the stacks are never read whole
+        Execution_settings["lazy_loading"] = True
+    stream = Execution_settings.get("stream", False)
+    workers = Execution_settings.get("workers", 1)
+    lazy = Execution_settings.get("lazy_loading", False)
+    from_raw = Execution_settings.get("direct_from_raw", False)
+    cache_dir = Execution_settings.get("cache_dir")
+    # command line options override the Profiling_settings of the config (off by default)
+    Profiling_settings = config.setdefault("Profiling_settings", {})
+    if args.profile or args.trace:
+        Profiling_settings["enabled"] = True
+    if args.trace:
+        Profiling_settings["chrome_trace"] = True
+    profiler = profiling.configure(Profiling_settings)
+    if cache_dir:
+        from cache import ResultCache
+        cache = ResultCache(cache_dir, Execution_settings.get("cache_max_size_mb", 1024))
+    else:
+        cache = None
+
+    # Dry run: catalog the inputs and report the missing files and the memory estimates, without loading any pixels
+    if args.dry_run:
+        from catalog import update_catalog, dry_run_report
+        dry_run_report(update_catalog(Path_settings, from_raw), Execution_settings)
+        return
 
     # Setep 0: Get the single mNG intensity if required (Optional)
     if config["get_single_mNG_intensity"]["integrated_intensity_analysis"]:
         logging.info("Starting integrated intensity analysis to get single mNG intensity...")
+        from get_mNG_intensity import get_single_mNG_intensity
         single_mNG_intensity = get_single_mNG_intensity(config["get_single_mNG_intensity"])
 
         if single_mNG_intensity is not None:
-            logging.info(f"Integrated intensity analysis completed. Single mNG intensity: {single_mNG_intensity:.2f}, check plot saved in output_dir")
+            logging.info("Integrated intensity analysis completed. Single mNG intensity: %.2f, check plot saved in output_dir", single_mNG_intensity)
         else:
             logging.error("Integrated intensity analysis failed. Aborting processing.")
         return
     else:
-        logging.info(f"Skipping integrated intensity analysis as per configuration. Using existing single mNG intensity value.")
+        logging.info("Skipping integrated intensity analysis as per configuration. Using existing single mNG intensity value.")
     
 
-    # Step 1: Loading the preprocessed data 
-    logging.info("Loading GFP and RFP stacks...")
-    image_stacks_dict = load_preprocessed_data(Path_settings)
-    if not image_stacks_dict:
-        logging.error("No image stacks were loaded. Aborting processing.")
-        raise ValueError("Empty image_stacks dictionary.")
-    else:
-        logging.info("Loading GFP and RFP stacks completed.")
-
-    # Step 2: Load segmentation masks
-    logging.info("Loading segmentation masks...")
-    masks_dict = load_segmentation_mask(Path_settings)
-    if not masks_dict:
-        logging.error("Loading masks failed.")
-        raise ValueError("Segmentation resulted in an empty dataset.")
-    logging.info(f"Loaded {len(masks_dict)} masks. Moving to processing.")
-
-
-    # step 3: Processing the data
-    logging.info("Processing started...")
-    final_processed_data = processing(image_stacks_dict, masks_dict, config)
-    logging.info(f"Processing completed successfully for {len(final_processed_data)} cells.")
+    # Dataset catalog: the input directories are listed once and only the headers of the new or changed files are read,
+    # the fields of view with all their inputs are processed
+    from catalog import update_catalog, plan_memory
+    with profiler.stage("catalog"):
+        catalog = update_catalog(Path_settings, from_raw)
+    file_names = catalog.file_names(from_raw)
+    logging.info("%s fields of view to process, estimated peak memory %.1f MB.", len(file_names), plan_memory(catalog, Execution_settings)['peak'] / 2**20)
+
+    # mergeable statistics of the copy numbers, updated per field of view during the processing
+    from stats import GroupedStats, STATS_FILE
+    fov_stats = GroupedStats() if config['stats_summary'] else None
+
+    # Optional: intensity profile report of the cells, rendered off-screen in the background from the profiles saved
+    # during the analysis, one field of view at a time as they are analysed
+    report = None
+    if config["active_slice_settings"]["plot_intensity_profile"]:
+        from report import ProfileReport
+        report = ProfileReport(output_dir, config.get("Report_settings"))
+
+    try:
+        with profiler.stage("processing") as span:
+            if workers > 1 or cache is not None:
+                # Steps 1-3 one field of view per task (in parallel with several workers, or reusing the cached results), 
+                # rows merged in (file name, cell ID) order, and appended to the csv file as they come back with --stream
+                logging.info("Per field of view processing started...")
+                from parallel import processing_parallel
+                processed_table = processing_parallel(file_names, config, workers, cache, fov_stats, report, stream)
+                logging.info("Processing completed successfully for %s cells.", len(processed_table))
+
+            elif stream:
+                # Steps 1-3 one field of view at a time: load, segment, measure and append the rows to the csv file
+                logging.info("Streaming processing started...")
+                from analysis import processing_stream
+                processed_table = processing_stream(iter_fovs(Path_settings, lazy, from_raw, file_names), config, fov_stats, report)
+                logging.info("Processing completed successfully for %s cells.", len(processed_table))
+
+            else:
+                # Step 1: Loading the preprocessed data 
+                logging.info("Loading GFP and RFP stacks...")
+                from load_data import load_preprocessed_data
+                from segmentation import load_segmentation_mask
+                from analysis import processing
+                image_stacks_dict = load_preprocessed_data(Path_settings, lazy, from_raw, file_names)
+                if not image_stacks_dict:
+                    logging.error("No image stacks were loaded. Aborting processing.")
+                    raise ValueError("Empty image_stacks dictionary.")
+                else:
+                    logging.info("Loading GFP and RFP stacks completed.")
+
+                # Step 2: Load segmentation masks
+                logging.info("Loading segmentation masks...")
+                masks_dict = load_segmentation_mask(Path_settings, file_names)
+                if not masks_dict:
+                    logging.error("Loading masks failed.")
+                    raise ValueError("Segmentation resulted in an empty dataset.")
+                logging.info("Loaded %s masks. Moving to processing.", len(masks_dict))
+
+
+                # step 3: Processing the data
+                logging.info("Processing started...")
+                processed_table = processing(image_stacks_dict, masks_dict, config, fov_stats, report)
+                logging.info("Processing completed successfully for %s cells.", len(processed_table))
+            span["cells"] = len(processed_table)
+    except BaseException:
+        # the rendering processes are stopped and the PDF is closed with the pages rendered so far
+        if report is not None:
+            report.abort()
+        raise
+
+    # waits for the last pages of the intensity profile report
+    if report is not None:
+        logging.info("Finishing the intensity profile report...")
+        with profiler.stage("report"):
+            report.close()
+
+    # Optional: append the run to the parquet dataset shared by the runs
+    parquet_dataset_dir = Path_settings.get("parquet_dataset_dir")
+    if parquet_dataset_dir:
+        from parquet_output import save_parquet_dataset
+        with profiler.stage("parquet"):
+            save_parquet_dataset(processed_table, parquet_dataset_dir, Path_settings)
 
     # step 4: Plots ans Stats
-    copy_numbers = np.array(final_processed_data['Copy Number'])
+    copy_numbers = processed_table['copy_number']
     if config['stats_summary']:
         logging.info('Providing stats summary')
-        compute_stats(copy_numbers, output_dir)
+        from stats import compute_stats
+        with profiler.stage("stats"):
+            compute_stats(copy_numbers, output_dir)
+            fov_stats.save(os.path.join(output_dir, STATS_FILE))
 
     if config['plot_copy_number']:
         logging.info('starting the plotting of copy number')
-        plot_copy_number_distribution(copy_numbers, output_dir, Plot_settings)
+        from plots import plot_copy_number_distribution
+        with profiler.stage("plots"):
+            plot_copy_number_distribution(copy_numbers, output_dir, Plot_settings)
 
     # step 5: save metadata 
-    logging.info(f"Saved metadata to: {output_dir}")
-    save_full_metadata(config, output_dir)
+    from save_metadata import save_full_metadata
+    logging.info("Saved metadata to: %s", output_dir)
+    if profiler.enabled:
+        # Optional: profile of the stages and fields of view, saved with the metadata
+        profiler.log_summary()
+        if Profiling_settings.get("chrome_trace"):
+            profiler.save_chrome_trace(os.path.join(output_dir, profiling.TRACE_FILE))
+    save_full_metadata(config, output_dir, profiler.summary() if profiler.enabled else None)
 
 
 
@@ -1,17 +1,10 @@
 import os
 import logging
 import json
-from plots import plot_copy_number_distribution
-import pandas as pd
-import numpy as np
-from save_metadata import save_full_metadata
+import argparse
+from log_setup import setup_logging
 
 
-
-# set up logging configuration
-logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S')
-
 # Define CONFIG_PATH relative to this file's location
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "config.json")
 
@@ -20,19 +13,50 @@ def load_config(config_path = CONFIG_PATH):
         return json.load(f)
 
 
-def main():
-    logging.info("Loading configuration...")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Plot the copy number distribution of processed results.")
+    parser.add_argument("--compare", nargs="+", metavar="LABEL=CSV", default=None,
+                        help="compare the copy number distributions of several processed data csv files in one figure, e.g. Rfa1_untreated=run1/processed_data.csv.")
+    parser.add_argument("--layout", choices=["overlay", "facet"], default=None,
+                        help="layout of the comparison figure (default: comparison_layout of the Plot_settings, or overlay).")
+    return parser.parse_args(argv)
+
+
+def load_copy_numbers(csv_path):
+    import pandas as pd
+    # only the copy number column is read
+    return pd.read_csv(csv_path, usecols=['Copy Number'])['Copy Number'].to_numpy()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # numpy, pandas and matplotlib are imported once the arguments are parsed
+    import numpy as np
+    import pandas as pd
+    from plots import plot_copy_number_distribution, plot_copy_number_comparison
+
     config = load_config(CONFIG_PATH)
     path_settings = config["Path_settings"]
+    setup_logging(config.get("Logging_settings"), path_settings["output_dir"])
+    logging.info("Loaded configuration.")
     plot_settings = config["Plot_settings"]
+
+    if args.compare:
+        result_sets = {}
+        for entry in args.compare:
+            label, _, csv_path = entry.rpartition("=")
+            result_sets[label or os.path.basename(os.path.dirname(os.path.abspath(csv_path)))] = load_copy_numbers(csv_path)
+        logging.info("plotting the comparison of %s result sets...", len(result_sets))
+        plot_copy_number_comparison(result_sets, path_settings["output_dir"], plot_settings, args.layout)
+        return
     output_path = os.path.join(path_settings["output_dir"], path_settings["output_name"])
 
     # Check if the processed data file exists
     if not os.path.exists(output_path):
-        logging.error(f"Processed data file not found at {output_path}. Please run the full pipeline first.")
+        logging.error("Processed data file not found at %s. Please run the full pipeline first.", output_path)
         return
 
-    logging.info(f"loading the data from {output_path}...")
+    logging.info("loading the data from %s...", output_path)
     processed_data = pd.read_csv(output_path)
 
     if 'Copy Number' not in processed_data.columns:
@@ -52,8 +76,9 @@ def main():
 
 
     # save the metadata 
+    from save_metadata import save_full_metadata
     output_dir = path_settings["output_dir"]
-    logging.info(f"Saved metadata to: {output_dir}")
+    logging.info("Saved metadata to: %s", output_dir)
     save_full_metadata(config, output_dir)
 
 
@@ -1,64 +1,214 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy import stats
 import numpy as np
 import logging
 import os
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# formats of the saved figures
+FIGURE_FORMATS = ("png", "svg")
+
+# resolution of the binned kernel density estimate
+KDE_GRID = 512
+
+
+def binned_kde(values, value_range, grid_size=KDE_GRID):
+    """
+    Gaussian kernel density estimate (Scott's bandwidth, as seaborn/scipy) computed on a fine histogram of the values
+    convolved with the kernel, so its cost does not grow with the number of values.
+
+    Returns:
+        grid, density (np.ndarray)
+    """
+    bandwidth = values.std() * values.size ** (-1 / 5)
+    if bandwidth == 0:
+        return np.array([]), np.array([])
+    lo, hi = value_range[0] - 3 * bandwidth, value_range[1] + 3 * bandwidth
+    counts, edges = np.histogram(values, bins=grid_size, range=(lo, hi))
+    grid = (edges[:-1] + edges[1:]) / 2
+    step = edges[1] - edges[0]
+    half = int(np.ceil(4 * bandwidth / step))
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) * step / bandwidth) ** 2)
+    density = np.convolve(counts, kernel / (kernel.sum() * step * values.size), mode="same")
+    return grid, density
+
+
+def bin_copy_numbers(copy_numbers, bins=20, value_range=None, kde=False):
+    """
+    Pre-bins the copy numbers of a result set: density histogram, normal fit and optional KDE. Only these are drawn,
+    so the rendering time of the figures does not depend on the number of cells, and they are small enough to be sent
+    to the rendering processes.
+
+    Args:
+        copy_numbers (array): copy numbers of the cells (non-finite values are skipped).
+        bins (int or array): number of bins or bin edges.
+        value_range (tuple): optional (min, max) of the bins, to share the bins between result sets.
+        kde (bool): also compute the kernel density estimate.
+
+    Returns:
+        dict: density, edges, n, mean, std (normal fit) and kde (grid, density) or None.
+    """
+    values = np.asarray(copy_numbers, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    density, edges = np.histogram(values, bins=bins, range=value_range, density=True)
+    return {"density": density, "edges": edges, "n": values.size,
+            "mean": values.mean(), "std": values.std(),
+            "kde": binned_kde(values, (edges[0], edges[-1])) if kde else None}
+
+
+def _draw_distribution(ax, binned, plot_settings, label, color, fit_label):
+    ax.bar(binned["edges"][:-1], binned["density"], width=np.diff(binned["edges"]), align="edge",
+           color=color, edgecolor=plot_settings["edgecolor"], alpha=plot_settings["alpha"], label=label)
+    if binned["kde"] is not None:
+        ax.plot(*binned["kde"], color=color, linewidth=1.5)
+    if binned["std"] > 0:
+        x = np.linspace(binned["edges"][0], binned["edges"][-1], 100)
+        pdf = np.exp(-0.5 * ((x - binned["mean"]) / binned["std"]) ** 2) / (binned["std"] * np.sqrt(2 * np.pi))
+        ax.plot(x, pdf, 'k', linewidth=2, label=fit_label)
+
+
+def _label_axes(ax, plot_settings, title=None):
+    ax.set_title(title or plot_settings["title"], fontsize=plot_settings["title_fontsize"])
+    ax.set_xlabel(plot_settings['xlabel'], fontsize=plot_settings["x_fontsize"])
+    ax.set_ylabel(plot_settings["ylabel"], fontsize=plot_settings["y_fontsize"])
+    if plot_settings["add_legened"]:
+        ax.legend()
+
+
+def new_figure(figsize):
+    """
+    Figure on the Agg canvas, outside of pyplot: nothing is shown and the figure is freed with its last reference.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def distribution_figure(binned, plot_settings):
+    """
+    Histogram and normal fit of the copy numbers of one result set (pre-binned by bin_copy_numbers).
+    """
+    fig = new_figure((10, 6))
+    ax = fig.subplots()
+    _draw_distribution(ax, binned, plot_settings, plot_settings["histogram_legend"], plot_settings["color"],
+                       plot_settings["fit_legend"])
+    _label_axes(ax, plot_settings)
+    return fig
+
+
+def comparison_figure(binned_sets, plot_settings, layout="overlay"):
+    """
+    Copy number distributions of several result sets (e.g. protein/condition) in one figure.
+
+    Args:
+        binned_sets (dict): {label: output of bin_copy_numbers}, binned with the same edges.
+        plot_settings (config dict): see plot_copy_number_distribution.
+        layout (str): "overlay" draws the step histograms of all the sets on the same axes, "facet" one panel
+        per set with shared axes.
+    """
+    colors = [f"C{i % 10}" for i in range(len(binned_sets))]
+
+    if layout == "overlay":
+        fig = new_figure((10, 6))
+        ax = fig.subplots()
+        for (label, binned), color in zip(binned_sets.items(), colors):
+            ax.stairs(binned["density"], binned["edges"], color=color, linewidth=2,
+                      label=f"{label} (n={binned['n']})")
+            if binned["kde"] is not None:
+                ax.plot(*binned["kde"], color=color, linewidth=1, linestyle="--")
+        _label_axes(ax, plot_settings)
+        return fig
+
+    if layout == "facet":
+        ncols = min(3, len(binned_sets))
+        nrows = int(np.ceil(len(binned_sets) / ncols))
+        fig = new_figure((5 * ncols, 3.5 * nrows))
+        axes = fig.subplots(nrows, ncols, sharex=True, sharey=True, squeeze=False).ravel()
+        for ax, (label, binned), color in zip(axes, binned_sets.items(), colors):
+            _draw_distribution(ax, binned, plot_settings, f"n={binned['n']}", color, plot_settings["fit_legend"])
+            ax.set_title(label, fontsize=plot_settings["x_fontsize"])
+        for ax in axes[len(binned_sets):]:
+            ax.set_visible(False)
+        fig.suptitle(plot_settings["title"], fontsize=plot_settings["title_fontsize"])
+        fig.supxlabel(plot_settings["xlabel"], fontsize=plot_settings["x_fontsize"])
+        fig.supylabel(plot_settings["ylabel"], fontsize=plot_settings["y_fontsize"])
+        return fig
+
+    raise ValueError(f"Unknown comparison layout: {layout}")
+
+
+def save_figure(builder, args, output_dir, name, formats=FIGURE_FORMATS):
+    """
+    Builds a figure with builder(*args) once and saves it in each format (PNG and SVG by default), in the
+    process, with the Agg canvas. The figures are never shown.
+
+    Returns:
+        list: paths of the saved files.
+    """
+    fig = builder(*args)
+    paths = []
+    for file_format in formats:
+        paths.append(os.path.join(output_dir, f"{name}.{file_format}"))
+        fig.savefig(paths[-1], format=file_format)
+    return paths
 
 
 def plot_copy_number_distribution(copy_numbers, output_dir, plot_settings):
 
     """
-    Generates and saves a plot of the copy number distribution.
-    
+    Generates and saves a plot of the copy number distribution (headless, see save_figure).
+
     args:
      - copy numbers (np array): for all the cells
      - output_dir (str): directory to save the plots
      - plot_settings: (config dict): for plot setting
 
-    
+
     """
 
     if len(copy_numbers) == 0:
         logging.warning("The input copy_numbers list is empty. Nothing was plotted.")
         return
     try:
-
-        # Fit a normal distribution to the data
-        mu, std = stats.norm.fit(copy_numbers)
-
-        # Plot histogram and normal distribution fit
-        plt.figure(figsize=(10, 6))
-
-        sns.histplot(copy_numbers, kde=plot_settings["kde"], alpha=plot_settings['alpha'], bins=plot_settings["bins"], color=plot_settings["color"], edgecolor = plot_settings["edgecolor"], stat="density", label=plot_settings["histogram_legend"])
-        xmin, xmax = plt.xlim()
-        x = np.linspace(xmin, xmax, 100)
-        p = stats.norm.pdf(x, mu, std)
-        plt.plot(x, p, 'k', linewidth=2, label=plot_settings["fit_legend"])
-        plt.title(plot_settings["title"], fontsize = plot_settings["title_fontsize"])
-        plt.xlabel(plot_settings['xlabel'], fontsize = plot_settings["x_fontsize"])
-        plt.ylabel(plot_settings["ylabel"], fontsize = plot_settings["y_fontsize"])
-        if plot_settings["add_legened"]:
-            plt.legend()
-        
-        logging.info('sucsussfully plotted the copy number')
+        binned = bin_copy_numbers(copy_numbers, plot_settings["bins"], kde=plot_settings["kde"])
+        save_figure(distribution_figure, (binned, plot_settings), output_dir, 'copy_number_distribution')
+        logging.info('sucsussfully saved the plot the in the output directory')
 
     except Exception as e:
-        logging.error(f"Error during plotting the copy number: {e}")
-        return
+        logging.error('failed to save the plot the in the output directory: %s', e)
 
-    # Save plot 
-    try:
-        plot_filepath = os.path.join(output_dir, 'copy_number_distribution.png')
-        plt.savefig(plot_filepath, format='png')
-        #plt.close()
 
-        svg_file_path = os.path.join(output_dir, 'copy_number_distribution.svg')
-        plt.savefig(svg_file_path, format='svg')
-        plt.show()
-        #plt.close()
+def plot_copy_number_comparison(result_sets, output_dir, plot_settings, layout=None, name='copy_number_comparison'):
+    """
+    Generates and saves a comparison of the copy number distributions of several result sets, binned with
+    shared bins.
 
-        logging.info('sucsussfully saved the plot the in the output directory')
+    args:
+     - result_sets (dict): {label: copy numbers array}, e.g. one per protein/condition
+     - output_dir (str): directory to save the plots
+     - plot_settings (config dict): for plot setting, "comparison_layout" ("overlay" or "facet") is used if layout is None
+     - name (str): file name of the figure, without extension
 
-    except Exception as e:
-        logging.error(f'failed to save the plot the in the output directory: {e}')
\ No newline at end of file
+    returns:
+     - list: paths of the saved files
+    """
+    layout = layout or plot_settings.get("comparison_layout", "overlay")
+    finite = {}
+    for label, values in result_sets.items():
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size:
+            finite[label] = values
+        else:
+            logging.warning("No copy numbers in the result set %s, skipped in the comparison.", label)
+    if not finite:
+        logging.warning("The result sets are empty. Nothing was plotted.")
+        return []
+    result_sets = finite
+
+    value_range = (min(values.min() for values in finite.values()), max(values.max() for values in finite.values()))
+    binned_sets = {label: bin_copy_numbers(values, plot_settings["bins"], value_range, plot_settings["kde"])
+                   for label, values in result_sets.items()}
+
+    paths = save_figure(comparison_figure, (binned_sets, plot_settings, layout), output_dir, name)
+    logging.info("Saved the comparison of %s result sets: %s", len(binned_sets), ', '.join(paths))
+    return paths
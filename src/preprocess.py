@@ -3,33 +3,24 @@ from tqdm import tqdm
 import numpy as np
 import tifffile
 import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.FileHandler("pipeline.log"),  # Save logs to a file
-        logging.StreamHandler()  # Print logs to the console
-    ]
-)
+
+# stacks above this size are written as BigTIFF when "bigtiff" is "auto" (classic TIFF files are limited to 4 GB)
+BIGTIFF_THRESHOLD = 2**32 - 2**25
+
+# pages waiting in the queue of each stack writer
+WRITER_QUEUE_SIZE = 8
 
 def split_image_stack(image_stack):
     """
     Split each slice in the z-stack into two halves (RFP and GFP).
+    The halves are returned as strided views of the stack (no copy).
     """
-    GFP_stack = []
-    RFP_stack = []
-
-    for image in image_stack:
-        middle_col = image.shape[1]//2
-        # Split each slice into RFP and GFP
-        RFP_stack.append(image[:,:middle_col]) # Left half for RFP
-        GFP_stack.append(image[:,middle_col:]) # Right half for GFP
-    
-    # Convert the lists into numpy arrays (3D stacks)
-    RFP_stack = np.array(RFP_stack)
-    GFP_stack = np.array(GFP_stack)
+    middle_col = image_stack.shape[2]//2
+    RFP_stack = image_stack[:, :, :middle_col] # Left half for RFP
+    GFP_stack = image_stack[:, :, middle_col:] # Right half for GFP
 
     return RFP_stack, GFP_stack
 
@@ -39,25 +30,145 @@ def max_projection(GFP_stack):
     """
     return np.max(GFP_stack, axis = 0)
 
-def save_image(image, file_name, save_dir, suffix):
+def iter_slices(file_path):
+    """
+    Yields the slices of a TIFF stack one page at a time, without reading the whole stack in memory.
+    """
+    with tifffile.TiffFile(file_path) as tif:
+        for page in tif.series[0].pages:
+            yield page.asarray()
+
+def stream_split_projection(slices, GFP_writer=None, RFP_writer=None):
+    """
+    Single pass over the slices of a dual-view stack: splits each slice into RFP and GFP views, 
+    appends them to the RFP and GFP stack writers (if given) and updates the GFP max projection in place.
+    Only one slice is held in memory at a time.
+
+    Args:
+        slices (iterable): 2D slices of the raw stack, e.g. from iter_slices.
+        GFP_writer, RFP_writer (StackWriter): writers of the GFP and RFP stacks, or None to skip writing them.
+
+    Returns:
+        np.ndarray: max projection of the GFP stack.
+    """
+    GFP_projection = None
+    for image in slices:
+        middle_col = image.shape[1]//2
+        RFP_image = image[:, :middle_col] # Left half for RFP
+        GFP_image = image[:, middle_col:] # Right half for GFP
+
+        if GFP_writer is not None:
+            GFP_writer.write(GFP_image)
+        if RFP_writer is not None:
+            RFP_writer.write(RFP_image)
+
+        if GFP_projection is None:
+            GFP_projection = GFP_image.copy()
+        else:
+            np.maximum(GFP_projection, GFP_image, out=GFP_projection)
+
+    return GFP_projection
+
+def write_options(writer_settings, nbytes):
+    """
+    Returns the (TiffWriter, write) keyword arguments for the writer settings:
+    compression (e.g. "zlib", "zstd", "lzw", None), compression_level, predictor, 
+    encoder_threads (threads used by tifffile to encode the strips of a page) and bigtiff (true, false or "auto").
+    """
+    bigtiff = writer_settings.get("bigtiff", "auto")
+    if bigtiff == "auto":
+        bigtiff = nbytes > BIGTIFF_THRESHOLD
+
+    options = {}
+    compression = writer_settings.get("compression")
+    if compression:
+        options["compression"] = compression
+        if writer_settings.get("compression_level") is not None:
+            options["compressionargs"] = {"level": writer_settings["compression_level"]}
+        if writer_settings.get("predictor"):
+            options["predictor"] = True
+        if writer_settings.get("encoder_threads"):
+            options["maxworkers"] = writer_settings["encoder_threads"]
+
+    return {"bigtiff": bool(bigtiff)}, options
+
+def write_tiff(file_path, data, writer_settings, shape=None, dtype=None):
+    """
+    Writes an image, or the pages yielded by an iterator (with their stack shape and dtype), to a TIFF file.
+    """
+    if shape is None:
+        shape, dtype = data.shape, data.dtype
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+    file_options, options = write_options(writer_settings, nbytes)
+    with tifffile.TiffWriter(file_path, **file_options) as tif:
+        tif.write(data, shape=shape, dtype=dtype, **options)
+
+class StackWriter:
+    """
+    Writes a z-stack page by page in a thread of the writer pool, so the writes overlap with the reading and splitting
+    of the next slices and files. The pages are handed over to the thread through a bounded queue.
+    """
+    def __init__(self, executor, file_path, shape, dtype, writer_settings):
+        self.file_path = file_path
+        self._queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.future = executor.submit(write_tiff, file_path, self._pages(), writer_settings, shape, dtype)
+
+    def _pages(self):
+        while True:
+            page = self._queue.get()
+            if page is None:
+                return
+            yield page
+
+    def write(self, page):
+        while True:
+            try:
+                self._queue.put(page, timeout=1)
+                return
+            except queue.Full:
+                # do not wait forever on a writer that failed
+                if self.future.done():
+                    self.future.result()
+                    raise RuntimeError(f"Writer of {self.file_path} stopped")
+
+    def close(self):
+        """
+        Ends the stack. The file is complete once the future is done.
+        """
+        while not self.future.done():
+            try:
+                self._queue.put(None, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+def save_image(image, file_name, save_dir, suffix, writer_settings=None):
     """
     Save any image (RFP stack, GFP stack, GFP projection) to the specified directory.
     """
+    writer_settings = writer_settings or {}
     file_path = os.path.join(save_dir, file_name.replace('.TIF', suffix))
     try:    
-        tifffile.imwrite(file_path, image)
-        logging.info(f"Saved: {file_path}")
-    except:
-        logging.error(f"Failed to save {file_path}: {e}")
+        write_tiff(file_path, image, writer_settings)
+        logging.info("Saved: %s", file_path)
+    except Exception as e:
+        logging.error("Failed to save %s: %s", file_path, e)
 
 
-def preprocessing(path_settings):
+def preprocessing(path_settings, projection_only=False, writer_settings=None):
      """
     Preprocess the images: split the dual channels and create max projections for GFP (to be used for segmentation).
 
     saves the reults into GFP and RFP directory and the projection directory.
+    If projection_only is True, only the GFP projections are saved: for the direct-from-raw analysis, 
+    which reads the GFP and RFP halves from the raw stacks.
+
+    The files are written by a pool of writer threads (writer_settings["threads"]), overlapping with the reading 
+    of the raw stacks, with optional compression and BigTIFF (see write_options).
 
     """
+     writer_settings = writer_settings or {}
      input_dir = path_settings["input_dir"]
      GFP_dir = path_settings["GFP_dir"]
      RFP_dir = path_settings["RFP_dir"]
@@ -66,29 +177,50 @@ def preprocessing(path_settings):
      RFP_suffix = path_settings["RFP_suffix"]
      projection_suffix = path_settings["projection_suffix"]
 
-     os.makedirs(GFP_dir, exist_ok=True)
-     os.makedirs(RFP_dir, exist_ok=True)
+     if not projection_only:
+        os.makedirs(GFP_dir, exist_ok=True)
+        os.makedirs(RFP_dir, exist_ok=True)
      os.makedirs(projected_dir, exist_ok=True)
-     for file_name in tqdm(os.listdir(input_dir)):
-        if file_name.endswith(".TIF") or file_name.endswith(".tif") :
-            file_path = os.path.join(input_dir, file_name)
-            try: 
-                #read the image stacks
-                image_stack = tifffile.imread(file_path)
-
-                # Split the image stack into RFP and GFP channels
-                RFP_stack, GFP_stack = split_image_stack(image_stack)
-
-                # Create max projection of GFP stack
-                GFP_projection = max_projection(GFP_stack)
-
-                # Save the results (split stacks and max projection)
-                save_image(GFP_stack, file_name, GFP_dir, GFP_suffix)
-                save_image(RFP_stack, file_name, RFP_dir, RFP_suffix)
-                save_image(GFP_projection, file_name,projected_dir, projection_suffix)
 
+     # the GFP and RFP writers of a file run at the same time, so at least 2 threads are needed
+     threads = max(2, writer_settings.get("threads", 4))
+     pending = []
+     with ThreadPoolExecutor(max_workers=threads) as executor:
+        for file_name in tqdm(os.listdir(input_dir)):
+            if file_name.endswith(".TIF") or file_name.endswith(".tif") :
+                file_path = os.path.join(input_dir, file_name)
+                writers = []
+                try: 
+                    if not projection_only:
+                        with tifffile.TiffFile(file_path) as tif:
+                            shape, dtype = tif.series[0].shape, tif.series[0].dtype
+                        middle_col = shape[2]//2
+                        GFP_path = os.path.join(GFP_dir, file_name.replace('.TIF', GFP_suffix))
+                        RFP_path = os.path.join(RFP_dir, file_name.replace('.TIF', RFP_suffix))
+                        writers = [StackWriter(executor, GFP_path, shape[:2] + (shape[2] - middle_col,), dtype, writer_settings),
+                                   StackWriter(executor, RFP_path, shape[:2] + (middle_col,), dtype, writer_settings)]
+
+                    # Stream the slices of the image stack: split them into RFP and GFP channels, 
+                    # save the split stacks and create the max projection of the GFP stack in a single pass
+                    GFP_projection = stream_split_projection(iter_slices(file_path), *writers)
+
+                    # Save the max projection
+                    projection_path = os.path.join(projected_dir, file_name.replace('.TIF', projection_suffix))
+                    pending.append((projection_path, executor.submit(write_tiff, projection_path, GFP_projection, writer_settings)))
+
+                except Exception as e:
+                    logging.error("Error processing %s: %s", file_name, e)
+
+                finally:
+                    for writer in writers:
+                        writer.close()
+                        pending.append((writer.file_path, writer.future))
+
+        for file_path, future in pending:
+            try:
+                future.result()
+                logging.info("Saved: %s", file_path)
             except Exception as e:
-                logging.error(f"Error processing {file_name}: {e}")
+                logging.error("Failed to save %s: %s", file_path, e)
 
      logging.info("Preprocessing completed successfully.")
-
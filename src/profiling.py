@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # not available on Windows, the peak RSS is not recorded
+    resource = None
+
+TRACE_FILE = "profile_trace.json"
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _io_counters():
+    """
+    Bytes read and written by the process so far (rchar and wchar of /proc/self/io, including the reads served by
+    the page cache), or (None, None) where /proc is not available.
+    """
+    try:
+        with open("/proc/self/io", "rb") as f:
+            counters = dict(line.split(b":", 1) for line in f.read().splitlines())
+        return int(counters[b"rchar"]), int(counters[b"wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _current_rss():
+    """
+    Resident memory of the process now (bytes), from the resident pages of /proc/self/statm, or None where /proc
+    is not available.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _peak_rss():
+    # high-water mark of the resident memory over the lifetime of the process (bytes), not of a span
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+def _difference(end, start):
+    return None if end is None or start is None else end - start
+
+
+class Profiler:
+    """
+    Records a span (wall time, CPU time, bytes read and written, change of the resident memory and number of cells)
+    for each run of a stage, per field of view. The peak RSS of the process so far is also kept with each span,
+    it is only reported per process. Disabled profilers record nothing, so the instrumented stages cost a context
+    manager call when the profiling is off.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+
+    @contextmanager
+    def stage(self, name, fov=None):
+        """
+        Records the span of a stage. The block can set span["cells"] to the number of cells it processed.
+
+        Args:
+            name (str): name of the stage.
+            fov (str): file name of the field of view, None for the stages of the whole run.
+        """
+        span = {"cells": None}
+        if not self.enabled:
+            yield span
+            return
+
+        read, written = _io_counters()
+        rss = _current_rss()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            end = time.perf_counter()
+            end_read, end_written = _io_counters()
+            span.update({"name": name, "fov": fov, "start": start, "wall_s": end - start,
+                         "cpu_s": time.process_time() - cpu,
+                         "bytes_read": _difference(end_read, read), "bytes_written": _difference(end_written, written),
+                         "rss_delta": _difference(_current_rss(), rss), "peak_rss": _peak_rss(),
+                         "pid": os.getpid(), "tid": threading.get_ident()})
+            self.spans.append(span)
+
+    def summary(self):
+        """
+        Totals of the spans per stage and per field of view: calls, wall_s, cpu_s, bytes_read, bytes_written,
+        cells, cells_per_s and rss_delta_mb (change of the resident memory over the calls), and the peak RSS of
+        each process (main process and workers) over the run.
+
+        Returns:
+            dict: {"stages": {name: totals}, "fovs": {file name: totals}, "processes": {pid: {"peak_rss_mb": MB}}}
+        """
+        stages, fovs, processes = {}, {}, {}
+        for span in self.spans:
+            if span["peak_rss"] is not None:
+                # the high-water mark only grows, the last span of a process holds its peak
+                process = processes.setdefault(str(span["pid"]), {"peak_rss_mb": 0.0})
+                process["peak_rss_mb"] = max(process["peak_rss_mb"], span["peak_rss"] / 2**20)
+            _accumulate(stages.setdefault(span["name"], _totals()), span)
+            if span["fov"] is not None:
+                # the stages of a field of view process the same cells, they are not added up
+                _accumulate(fovs.setdefault(span["fov"], _totals()), span, add_cells=False)
+        for totals in list(stages.values()) + list(fovs.values()):
+            totals["cells_per_s"] = totals["cells"] / totals["wall_s"] if totals["cells"] and totals["wall_s"] else None
+            totals["rss_delta_mb"] = totals.pop("rss_delta") / 2**20 if totals["rss_delta"] is not None else None
+        return {"stages": stages, "fovs": fovs, "processes": processes}
+
+    def log_summary(self):
+        summary = self.summary()
+        for name, totals in summary["stages"].items():
+            throughput = f", {totals['cells_per_s']:.0f} cells/s" if totals["cells_per_s"] else ""
+            logging.info("Profile %s: %s call(s), wall %.3f s, cpu %.3f s%s", name, totals['calls'], totals['wall_s'], totals['cpu_s'], throughput)
+        for pid, process in summary["processes"].items():
+            logging.info("Profile process %s: peak RSS %.1f MB", pid, process['peak_rss_mb'])
+
+    def save_chrome_trace(self, path):
+        """
+        Saves the spans in the Chrome trace event format (chrome://tracing or https://ui.perfetto.dev),
+        one track per process and thread.
+        """
+        origin = min((span["start"] for span in self.spans), default=0)
+        events = [{"name": span["name"], "cat": "fov" if span["fov"] else "run", "ph": "X",
+                   "ts": (span["start"] - origin) * 1e6, "dur": span["wall_s"] * 1e6,
+                   "pid": span["pid"], "tid": span["tid"],
+                   "args": {key: span[key] for key in ("fov", "cells", "cpu_s", "bytes_read", "bytes_written", "rss_delta")}}
+                  for span in self.spans]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logging.info("Saved the Chrome trace of the run to %s", path)
+
+
+def _totals():
+    return {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "bytes_read": None, "bytes_written": None, "cells": 0,
+            "rss_delta": None}
+
+
+def _accumulate(totals, span, add_cells=True):
+    totals["calls"] += 1
+    totals["wall_s"] += span["wall_s"]
+    totals["cpu_s"] += span["cpu_s"]
+    for key in ("bytes_read", "bytes_written", "rss_delta"):
+        if span[key] is not None:
+            totals[key] = (totals[key] or 0) + span[key]
+    if span["cells"]:
+        totals["cells"] = totals["cells"] + span["cells"] if add_cells else max(totals["cells"], span["cells"])
+
+
+# profiler of the process, disabled until the pipeline configures it
+_profiler = Profiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def configure(Profiling_settings=None):
+    """
+    Sets the profiler of the process from the Profiling_settings ("enabled", default false).
+    """
+    global _profiler
+    _profiler = Profiler((Profiling_settings or {}).get("enabled", False))
+    return _profiler
+
+
+def stage(name, fov=None):
+    """
+    Records a span of the stage with the profiler of the process, see Profiler.stage.
+    """
+    return _profiler.stage(name, fov)
+
+
+@contextmanager
+def collect(enabled):
+    """
+    Records the spans of a block with a new profiler, e.g. in a worker process (which inherits the profiler and
+    the spans of the main process), and restores the profiler of the process after the block.
+    """
+    global _profiler
+    previous, _profiler = _profiler, Profiler(enabled)
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
@@ -0,0 +1,203 @@
+import os
+import math
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+PROFILE_DIR = "intensity_profiles"
+
+
+def profile_path(output_dir, file_name):
+    """
+    Path of the saved intensity profiles of a field of view.
+    """
+    return os.path.join(output_dir, PROFILE_DIR, file_name.replace('.TIF', '_profiles.npz'))
+
+
+def save_fov_profiles(output_dir, file_name, cell_ids, GFP_sums, active_slices):
+    """
+    Saves the intensity profiles (per-slice GFP sums), thresholds and focal slices of the cells of a field of view,
+    for the intensity profile report.
+
+    Args:
+        output_dir (str): output directory of the run.
+        file_name (str): name of the raw file of the field of view.
+        cell_ids (list): cell IDs, in the order of the rows of GFP_sums.
+        GFP_sums (np.ndarray): (n_cells, Z) per-slice GFP intensity sums.
+        active_slices (dict): output of find_active_slices_batch.
+    """
+    path = profile_path(output_dir, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, file_name=file_name, cell_ids=np.asarray(cell_ids), GFP_sums=GFP_sums,
+             threshold=active_slices['threshold intensity'], focal=active_slices['focal slice'])
+
+
+def profile_figure(profiles):
+    """
+    Small multiples of the intensity profiles of all the cells of a field of view, on one grid page.
+    Uses the object-oriented interface with the Agg canvas (no pyplot, nothing is shown).
+
+    Args:
+        profiles: loaded .npz of save_fov_profiles.
+
+    Returns:
+        matplotlib.figure.Figure
+    """
+    # matplotlib is only imported by the report stage, saving the profiles during the analysis does not need it
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    cell_ids = profiles['cell_ids']
+    n_cells = len(cell_ids)
+    ncols = max(1, math.ceil(math.sqrt(n_cells)))
+    nrows = max(1, math.ceil(n_cells / ncols))
+
+    fig = Figure(figsize=(2.6 * ncols, 2 * nrows + 0.6), constrained_layout=True)
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows, ncols, squeeze=False).ravel()
+
+    for ax, cell_id, intensity_sums, threshold, focal in zip(axes, cell_ids, profiles['GFP_sums'],
+                                                            profiles['threshold'], profiles['focal']):
+        ax.plot(intensity_sums, linewidth=1)
+        ax.axhline(y=threshold, color='r', linestyle='--', linewidth=0.8)
+        ax.axvline(x=focal, color='g', linestyle='--', linewidth=0.8)
+        ax.set_title(f"Cell {cell_id}", fontsize=8)
+        ax.tick_params(labelsize=6)
+    for ax in axes[n_cells:]:
+        ax.set_visible(False)
+
+    fig.suptitle(f"Intensity profiles in {profiles['file_name']} (red: threshold, green: focal slice)", fontsize=10)
+    return fig
+
+
+def render_png(profile_file, png_path):
+    """
+    Renders the profiles of one field of view to a PNG tile.
+    """
+    with np.load(profile_file) as profiles:
+        fig = profile_figure(profiles)
+    fig.savefig(png_path, dpi=100)
+    return png_path
+
+
+# PdfPages of the report, in the process rendering the pages of a ProfileReport (opened with the first page)
+_pdf_path = None
+_pdf = None
+
+
+def _set_pdf_path(pdf_path):
+    global _pdf_path
+    _pdf_path = pdf_path
+
+
+def _add_pdf_page(profile_file):
+    """
+    Renders the profiles of one field of view to the next page of the PDF of the process.
+    """
+    global _pdf
+    if _pdf is None:
+        from matplotlib.backends.backend_pdf import PdfPages
+        _pdf = PdfPages(_pdf_path)
+    with np.load(profile_file) as profiles:
+        _pdf.savefig(profile_figure(profiles))
+
+
+def _close_pdf():
+    global _pdf
+    if _pdf is not None:
+        _pdf.close()
+        _pdf = None
+
+
+class ProfileReport:
+    """
+    Intensity profile report rendered in the background while the fields of view are analysed: the page (PDF) or
+    tile (PNG) of a field of view is submitted to the rendering processes as soon as its profiles are saved (add),
+    so the report is mostly rendered when the analysis ends (close).
+
+    The pages of the PDF are written in order by a single process holding the open PdfPages, the PNG tiles are
+    rendered by a pool of Report_settings["workers"] processes. The processes are started with the first page.
+    Ends with close, or abort if the analysis fails.
+    """
+
+    def __init__(self, output_dir, Report_settings=None):
+        Report_settings = Report_settings or {}
+        self.output_dir = output_dir
+        self.format = Report_settings.get("format", "pdf")
+        if self.format == "pdf":
+            self.pdf_path = os.path.join(output_dir, "intensity_profiles.pdf")
+            self._executor = ProcessPoolExecutor(max_workers=1, initializer=_set_pdf_path, initargs=(self.pdf_path,))
+        elif self.format == "png":
+            self._executor = ProcessPoolExecutor(max_workers=Report_settings.get("workers", 4))
+        else:
+            raise ValueError(f"Unknown intensity profile report format: {self.format}")
+        self._futures = []
+
+    def add(self, file_name):
+        """
+        Submits the page or tile of a field of view, whose profiles were saved by the analysis (save_fov_profiles).
+        """
+        path = profile_path(self.output_dir, file_name)
+        if not os.path.exists(path):
+            logging.warning("Intensity profiles not found for %s, skipped in the report.", file_name)
+            return
+        if self.format == "pdf":
+            self._futures.append(self._executor.submit(_add_pdf_page, path))
+        else:
+            self._futures.append(self._executor.submit(render_png, path, path.replace('.npz', '.png')))
+
+    def close(self):
+        """
+        Waits for the pages or tiles, closes the PDF and stops the rendering processes.
+
+        Returns:
+            list: paths of the rendered files.
+        """
+        try:
+            if not self._futures:
+                logging.warning("No intensity profiles to report.")
+                return []
+            rendered = [future.result() for future in self._futures]
+            if self.format == "pdf":
+                self._executor.submit(_close_pdf).result()
+                rendered = [self.pdf_path]
+        finally:
+            self._executor.shutdown()
+
+        logging.info("Saved the intensity profile report of %s fields of view: %s%s", len(self._futures), rendered[0], ' ...' if len(rendered) > 1 else '')
+        return rendered
+
+    def abort(self):
+        """
+        Stops the report when the analysis failed: the pages not yet rendered are dropped, the PDF is closed with the
+        pages rendered so far (a valid file) and the rendering processes are stopped.
+        """
+        for future in self._futures:
+            future.cancel()
+        try:
+            if self.format == "pdf":
+                self._executor.submit(_close_pdf).result()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+        logging.warning("The intensity profile report was stopped before the end of the analysis.")
+
+
+def render_profile_report(output_dir, file_names, Report_settings=None):
+    """
+    Renders the intensity profile report of the fields of view at once, from the profiles saved during the analysis
+    (e.g. to render the report of a previous run again). The pipeline renders it during the analysis (ProfileReport).
+
+    Args:
+        output_dir (str): output directory of the run.
+        file_names (list): fields of view in the report.
+        Report_settings (config dict):
+            format (str): "pdf" for a multi-page PDF (intensity_profiles.pdf), "png" for one PNG tile per field of view.
+            workers (int): worker processes rendering the PNG tiles in parallel.
+
+    Returns:
+        list: paths of the rendered files.
+    """
+    report = ProfileReport(output_dir, Report_settings)
+    for file_name in file_names:
+        report.add(file_name)
+    return report.close()
@@ -3,14 +3,9 @@ import tiffile
 from preprocess import preprocessing
 import logging
 import json
+import argparse
+from log_setup import setup_logging
 
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
 # Define CONFIG_PATH relative to this file's location
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "config.json")
 
@@ -18,16 +13,26 @@ def load_config(config_path="config.json"):
     with open(config_path, "r") as config_file:
         return json.load(config_file)
     
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Preprocessing of the raw dual-view stacks.")
+    parser.add_argument("--from-raw", action="store_true",
+                        help="only save the GFP projections, the analysis will read the GFP and RFP halves from the raw stacks.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+
+    args = parse_args(argv)
 
     # Extract paths from config
     config = load_config(CONFIG_PATH)
 
     path_settings = config["Path_settings"]
+    setup_logging(config.get("Logging_settings"), path_settings["output_dir"])
+    projection_only = args.from_raw or config.get("Execution_settings", {}).get("direct_from_raw", False)
 
     # Preprocess raw data (split channels + max projection)
     logging.info("Starting preprocessing of raw images...")
-    image_stacks_dict = preprocessing(path_settings) 
+    image_stacks_dict = preprocessing(path_settings, projection_only, config.get("Writer_settings", {})) 
     logging.info("Preprocessing completed. Proceed with the segmentation")
 
 
@@ -5,8 +5,14 @@ import getpass
 import socket
 from datetime import datetime
 import subprocess
-import pkg_resources
+import re
 import logging
+from importlib import metadata
+
+REQUIREMENTS_PATH = os.path.join(os.path.dirname(__file__), "..", "requirements.txt")
+
+# optional dependencies of the pipeline, not in the requirements
+OPTIONAL_PACKAGES = ("pyarrow", "imagecodecs", "openpyxl")
 
 def get_git_commit_hash():
     try:
@@ -14,10 +20,40 @@ def get_git_commit_hash():
     except Exception:
         return "Not a Git repo or Git not available"
 
-def get_installed_packages():
-    return {pkg.key: pkg.version for pkg in pkg_resources.working_set}
+def required_packages(requirements_path=REQUIREMENTS_PATH):
+    """
+    Names of the packages in the requirements file, and the optional dependencies.
+    """
+    names = []
+    try:
+        with open(requirements_path, "r") as f:
+            for line in f:
+                match = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)", line.split("#", 1)[0])
+                if match:
+                    names.append(match.group(1).lower())
+    except OSError as e:
+        logging.warning("Requirements file not found, only the optional packages are recorded: %s", e)
+    return sorted(set(names) | set(OPTIONAL_PACKAGES))
+
+
+def get_installed_packages(names=None):
+    """
+    Versions of the packages of the pipeline (requirements and optional dependencies) installed in the current
+    environment, None for the packages that are not installed. Only these packages are read with importlib.metadata.
+    """
+    packages = {}
+    for name in names or required_packages():
+        try:
+            packages[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            packages[name] = None
+    return packages
 
-def save_full_metadata(config, output_dir):
+def save_full_metadata(config, output_dir, profile=None):
+    """
+    Saves the metadata of the run (environment, config and optional profile of the stages, see profiling.py)
+    to a timestamped JSON file in output_dir.
+    """
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
     protein_name = config["Path_settings"]["protein_name"]
     condition = config["Path_settings"]["condition"]
@@ -32,6 +68,8 @@ def save_full_metadata(config, output_dir):
         "config_used": config,
         "installed_packages": get_installed_packages()
     }
+    if profile is not None:
+        metadata["profile"] = profile
 
     filename = f"metadata_{protein_name}_{condition}_{timestamp}.json"
     metadata_path = os.path.join(output_dir, filename)
@@ -39,4 +77,4 @@ def save_full_metadata(config, output_dir):
     with open(metadata_path, "w") as f:
         json.dump(metadata, f, indent=2)
 
-    logging.info(f"Saved metadata to: {output_dir}")
+    logging.info("Saved metadata to: %s", output_dir)
@@ -3,20 +3,57 @@ import logging
 import imageio.v2 as imageio
 import numpy as np
 from tqdm import tqdm
+import profiling
+from mask_index import cached_mask_index
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
-        logging.FileHandler("pipeline.log"),  # Save logs to a file
-        logging.StreamHandler()  # Print logs to the console
-    ]
-)
+def segmentation_mask_path(filename, Path_settings):
+    """
+    Returns the path of the segmentation mask of a raw file.
+    """
+    return os.path.join(Path_settings["mask_dir"], filename.replace('.TIF', Path_settings["mask_suffix"]))
+
+
+def read_mask_image(mask_path):
+    """
+    Decodes a segmentation mask (.png) into a uint16 label image.
+    """
+    return np.array(imageio.imread(mask_path), dtype=np.uint16)
+
+
+def read_segmentation_mask(filename, Path_settings):
+    """
+    Reads the index of the segmentation mask of a single raw file: labels, bounding boxes, pixel counts and pixels 
+    of the cells. The index is built once per mask and saved as a .index.npz sidecar next to the mask (or in the 
+    "mask_index_dir" of the Path_settings), the mask is only decoded again when its content changes.
+
+    Args:
+    filename (str): name of the raw .TIF file.
+    Path_settings (config dict): see load_segmentation_mask.
+
+    Returns:
+        MaskIndex: index of the mask (np.asarray(mask) gives the label image), or None if the mask is missing or loading fails.
+    """
+    with profiling.stage("read_mask", filename) as span:
+        mask_path = segmentation_mask_path(filename, Path_settings)
+        mask_filename = os.path.basename(mask_path)
+
+        try:
+            mask = cached_mask_index(mask_path, read_mask_image, Path_settings.get("mask_index_dir"))
+            span["cells"] = len(mask)
+            logging.info("Loaded mask: %s, number of cells: %s", mask_filename, len(mask))
 
+        except FileNotFoundError:
+            logging.warning("Segmentation mask not found: %s", mask_path)
+            return None
+        except Exception as e:
+            logging.error("failed to load the masks %s: %s", mask_path, e)
+            return None
 
-def load_segmentation_mask(Path_settings):
+        return mask
+
+
+def load_segmentation_mask(Path_settings, file_names=None):
     """"
     Load the segmented mask done by cellpose (.png) corresponding to the given filename. The background is 0 and each cell has a unique number in the mask. 
 
@@ -25,40 +62,21 @@ def load_segmentation_mask(Path_settings):
         mask_dir (str): Path to the segmentation mask directory. (Note: the segmentation was done from the GFP projection)
         input dir (str): path to the raw data
         mask_siffix(str): for the mask file name
+    file_names (list): names of the raw files whose masks are loaded (e.g. from the dataset catalog), instead of listing the raw directory.
 
     
     Returns:
-        np.ndarray: Loaded mask image as an integer array, or None if loading fails.
-        - masks(dict):dictionary with the file names as keys and segmentation masks (np.ndarray integer array) as values.
+        - masks(dict):dictionary with the file names as keys and the MaskIndex of the segmentation masks as values (see read_segmentation_mask).
     """
-    input_dir = Path_settings["input_dir"]
-    mask_dir = Path_settings["mask_dir"]
-    mask_suffix = Path_settings["mask_suffix"]
+    if file_names is None:
+        input_dir = Path_settings["input_dir"]
+        file_names = sorted(filename for filename in os.listdir(input_dir)
+                            if not filename.startswith('.') and filename.endswith(".TIF"))
 
     masks = {}
-    for filename in tqdm(os.listdir(input_dir)):
-        if filename.endswith(".TIF"):
-            mask_filename = filename.replace('.TIF', mask_suffix)
-            mask_path = os.path.join(mask_dir,mask_filename)
-
-        if not os.path.exists(mask_path):
-            logging.warning(f"Segmentation mask not found: {mask_path}")
-            continue
-    
-        try:
-            mask = imageio.imread(mask_path)
-            mask = np.array(mask, dtype=np.uint16)
-            
-            unique_values = np.unique(mask)
+    for filename in tqdm(file_names):
+        mask = read_segmentation_mask(filename, Path_settings)
+        if mask is not None:
             masks[filename] = mask
-            logging.info(f"Loaded mask: {mask_filename}, number of cells: {len(unique_values) - 1}")
-
-        
-        except Exception as e:
-            logging.error(f"failed to load the masks {mask_path}: {e}")
-            continue
     
     return masks
-    
-
-
@@ -1,7 +1,7 @@
 import numpy as np
-from scipy import stats
 import pandas as pd
 import os
+import json
 import logging
 def compute_stats(copy_numbers, output_dir):
     """Computes and returns summary statistics for the copy numbers."""
@@ -10,6 +10,8 @@ def compute_stats(copy_numbers, output_dir):
         logging.warning("The input copy_numbers list is empty. No statistics will be computed.")
         return
     
+    from scipy import stats
+
     try:
 
         mean_copy_number = np.mean(copy_numbers)
@@ -20,7 +22,7 @@ def compute_stats(copy_numbers, output_dir):
 
 
     except Exception as e:
-        logging.error(f"Error during computation of statistics: {e}")
+        logging.error("Error during computation of statistics: %s", e)
         return
     
     stats_summary = {
@@ -36,4 +38,286 @@ def compute_stats(copy_numbers, output_dir):
         stats_df.to_csv(os.path.join(output_dir, 'copy_number_stats.csv'), index=False)
         logging.info("Summary statistics saved successfully")
     except Exception as e:
-        logging.error(f"error while saving the stats to CSV:{e}")
+        logging.error("error while saving the stats to CSV:%s", e)
+
+
+# file of the mergeable statistics of a run, next to the processed data
+STATS_FILE = "copy_number_stats.json"
+STATS_VERSION = 1
+
+# group keys of the mergeable statistics, from the coarsest to the finest
+GROUP_KEYS = ("protein_name", "condition", "file_name")
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with a relative accuracy guarantee (DDSketch): the values are counted in logarithmic
+    buckets, so any quantile is estimated within relative_accuracy of a value of the data, with a memory that grows
+    with the log of the range of the values and not with their number. Two sketches merge by adding their counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.positive.values()) + sum(self.negative.values())
+
+    def _add(self, store, values):
+        index, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for i, c in zip(index.tolist(), counts.tolist()):
+            store[i] = store.get(i, 0) + c
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self._add(self.positive, values[values > self.min_value])
+        self._add(self.negative, -values[values < -self.min_value])
+        self.zero_count += int(np.count_nonzero(np.abs(values) <= self.min_value))
+
+    def merge(self, other):
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for i, c in other_store.items():
+                store[i] = store.get(i, 0) + c
+        self.zero_count += other.zero_count
+        return self
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        Estimated q-quantile (0 <= q <= 1) of the values, nan if the sketch is empty.
+        """
+        count = self.count
+        if count == 0:
+            return np.nan
+        rank = q * (count - 1)
+        seen = 0
+        # ascending values: negatives from the largest magnitude, zeros, positives from the smallest
+        for i in sorted(self.negative, reverse=True):
+            seen += self.negative[i]
+            if seen > rank:
+                return -self._value(i)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return self._value(i)
+        return np.nan
+
+    def to_dict(self):
+        return {"relative_accuracy": self.relative_accuracy, "min_value": self.min_value,
+                "positive": {str(i): c for i, c in self.positive.items()},
+                "negative": {str(i): c for i, c in self.negative.items()},
+                "zero_count": self.zero_count}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"], data["min_value"])
+        sketch.positive = {int(i): c for i, c in data["positive"].items()}
+        sketch.negative = {int(i): c for i, c in data["negative"].items()}
+        sketch.zero_count = data["zero_count"]
+        return sketch
+
+
+class StatsAccumulator:
+    """
+    Mergeable summary statistics of a set of values: count, mean and central moments up to the 4th (combined with
+    the pairwise formulas of Chan et al. / Pebay, so the merge of two accumulators is the accumulator of the union),
+    min and max, and a QuantileSketch for the median and percentiles. Non-finite values are skipped.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, values):
+        """
+        Adds a batch of values (e.g. the copy numbers of a field of view).
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return self
+        batch = StatsAccumulator(self.sketch.relative_accuracy)
+        deviations = values - values.mean()
+        batch.n, batch.mean = values.size, values.mean()
+        batch.m2, batch.m3, batch.m4 = (deviations ** 2).sum(), (deviations ** 3).sum(), (deviations ** 4).sum()
+        batch.min, batch.max = values.min(), values.max()
+        batch.sketch.update(values)
+        return self.merge(batch)
+
+    def merge(self, other):
+        """
+        Merges the statistics of other into this accumulator.
+        """
+        if other.n == 0:
+            return self
+        na, nb = self.n, other.n
+        n = na + nb
+        delta = other.mean - self.mean
+
+        m4 = (self.m4 + other.m4 + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+              + 6 * delta ** 2 * (na * na * other.m2 + nb * nb * self.m2) / n ** 2
+              + 4 * delta * (na * other.m3 - nb * self.m3) / n)
+        m3 = (self.m3 + other.m3 + delta ** 3 * na * nb * (na - nb) / n ** 2
+              + 3 * delta * (na * other.m2 - nb * self.m2) / n)
+        m2 = self.m2 + other.m2 + delta ** 2 * na * nb / n
+
+        self.n, self.mean, self.m2, self.m3, self.m4 = n, self.mean + delta * nb / n, m2, m3, m4
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def summary(self):
+        """
+        Summary statistics, with the same definitions as compute_stats (population standard deviation, biased
+        skewness and excess kurtosis); the median and percentiles are estimated by the sketch.
+        """
+        variance = self.m2 / self.n if self.n else np.nan
+        shape = variance > 0
+        return {
+            'Cells': self.n,
+            'Mean Copy Number': self.mean if self.n else np.nan,
+            'Median Copy Number': self.sketch.quantile(0.5),
+            'Standard Deviation': np.sqrt(variance),
+            'Skewness': self.m3 / self.n / variance ** 1.5 if shape else np.nan,
+            'Kurtosis': self.m4 / self.n / variance ** 2 - 3 if shape else np.nan,
+            'Min': self.min if self.n else np.nan,
+            'P5': self.sketch.quantile(0.05),
+            'P25': self.sketch.quantile(0.25),
+            'P75': self.sketch.quantile(0.75),
+            'P95': self.sketch.quantile(0.95),
+            'Max': self.max if self.n else np.nan,
+        }
+
+    def to_dict(self):
+        return {"n": self.n, "mean": float(self.mean), "m2": float(self.m2), "m3": float(self.m3), "m4": float(self.m4),
+                "min": float(self.min), "max": float(self.max), "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        accumulator = cls()
+        accumulator.n, accumulator.mean = data["n"], data["mean"]
+        accumulator.m2, accumulator.m3, accumulator.m4 = data["m2"], data["m3"], data["m4"]
+        accumulator.min, accumulator.max = data["min"], data["max"]
+        accumulator.sketch = QuantileSketch.from_dict(data["sketch"])
+        return accumulator
+
+
+class GroupedStats:
+    """
+    StatsAccumulator per group of cells, keyed by (protein_name, condition, file_name). Updated per field of view
+    during the processing, saved next to the results (copy_number_stats.json), and merged across runs and regrouped
+    by any subset of the keys without reading the per-cell data again.
+    """
+
+    def __init__(self, keys=GROUP_KEYS):
+        self.keys = tuple(keys)
+        self.groups = {}
+
+    def update(self, group, values):
+        self.groups.setdefault(tuple(group), StatsAccumulator()).update(values)
+        return self
+
+    def merge(self, other):
+        """
+        Merges the groups of other, grouped by the same keys (see regroup to merge statistics grouped differently).
+
+        Raises:
+            ValueError: if the keys of the statistics differ.
+        """
+        if tuple(other.keys) != self.keys:
+            raise ValueError(f"Cannot merge statistics grouped by {list(other.keys)} into statistics grouped by {list(self.keys)}.")
+        for group, accumulator in other.groups.items():
+            self.groups.setdefault(group, StatsAccumulator()).merge(accumulator)
+        return self
+
+    def regroup(self, by):
+        """
+        Merges the groups that have the same values of the keys in by, e.g. by=("protein_name", "condition")
+        pools the fields of view of each condition. by=() pools everything.
+        """
+        positions = [self.keys.index(key) for key in by]
+        regrouped = GroupedStats(by)
+        for group, accumulator in self.groups.items():
+            regrouped.groups.setdefault(tuple(group[i] for i in positions), StatsAccumulator()).merge(accumulator)
+        return regrouped
+
+    def table(self):
+        """
+        Summary statistics of every group, one row per group.
+        """
+        return pd.DataFrame([dict(zip(self.keys, group), **accumulator.summary())
+                             for group, accumulator in sorted(self.groups.items())])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"version": STATS_VERSION, "keys": list(self.keys),
+                       "groups": [{"group": list(group), "stats": accumulator.to_dict()}
+                                  for group, accumulator in self.groups.items()]}, f)
+        logging.info("Saved the mergeable statistics of %s groups to %s", len(self.groups), path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads the statistics saved by save.
+
+        Raises:
+            ValueError: if the file was saved by another version of the statistics.
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != STATS_VERSION:
+            raise ValueError(f"{path} has the statistics version {data.get('version')}, expected {STATS_VERSION}.")
+        grouped = cls(data["keys"])
+        for entry in data["groups"]:
+            grouped.groups[tuple(entry["group"])] = StatsAccumulator.from_dict(entry["stats"])
+        return grouped
+
+
+def update_fov_stats(fov_stats, file_name, copy_numbers, Path_settings):
+    """
+    Adds the copy numbers of the cells of a field of view to the grouped statistics of the run (if any).
+    """
+    if fov_stats is None or len(copy_numbers) == 0:
+        return
+    fov_stats.update((Path_settings["protein_name"], Path_settings["condition"], file_name), copy_numbers)
+
+
+def merge_stats_files(paths, by=("protein_name", "condition")):
+    """
+    Merges the saved statistics (copy_number_stats.json) of several runs, grouped by the keys in by.
+
+    Args:
+        paths (list): statistics files of the runs.
+        by (tuple): group keys of the result, a subset of GROUP_KEYS.
+
+    Returns:
+        GroupedStats, see GroupedStats.table for the summary of each group.
+
+    Raises:
+        ValueError: if a file has another version or other group keys.
+    """
+    merged = GroupedStats()
+    for path in paths:
+        stats = GroupedStats.load(path)
+        try:
+            merged.merge(stats)
+        except ValueError as e:
+            raise ValueError(f"Cannot merge {path}: {e}") from None
+    return merged.regroup(by)
@@ -0,0 +1,12 @@
+import os
+import sys
+import logging
+
+# the modules of src/ and benchmarks/ are imported as top-level modules, as by the scripts
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+# the stages log every file and cell, only the warnings are kept
+logging.getLogger().setLevel(logging.WARNING)
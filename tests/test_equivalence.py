@@ -0,0 +1,166 @@
+"""
+Equivalence of the analysis with the per-cell masking of the original pipeline (a full-frame binary mask per cell,
+multiplied with every slice), on a small seeded synthetic field of view: process_fov, the Z-chunked reduction
+(in memory and from a compressed stack read on demand), the dict wrappers, and the CellTable save/load/concat.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+from synthetic import CONFIG_TEMPLATE, SINGLE_MNG_INTENSITY, make_fov
+from load_data import close_stacks, open_stack, split_channels
+from mask_index import MaskIndex
+from cells import CellTable
+from analysis import (segment_stacks, reduce_fov, find_active_slices, cell_intensity, save_processed_data,
+                      process_fov, write_processed_data)
+
+SEED = 0
+FILE_NAME = "synthetic_000.TIF"
+
+
+@pytest.fixture(scope="module")
+def fov():
+    raw, mask = make_fov("small", np.random.default_rng(SEED))
+    return raw, split_channels(raw), mask
+
+
+def make_config(tmp_path, drop_threshold=90, ci=None):
+    with open(CONFIG_TEMPLATE, "r") as f:
+        config = json.load(f)
+    config["Path_settings"]["output_dir"] = str(tmp_path)
+    config["active_slice_settings"].update(plot_intensity_profile=False, drop_threshold=drop_threshold)
+    config["Analysis_settings"].update(single_mNG_intensity=SINGLE_MNG_INTENSITY, single_mNG_intensity_ci=ci)
+    return config
+
+
+def legacy_cells(channels, mask, config):
+    """
+    The analysis of the original pipeline: per-slice sums of each cell masked with its full-frame binary mask,
+    then the focal slice, active slices and copy number of each cell in Python loops.
+    """
+    drop_threshold = config["active_slice_settings"]["drop_threshold"]
+    settings = config["Analysis_settings"]
+    rg, ra = settings["rg"], settings["ra"]
+
+    rows = []
+    for cell_id in np.unique(mask[mask > 0]):
+        binary_mask = mask == cell_id
+        gfp_sums = [np.sum(image * binary_mask) for image in channels['GFP']]
+        rfp_sums = [np.sum(image * binary_mask) for image in channels['RFP']]
+
+        focal_plane = int(np.argmax(gfp_sums))
+        focal_intensity = float(gfp_sums[focal_plane])
+        threshold_intensity = focal_intensity * (1 - drop_threshold / 100)
+        active_slices = [i for i, intensity in enumerate(gfp_sums) if intensity >= threshold_intensity]
+
+        gfp_total_intensity = sum(gfp_sums[i] for i in active_slices)
+        rfp_total_intensity = sum(rfp_sums[i] for i in active_slices)
+        total_intensity_normal = (rg * gfp_total_intensity - ra * rg * rfp_total_intensity) / (rg - ra)
+        rows.append({'cell_id': int(cell_id), 'focal_slice': focal_plane, 'focal_intensity': focal_intensity,
+                     'threshold_intensity': threshold_intensity, 'active_slices': active_slices,
+                     'total_intensity': gfp_total_intensity, 'total_background': rfp_total_intensity,
+                     'total_intensity_normal': total_intensity_normal,
+                     'copy_number': total_intensity_normal / settings["single_mNG_intensity"]})
+    return rows
+
+
+def assert_matches_legacy(table, legacy):
+    assert table['cell_id'].tolist() == [row['cell_id'] for row in legacy]
+    assert table['focal_slice'].tolist() == [row['focal_slice'] for row in legacy]
+    assert table['total_intensity'].tolist() == [row['total_intensity'] for row in legacy]
+    assert table['total_background'].tolist() == [row['total_background'] for row in legacy]
+    for column in ('focal_intensity', 'threshold_intensity', 'total_intensity_normal', 'copy_number'):
+        np.testing.assert_allclose(table[column], [row[column] for row in legacy], rtol=1e-12)
+    assert [np.flatnonzero(row).tolist() for row in table.active_mask()] == [row['active_slices'] for row in legacy]
+
+
+@pytest.mark.parametrize("drop_threshold", [90, 30])
+def test_process_fov_matches_legacy(fov, tmp_path, drop_threshold):
+    _, channels, mask = fov
+    config = make_config(tmp_path, drop_threshold)
+    legacy = legacy_cells(channels, mask, config)
+
+    assert_matches_legacy(process_fov(FILE_NAME, channels, mask, config), legacy)
+    # same cells from the mask index (as read from the sidecars)
+    assert_matches_legacy(process_fov(FILE_NAME, channels, MaskIndex.from_mask(mask), config), legacy)
+
+
+def test_copy_number_interval(fov, tmp_path):
+    _, channels, mask = fov
+    table = process_fov(FILE_NAME, channels, mask, make_config(tmp_path, ci=[650.0, 780.0]))
+    np.testing.assert_allclose(table['copy_number_ci_low'], table['total_intensity_normal'] / 780.0, rtol=1e-12)
+    np.testing.assert_allclose(table['copy_number_ci_high'], table['total_intensity_normal'] / 650.0, rtol=1e-12)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_dict_functions_match_process_fov(fov, tmp_path, compact):
+    _, channels, mask = fov
+    config = make_config(tmp_path, drop_threshold=30)
+    segmented = segment_stacks({FILE_NAME: channels}, {FILE_NAME: mask}, compact=compact)
+    active_slices = find_active_slices(segmented, config["active_slice_settings"])
+    intensities = cell_intensity(segmented, active_slices, config["Analysis_settings"])
+
+    df = save_processed_data(active_slices, intensities, str(tmp_path / "dicts.csv"))
+    expected = write_processed_data(process_fov(FILE_NAME, channels, mask, config), str(tmp_path / "batch.csv"))
+    # the segmented stacks sum to uint64 and the labelled reduction to int64, same values
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+    assert (tmp_path / "dicts.csv").read_bytes() == (tmp_path / "batch.csv").read_bytes()
+
+
+@pytest.mark.parametrize("z_chunk_size", [1, 3, 10, 64])
+def test_reduce_fov_chunked(fov, z_chunk_size):
+    _, channels, mask = fov
+    cell_ids, GFP_sums, RFP_sums = reduce_fov(channels, mask)
+    chunked_ids, chunked_GFP_sums, chunked_RFP_sums = reduce_fov(channels, mask, z_chunk_size)
+
+    np.testing.assert_array_equal(chunked_ids, cell_ids)
+    np.testing.assert_array_equal(chunked_GFP_sums, GFP_sums)
+    np.testing.assert_array_equal(chunked_RFP_sums, RFP_sums)
+
+
+@pytest.mark.parametrize("z_chunk_size", [None, 4])
+def test_lazy_compressed_stack(fov, tmp_path, z_chunk_size):
+    raw, channels, mask = fov
+    path = tmp_path / FILE_NAME
+    # a compressed stack cannot be memory-mapped, it is read on demand (LazyStack)
+    tifffile.imwrite(path, raw, compression="zlib")
+    config = make_config(tmp_path)
+    config["Execution_settings"]["z_chunk_size"] = z_chunk_size
+
+    lazy_channels = split_channels(open_stack(str(path), lazy=True))
+    try:
+        table = process_fov(FILE_NAME, lazy_channels, mask, config)
+    finally:
+        close_stacks(lazy_channels)
+    assert_matches_legacy(table, legacy_cells(channels, mask, config))
+
+
+def test_cell_table_save_load_concat(fov, tmp_path):
+    _, channels, mask = fov
+    config = make_config(tmp_path, drop_threshold=30)
+    first = process_fov("b.TIF", channels, mask, config)
+    # a second field of view with fewer slices and the copy number interval
+    config["Analysis_settings"]["single_mNG_intensity_ci"] = [650.0, 780.0]
+    second = process_fov("a.TIF", {channel: stack[:7] for channel, stack in channels.items()}, mask, config)
+
+    path = tmp_path / "cells.npz"
+    first.save(path)
+    loaded = CellTable.load(path)
+    assert loaded.file_names == first.file_names
+    assert loaded.n_slices == first.n_slices
+    np.testing.assert_array_equal(loaded.active, first.active)
+    pd.testing.assert_frame_equal(loaded.to_pandas(), first.to_pandas())
+
+    table = CellTable.concat([loaded, CellTable.empty(), second])
+    df = table.to_pandas().astype({'File Name': object})
+    expected = pd.concat([first.to_pandas(), second.to_pandas()], ignore_index=True).astype({'File Name': object})
+    pd.testing.assert_frame_equal(df, expected[df.columns])
+    assert np.isnan(table['copy_number_ci_low'][:len(first)]).all()
+
+    # sorted by (file name, cell ID), as the parallel runs
+    table = table.sorted()
+    assert np.asarray(table.file_names)[table.file_index].tolist() == ["a.TIF"] * len(second) + ["b.TIF"] * len(first)
+    assert table['cell_id'].tolist() == second['cell_id'].tolist() + first['cell_id'].tolist()
@@ -0,0 +1,48 @@
+"""
+Validation of the binned EM mixture (mixture.py) against sklearn's GaussianMixture fitted on the samples, on the
+synthetic spot table of the calibration, in linear and log10 space. Skipped when sklearn is not installed.
+"""
+import numpy as np
+import pytest
+
+from synthetic import make_spot_table
+from get_mNG_intensity import clean_integrated_intensity_data
+from mixture import fit_mixtures
+
+sklearn_mixture = pytest.importorskip("sklearn.mixture")
+
+K_VALUES = (1, 2, 3)
+N_SPOTS = 20_000
+SEED = 0
+
+
+@pytest.fixture(scope="module")
+def intensities():
+    spots = clean_integrated_intensity_data(make_spot_table(N_SPOTS, np.random.default_rng(SEED)))
+    return spots["Intens"].to_numpy()
+
+
+def sklearn_fits(x):
+    # converged tightly, and from several initializations so the reference is not a local optimum (K=3)
+    return {k: sklearn_mixture.GaussianMixture(k, tol=1e-8, max_iter=1000, n_init=3, random_state=SEED).fit(x.reshape(-1, 1))
+            for k in K_VALUES}
+
+
+@pytest.mark.parametrize("space", ["linear", "log"])
+def test_matches_sklearn(intensities, space):
+    x = intensities if space == "linear" else np.log10(intensities)
+    ours = fit_mixtures(x, K_VALUES)
+    reference = sklearn_fits(x)
+
+    bics = {k: gmm.bic() for k, gmm in ours.items()}
+    reference_bics = {k: gmm.bic(x.reshape(-1, 1)) for k, gmm in reference.items()}
+    # same number of components chosen by the BIC, and BIC within 0.01%
+    assert min(bics, key=bics.get) == min(reference_bics, key=reference_bics.get)
+    for k in K_VALUES:
+        assert bics[k] == pytest.approx(reference_bics[k], rel=1e-4)
+
+    # the 2-component fit of the calibration (16 and 32 units): means within 0.05%, weights within 0.0005
+    order = np.argsort(ours[2].means_.ravel())
+    reference_order = np.argsort(reference[2].means_.ravel())
+    np.testing.assert_allclose(ours[2].means_.ravel()[order], reference[2].means_.ravel()[reference_order], rtol=5e-4)
+    np.testing.assert_allclose(ours[2].weights_.ravel()[order], reference[2].weights_.ravel()[reference_order], atol=5e-4)